@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+"""Benchmark rendering the charge emails that payday sends out.
+
+Usage:
+
+    [gratipay] $ honcho run -e defaults.env,local.env ./env/bin/python bin/bench-emails.py [nmessages]
+
+It renders nmessages (default 10,000) charge_succeeded and charge_failed
+emails for the participants in the database, spread over a few languages, and
+prints the median and worst time per message. It does that twice: once as
+payday does, with the templates and i18n helpers cached for each locale, and
+once with the caches emptied before every message, which is what each message
+cost when the helpers were rebuilt for it.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import time
+from decimal import Decimal
+
+from gratipay import wireup
+from gratipay.models.participant import Participant
+from gratipay.utils import i18n
+
+
+LANGS = ['en', 'fr,en;q=0.8', 'de-DE,de;q=0.9', 'es']
+
+
+def render_all(participants, nmessages, cold):
+    times = []
+    for n in range(nmessages):
+        p = participants[n % len(participants)]
+        p.set_attributes(email_lang=LANGS[n % len(LANGS)])
+        spt_name = 'charge_succeeded' if n % 2 else 'charge_failed'
+        exchange = dict(id=n, amount=Decimal('10.00'), fee=Decimal('0.59'), note='Declined')
+        if cold:
+            i18n.MATCHED_LANGS.clear()
+            for template in Participant._emails[spt_name].values():
+                template.by_locale.clear()
+        start = time.time()
+        p.render_email(spt_name, email='bench@example.com', exchange=exchange,
+                       nteams=3, top_team='Gratipay')
+        times.append(time.time() - start)
+    return times
+
+
+def main(nmessages=10000):
+    env = wireup.env()
+    db = wireup.db(env)
+    wireup.make_sentry_teller(env)
+    wireup.mail(env)
+    participants = db.all("SELECT p.*::participants FROM participants p LIMIT 100")
+    if not participants:
+        sys.exit("No participants to send emails to. Fill the database with fake data first.")
+    for cold in (False, True):
+        times = sorted(render_all(participants, nmessages, cold))
+        print("%-7s median %6.2fms   worst %6.2fms   (%i messages)"
+              % ('cold' if cold else 'cached', times[len(times) // 2] * 1000, times[-1] * 1000,
+                 len(times)))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+"""Benchmark the history pages against a big generated ledger.
+
+Usage:
+
+    [gratipay] $ honcho run -e defaults.env,local.env ./env/bin/python bin/bench-history.py [nrows]
+
+Point it at a scratch database! It fills the database with fake participants
+and teams, and then with about nrows (default 10,000,000) ledger rows spread
+over the last four years, a third each of exchanges, transfers,
+and payments. It then times iter_payday_events and export_history, which are
+what /~user/history/ and its exports run, for the busiest participants and
+every year, and prints the median and worst times. The history is timed for
+the whole year, and for the first page of DAYS_PER_PAGE days.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import sys
+import time
+from datetime import datetime
+
+from gratipay import wireup
+from gratipay.models.participant import Participant
+from gratipay.utils import fake_data
+from gratipay.utils.history import export_history, iter_payday_events
+
+
+NPARTICIPANTS = 1000
+NTEAMS = 50
+NSAMPLES = 10
+YEARS = 4
+DAYS_PER_PAGE = 30
+
+
+def generate(db, nrows):
+    print("Making participants and teams")
+    fake_data.prep_db(db)
+    fake_data.populate_db(db, num_participants=NPARTICIPANTS, ntips=NPARTICIPANTS,
+                          num_teams=NTEAMS, num_transfers=NPARTICIPANTS, num_communities=0)
+    fake_data.clean_db(db)
+    db.run("UPDATE participants SET ctime = ctime - interval '%s years'" % YEARS)
+
+    n = nrows // 3
+    params = dict(n=n, years=YEARS)
+    print("Making %i exchanges" % n)
+    db.run("""
+        WITH p AS (SELECT array_agg(username) AS usernames FROM participants)
+        INSERT INTO exchanges (timestamp, amount, fee, participant, status)
+             SELECT now() - random() * (interval '1 year' * %(years)s)
+                  , round((random() * 200 - 50)::numeric, 2)
+                  , 0
+                  , p.usernames[1 + (i %% array_length(p.usernames, 1))]
+                  , 'succeeded'
+               FROM p, generate_series(1, %(n)s) i
+    """, params)
+    print("Making %i transfers" % n)
+    db.run("""
+        WITH p AS (SELECT array_agg(username) AS usernames FROM participants)
+        INSERT INTO transfers (timestamp, tipper, tippee, amount, context)
+             SELECT now() - random() * (interval '1 year' * %(years)s)
+                  , p.usernames[1 + (i %% array_length(p.usernames, 1))]
+                  , p.usernames[1 + ((i + 1 + i / 7) %% array_length(p.usernames, 1))]
+                  , round((random() * 20 + 0.01)::numeric, 2)
+                  , 'tip'
+               FROM p, generate_series(1, %(n)s) i
+    """, params)
+    print("Making %i payments" % n)
+    db.run("""
+        WITH p AS (SELECT array_agg(username) AS usernames FROM participants)
+           , t AS (SELECT array_agg(slug) AS slugs FROM teams)
+        INSERT INTO payments (timestamp, participant, team, amount, direction)
+             SELECT now() - random() * (interval '1 year' * %(years)s)
+                  , p.usernames[1 + (i %% array_length(p.usernames, 1))]
+                  , t.slugs[1 + (i %% array_length(t.slugs, 1))]
+                  , round((random() * 20 + 0.01)::numeric, 2)
+                  , CASE WHEN i %% 2 = 0 THEN 'to-team' ELSE 'to-participant' END::payment_direction
+               FROM p, t, generate_series(1, %(n)s) i
+    """, params)
+    print("Analyzing")
+    db.run("ANALYZE")
+
+
+def bench(db):
+    usernames = db.all("""
+        SELECT participant
+          FROM exchanges
+      GROUP BY participant
+      ORDER BY count(*) DESC
+         LIMIT %s
+    """, (NSAMPLES,))
+    current_year = datetime.utcnow().year
+    timings = {'history': [], 'page': [], 'export': [], 'aggregate': []}
+    for username in usernames:
+        participant = Participant.from_username(username)
+        for year in range(current_year - YEARS, current_year + 1):
+            start = time.time()
+            list(iter_payday_events(db, participant, year))
+            timings['history'].append(time.time() - start)
+            start = time.time()
+            list(iter_payday_events(db, participant, year, ndays=DAYS_PER_PAGE))
+            timings['page'].append(time.time() - start)
+            for mode in ('export', 'aggregate'):
+                start = time.time()
+                export_history(participant, year, mode, None)
+                timings[mode].append(time.time() - start)
+
+    for page, times in sorted(timings.items()):
+        times.sort()
+        print("%-10s median %7.1fms   worst %7.1fms   (%i samples)"
+              % (page, times[len(times) // 2] * 1000, times[-1] * 1000, len(times)))
+
+
+def main(nrows=10000000):
+    db = wireup.db(wireup.env())
+    generate(db, nrows)
+    bench(db)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
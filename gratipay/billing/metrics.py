@@ -0,0 +1,105 @@
+"""Measure the stages of payday.
+
+Each stage of payday runs inside Payday.measure, which hands it cursor and db
+wrappers that charge the time spent in queries (and the rows they touch) to a
+StageMetrics object. Calls out to the payment processor are counted as well.
+
+"""
+from __future__ import division, unicode_literals
+
+import threading
+import time
+from contextlib import contextmanager
+
+
+class StageMetrics(object):
+    """Accumulate timing and counts for one stage of payday.
+
+    Card holds are created and settled in a thread pool, so the counters are
+    guarded by a lock.
+
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.wall_time = 0.0            # seconds
+        self.db_time = 0.0              # seconds
+        self.nrows = 0                  # rows returned or touched by queries
+        self.nprocessor_calls = 0       # calls to Braintree
+        self._lock = threading.Lock()
+
+    def add_query(self, elapsed, nrows):
+        with self._lock:
+            self.db_time += elapsed
+            self.nrows += max(nrows, 0)  # rowcount is -1 for some statements
+
+    def add_processor_call(self):
+        with self._lock:
+            self.nprocessor_calls += 1
+
+    def _asdict(self):
+        return dict( stage=self.stage
+                   , wall_time=self.wall_time
+                   , db_time=self.db_time
+                   , nrows=self.nrows
+                   , nprocessor_calls=self.nprocessor_calls
+                    )
+
+
+class TimedCursor(object):
+    """Wrap a cursor so that the time spent in run/one/all is charged to a
+    StageMetrics object. Everything else is passed through.
+    """
+
+    def __init__(self, cursor, metrics):
+        self._cursor = cursor
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def _timed(self, method, *a):
+        start = time.time()
+        try:
+            return method(*a)
+        finally:
+            self._metrics.add_query(time.time() - start, self._cursor.rowcount)
+
+    def run(self, sql, parameters=None):
+        return self._timed(self._cursor.run, sql, parameters)
+
+    def one(self, sql, parameters=None, default=None):
+        return self._timed(self._cursor.one, sql, parameters, default)
+
+    def all(self, sql, parameters=None):
+        return self._timed(self._cursor.all, sql, parameters)
+
+
+class TimedDB(object):
+    """Wrap a GratipayDB so that the queries it runs are charged to a
+    StageMetrics object.
+    """
+
+    def __init__(self, db, metrics):
+        self._db = db
+        self._metrics = metrics
+
+    def __getattr__(self, name):
+        return getattr(self._db, name)
+
+    @contextmanager
+    def get_cursor(self, cursor=None, **kw):
+        with self._db.get_cursor(cursor, **kw) as c:
+            yield c if isinstance(c, TimedCursor) else TimedCursor(c, self._metrics)
+
+    def run(self, sql, parameters=None, **kw):
+        with self.get_cursor(**kw) as cursor:
+            cursor.run(sql, parameters)
+
+    def one(self, sql, parameters=None, default=None, **kw):
+        with self.get_cursor(**kw) as cursor:
+            return cursor.one(sql, parameters, default)
+
+    def all(self, sql, parameters=None, **kw):
+        with self.get_cursor(**kw) as cursor:
+            return cursor.all(sql, parameters)
@@ -12,7 +12,8 @@ immediately affect the participant's balance.
 from __future__ import unicode_literals
 
 import itertools
-from multiprocessing.dummy import Pool as ThreadPool
+import time
+from contextlib import contextmanager
 
 import braintree
 
@@ -21,8 +22,12 @@ from aspen import log
 from gratipay.billing.exchanges import (
     cancel_card_hold, capture_card_hold, create_card_hold, upcharge, MINIMUM_CHARGE,
 )
+from gratipay.billing.metrics import StageMetrics, TimedCursor, TimedDB
+from gratipay.billing.processor import ProcessorExecutor
 from gratipay.exceptions import NegativeBalance
 from gratipay.models import check_db
+from gratipay.utils import emails
+from gratipay.utils.history import snapshot_balances
 from psycopg2 import IntegrityError
 
 
@@ -30,32 +35,31 @@ with open('sql/payday.sql') as f:
     PAYDAY = f.read()
 
 
-class ExceptionWrapped(Exception): pass
+def log_errors(batch, what):
+    """Log the errors in a BatchResult from the processor executor.
+    """
+    for error in batch.errors:
+        log("Failed to %s for %r:\n%s" % (what, error.item, error.traceback))
 
 
-def threaded_map(func, iterable, threads=5):
-    pool = ThreadPool(threads)
-    def g(*a, **kw):
-        # Without this wrapper we get a traceback from inside multiprocessing.
-        try:
-            return func(*a, **kw)
-        except Exception as e:
-            import traceback
-            raise ExceptionWrapped(e, traceback.format_exc())
-    try:
-        r = pool.map(g, iterable)
-    except ExceptionWrapped as e:
-        print(e.args[1])
-        raise e.args[0]
-    pool.close()
-    pool.join()
-    return r
+# How often to log progress while paging through existing card holds
+FETCH_PROGRESS_EVERY = 100
 
 
 class NoPayday(Exception):
     __str__ = lambda self: "No payday found where one was expected."
 
 
+class UnknownPayinEngine(Exception):
+    __str__ = lambda self: "Unknown payin engine: {}.".format(self.args[0])
+
+
+# The trigger engine funds payment instructions one row at a time through the
+# process_payment_instruction trigger. The set-based engine does the same work
+# in a handful of statements (see fund_payment_instructions in payday.sql).
+PAYIN_ENGINES = ('trigger', 'set-based')
+
+
 class Payday(object):
     """Represent an abstract event during which money is moved.
 
@@ -78,9 +82,21 @@ class Payday(object):
                 take_over_balances
             update_stats
             end
+            snapshot_balances
+            notify_participants
+
+    The payin_engine attribute selects how process_payment_instructions does
+    its work; see PAYIN_ENGINES.
+
+    Each stage runs inside measure, which records its timing and row counts in
+    the payday_metrics table.
 
     """
 
+    payin_engine = 'trigger'
+    stage_metrics = None    # the StageMetrics of the stage that's running
+    processor = ProcessorExecutor()     # replaced in wireup.billing
+
 
     @classmethod
     def start(cls):
@@ -123,6 +139,9 @@ class Payday(object):
         crashes.
 
         """
+        if self.payin_engine not in PAYIN_ENGINES:
+            raise UnknownPayinEngine(self.payin_engine)
+
         self.db.self_check()
 
         _start = aspen.utils.utcnow()
@@ -132,11 +151,15 @@ class Payday(object):
             self.payin()
             self.mark_stage_done()
         if self.stage < 2:
-            self.update_stats()
+            with self.measure('update_stats'):
+                self.update_stats()
             self.mark_stage_done()
 
         self.end()
-        self.notify_participants()
+        with self.measure('snapshot_balances'):
+            snapshot_balances(self.db)
+        with self.measure('notify_participants'):
+            self.notify_participants()
 
         _end = aspen.utils.utcnow()
         _delta = _end - _start
@@ -149,26 +172,73 @@ class Payday(object):
         money internally between participants.
         """
         with self.db.get_cursor() as cursor:
-            self.prepare(cursor, self.ts_start)
-            holds = self.create_card_holds(cursor)
-            self.process_payment_instructions(cursor)
+            with self.measure('prepare', cursor) as c:
+                self.prepare(c, self.ts_start)
+            with self.measure('create_card_holds', cursor) as c:
+                holds = self.create_card_holds(c)
+            with self.measure('process_payment_instructions', cursor) as c:
+                self.process_payment_instructions(c)
             self.transfer_takes(cursor, self.ts_start)
-            self.process_draws(cursor)
+            with self.measure('process_draws', cursor) as c:
+                self.process_draws(c)
             payments = cursor.all("""
                 SELECT * FROM payments WHERE "timestamp" > %s
             """, (self.ts_start,))
             try:
-                self.settle_card_holds(cursor, holds)
-                self.update_balances(cursor)
+                with self.measure('settle_card_holds', cursor) as c:
+                    self.settle_card_holds(c, holds)
+                with self.measure('update_balances', cursor) as c:
+                    self.update_balances(c)
                 check_db(cursor)
             except:
                 # Dump payments for debugging
                 import csv
-                from time import time
-                with open('%s_payments.csv' % time(), 'wb') as f:
+                with open('%s_payments.csv' % time.time(), 'wb') as f:
                     csv.writer(f).writerows(payments)
                 raise
-        self.take_over_balances()
+        with self.measure('take_over_balances'):
+            self.take_over_balances()
+
+
+    @contextmanager
+    def measure(self, stage, cursor=None):
+        """Time a stage of payday and record what it did in payday_metrics.
+
+        Within the block self.db is swapped out for a TimedDB, and if a cursor
+        is given then a TimedCursor wrapping it is yielded. The metrics are then
+        recorded with that cursor too, so they're rolled back along with the
+        stage.
+
+        """
+        metrics = self.stage_metrics = StageMetrics(stage)
+        db = self.db
+        self.db = TimedDB(db, metrics)
+        start = time.time()
+        try:
+            yield TimedCursor(cursor, metrics) if cursor else None
+        finally:
+            metrics.wall_time = time.time() - start
+            self.db = db
+            self.stage_metrics = None
+        log( "Stage %s took %.3fs (%.3fs in the DB, %i rows, %i processor calls)."
+           % (stage, metrics.wall_time, metrics.db_time, metrics.nrows, metrics.nprocessor_calls)
+            )
+        with self.db.get_cursor(cursor) as c:
+            c.run("""
+                DELETE FROM payday_metrics WHERE payday = %(payday)s AND stage = %(stage)s;
+                INSERT INTO payday_metrics
+                            (payday, stage, wall_time, db_time, nrows, nprocessor_calls)
+                     VALUES ( %(payday)s, %(stage)s, %(wall_time)s, %(db_time)s, %(nrows)s
+                            , %(nprocessor_calls)s
+                             );
+            """, dict(metrics._asdict(), payday=self.id))
+
+
+    def count_processor_call(self):
+        """Charge a call to the payment processor to the stage that's running.
+        """
+        if self.stage_metrics:
+            self.stage_metrics.add_processor_call()
 
 
     @staticmethod
@@ -179,24 +249,53 @@ class Payday(object):
         log('Prepared the DB.')
 
 
-    @staticmethod
-    def fetch_card_holds(participant_ids):
+    def fetch_card_holds(self, participant_ids, cancellations=None):
+        """Return a dict of existing card holds for the given participants.
+
+        Braintree's search results are paged through lazily. Holds for anyone
+        else are stale, and are handed to cancellations (a BackgroundBatch
+        from self.processor) to be voided while we get on with things. If no
+        batch is given then we make our own and wait for it before returning.
+
+        """
         log('Fetching card holds.')
+        wait = cancellations is None
+        if wait:
+            cancellations = self.processor.background(self.cancel_card_hold)
         holds = {}
+        self.count_processor_call()
         existing_holds = braintree.Transaction.search(
             braintree.TransactionSearch.status == 'authorized'
         )
-        for hold in existing_holds.items:
+        total = existing_holds.maximum_size
+        for i, hold in enumerate(existing_holds.items, 1):
             log_amount = hold.amount
             p_id = int(hold.custom_fields['participant_id'])
             if p_id in participant_ids:
                 log('Reusing a ${:.2f} hold for {}.'.format(log_amount, p_id))
                 holds[p_id] = hold
             else:
-                cancel_card_hold(hold)
+                cancellations.add(hold)
+            if i % FETCH_PROGRESS_EVERY == 0 or i == total:
+                log( 'Fetched %i of about %i card holds (%i reused, %i stale).'
+                   % (i, total, len(holds), len(cancellations))
+                    )
+        if wait:
+            self.wait_for_cancellations(cancellations)
         return holds
 
 
+    def cancel_card_hold(self, hold):
+        self.count_processor_call()
+        cancel_card_hold(hold)
+
+
+    def wait_for_cancellations(self, cancellations):
+        batch = cancellations.wait()
+        log_errors(batch, "cancel a card hold")
+        log("Canceled %i stale card holds." % (len(batch.results) - len(batch.errors)))
+
+
     def create_card_holds(self, cursor):
 
         # Get the list of participants to create card holds for
@@ -210,9 +309,10 @@ class Payday(object):
         if not participants:
             return {}
 
-        # Fetch existing holds
+        # Fetch existing holds, cancelling stale ones in the background
         participant_ids = set(p.id for p in participants)
-        holds = self.fetch_card_holds(participant_ids)
+        cancellations = self.processor.background(self.cancel_card_hold)
+        holds = self.fetch_card_holds(participant_ids, cancellations)
 
         # Create new holds and check amounts of existing ones
         def f(p):
@@ -226,18 +326,23 @@ class Payday(object):
                         return
                     else:
                         # The amount is too low, cancel the hold and make a new one
-                        cancel_card_hold(holds.pop(p.id))
+                        cancellations.add(holds.pop(p.id))
                 else:
                     # not up to minimum charge level. cancel the hold
-                    cancel_card_hold(holds.pop(p.id))
+                    cancellations.add(holds.pop(p.id))
                     return
             if amount >= MINIMUM_CHARGE:
+                self.count_processor_call()
                 hold, error = create_card_hold(self.db, p, amount)
                 if error:
                     return 1
                 else:
                     holds[p.id] = hold
-        threaded_map(f, participants)
+        # create_card_hold records its own failures, and isn't safe to repeat
+        # blindly, so unlike the cancellations it isn't retried.
+        batch = self.processor.map(f, participants, retry_on=())
+        log_errors(batch, "create a card hold")
+        self.wait_for_cancellations(cancellations)
 
         # Update the values of card_hold_ok in our temporary table
         if not holds:
@@ -251,13 +356,17 @@ class Payday(object):
         return holds
 
 
-    @staticmethod
-    def process_payment_instructions(cursor):
-        """Trigger the process_payment_instructions function for each row in
-        payday_payment_instructions.
+    def process_payment_instructions(self, cursor):
+        """Fund or park each row in payday_payment_instructions, using the
+        engine given by self.payin_engine.
         """
-        log("Processing payment instructions.")
-        cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
+        log("Processing payment instructions (%s)." % self.payin_engine)
+        if self.payin_engine == 'trigger':
+            cursor.run("UPDATE payday_payment_instructions SET is_funded=true;")
+        elif self.payin_engine == 'set-based':
+            cursor.run("SELECT fund_payment_instructions();")
+        else:
+            raise UnknownPayinEngine(self.payin_engine)
 
 
     @staticmethod
@@ -308,13 +417,20 @@ class Payday(object):
         # Capture holds to bring balances back up to (at least) zero
         def capture(p):
             amount = -p.new_balance
+            self.count_processor_call()
             capture_card_hold(self.db, p, amount, holds.pop(p.id))
-        threaded_map(capture, participants)
+        # Captures aren't retried: capture_card_hold records the exchange
+        # before it goes to Braintree.
+        batch = self.processor.map(capture, participants, retry_on=())
+        log_errors(batch, "capture a card hold")
+        # Balances depend on the captures, so we can't go on if any failed.
+        batch.raise_first_error()
         log("Captured %i card holds." % len(participants))
 
         log("Canceling card holds.")
         # Cancel the remaining holds
-        threaded_map(cancel_card_hold, holds.values())
+        batch = self.processor.map(self.cancel_card_hold, holds.values())
+        log_errors(batch, "cancel a card hold")
         log("Canceled %i card holds." % len(holds))
 
 
@@ -409,7 +525,15 @@ class Payday(object):
                       FROM our_payments
                      WHERE payday=p.id AND direction='to-team'
                    )
-             WHERE id=%(payday)s
+             WHERE id=%(payday)s;
+
+            DELETE FROM payday_team_stats WHERE payday=%(payday)s;
+            INSERT INTO payday_team_stats
+                        (payday, team, npatrons, receipts)
+                 SELECT payday, team, count(DISTINCT participant), sum(amount)
+                   FROM payments
+                  WHERE payday=%(payday)s AND direction='to-team'
+               GROUP BY payday, team;
 
         """, {'payday': self.id})
         log("Updated payday stats.")
@@ -427,60 +551,84 @@ class Payday(object):
 
 
     def notify_participants(self):
+        """Queue an email for each charge of this payday, in one statement.
+
+        The emails say how many teams the charge funds, and which one gets
+        the most. Those are worked out for all the charged participants at
+        once, from their payment instructions as of the start of payday.
+
+        """
         log("Notifying participants.")
-        ts_start, ts_end = self.ts_start, self.ts_end
-        exchanges = self.db.all("""
-            SELECT e.id, amount, fee, note, status, p.*::participants AS participant
-              FROM exchanges e
-              JOIN participants p ON e.participant = p.username
-             WHERE "timestamp" >= %(ts_start)s
-               AND "timestamp" < %(ts_end)s
-               AND amount > 0
-               AND p.notify_charge > 0
-        """, locals())
-        for e in exchanges:
-            if e.status not in ('failed', 'succeeded'):
-                log('exchange %s has an unexpected status: %s' % (e.id, e.status))
-                continue
-            i = 1 if e.status == 'failed' else 2
-            p = e.participant
-            if p.notify_charge & i == 0:
-                continue
-            username = p.username
-            nteams, top_team = self.db.one("""
-                WITH tippees AS (
-                         SELECT t.slug, amount
-                           FROM ( SELECT DISTINCT ON (team) team, amount
-                                    FROM payment_instructions
-                                   WHERE mtime < %(ts_start)s
-                                     AND participant = %(username)s
-                                ORDER BY team, mtime DESC
-                                ) s
-                           JOIN teams t ON s.team = t.slug
-                           JOIN participants p ON t.owner = p.username
-                          WHERE s.amount > 0
-                            AND t.is_approved IS true
-                            AND t.is_closed IS NOT true
-                            AND (SELECT count(*)
-                                   FROM current_exchange_routes er
-                                  WHERE er.participant = p.id
-                                    AND network = 'paypal'
-                                    AND error = ''
-                                ) > 0
-                     )
-                SELECT ( SELECT count(*) FROM tippees ) AS nteams
-                     , ( SELECT slug
-                           FROM tippees
-                       ORDER BY amount DESC
-                          LIMIT 1
-                       ) AS top_team
-            """, locals())
-            p.queue_email(
-                'charge_'+e.status,
-                exchange=dict(id=e.id, amount=e.amount, fee=e.fee, note=e.note),
-                nteams=nteams,
-                top_team=top_team,
-            )
+        unexpected = self.db.all("""
+
+            WITH charges AS (
+                     SELECT e.id, e.amount, e.fee, e.note, e.status
+                          , p.id AS participant_id, p.username, p.notify_charge
+                       FROM exchanges e
+                       JOIN participants p ON e.participant = p.username
+                      WHERE "timestamp" >= %(ts_start)s
+                        AND "timestamp" < %(ts_end)s
+                        AND amount > 0
+                        AND p.notify_charge > 0
+                 )
+               , instructions AS (
+                     SELECT DISTINCT ON (participant, team) participant, team, amount
+                       FROM payment_instructions
+                      WHERE mtime < %(ts_start)s
+                        AND participant IN (SELECT username FROM charges)
+                   ORDER BY participant, team, mtime DESC
+                 )
+               , tippees AS (
+                     SELECT s.participant, t.slug, s.amount
+                       FROM instructions s
+                       JOIN teams t ON s.team = t.slug
+                       JOIN participants p ON t.owner = p.username
+                      WHERE s.amount > 0
+                        AND t.is_approved IS true
+                        AND t.is_closed IS NOT true
+                        AND EXISTS ( SELECT 1
+                                       FROM current_exchange_routes er
+                                      WHERE er.participant = p.id
+                                        AND network = 'paypal'
+                                        AND error = ''
+                                    )
+                 )
+               , teams_by_participant AS (
+                     SELECT participant
+                          , count(*) AS nteams
+                          , (array_agg(slug ORDER BY amount DESC))[1] AS top_team
+                       FROM tippees
+                   GROUP BY participant
+                 )
+               , queued AS (
+                     INSERT INTO email_queue
+                                 (participant, spt_name, context, context_version)
+                          SELECT c.participant_id
+                               , 'charge_' || c.status
+                               , convert_to(( SELECT row_to_json(context)
+                                                FROM ( SELECT ( SELECT row_to_json(exchange)
+                                                                  FROM ( SELECT c.id, c.amount
+                                                                              , c.fee, c.note
+                                                                        ) exchange
+                                                               ) AS exchange
+                                                            , COALESCE(t.nteams, 0) AS nteams
+                                                            , t.top_team
+                                                     ) context
+                                            )::text, 'UTF8')
+                               , %(version)s
+                            FROM charges c
+                       LEFT JOIN teams_by_participant t ON t.participant = c.username
+                           WHERE c.status IN ('failed', 'succeeded')
+                             AND (c.notify_charge & CASE c.status WHEN 'failed' THEN 1 ELSE 2 END) > 0
+                        ORDER BY c.id
+                 )
+            SELECT id, status
+              FROM charges
+             WHERE status NOT IN ('failed', 'succeeded')
+
+        """, dict(ts_start=self.ts_start, ts_end=self.ts_end, version=emails.CONTEXT_VERSION))
+        for e in unexpected:
+            log('exchange %s has an unexpected status: %s' % (e.id, e.status))
 
 
     def mark_stage_done(self):
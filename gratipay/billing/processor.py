@@ -0,0 +1,197 @@
+"""Make many calls to the payment processor at once.
+
+Payday creates, captures, and cancels card holds for every participant who
+needs one. Those are slow network calls, so we make them concurrently, but
+Braintree also rate-limits us and occasionally has a hiccup. ProcessorExecutor
+wraps all of that up: a reusable pool of worker threads, a token bucket to
+stay under the rate limit, retries with exponential backoff for transient
+errors, and per-item error collection so one bad card doesn't abort the
+whole batch.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+import time
+import traceback
+from multiprocessing.dummy import Pool as ThreadPool
+
+import braintree
+
+
+# Errors from which we know the request wasn't acted on, so it's safe to try
+# it again.
+TRANSIENT_ERRORS = ( braintree.exceptions.DownForMaintenanceError
+                   , braintree.exceptions.http.ConnectionError
+                    )
+
+
+class TokenBucket(object):
+    """Allow at most `rate` calls per second, with bursts of up to `burst`.
+
+    A rate of 0 means no limit.
+
+    """
+
+    def __init__(self, rate, burst=None, clock=time.time, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = burst or max(rate, 1)
+        self.tokens = self.capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """Block until a token is available, then consume it.
+        """
+        if not self.rate:
+            return
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+class ItemError(object):
+    """Represent a failed item in a batch.
+    """
+
+    def __init__(self, item, exception, tb):
+        self.item = item
+        self.exception = exception
+        self.traceback = tb
+
+    def __repr__(self):
+        return '<ItemError %r: %r>' % (self.item, self.exception)
+
+
+class BatchResult(object):
+    """The outcome of ProcessorExecutor.map or BackgroundBatch.wait.
+
+    results is in the same order as the items given, with None for items that
+    failed. errors is a list of ItemError.
+
+    """
+
+    def __init__(self, results, errors):
+        self.results = results
+        self.errors = errors
+
+    @classmethod
+    def from_outcomes(cls, outcomes):
+        results = [r for r, _ in outcomes]
+        errors = [e for _, e in outcomes if e is not None]
+        return cls(results, errors)
+
+    def raise_first_error(self):
+        """If any item failed, re-raise its exception.
+        """
+        if self.errors:
+            raise self.errors[0].exception
+
+
+class BackgroundBatch(object):
+    """A batch of calls that start running as soon as their items are added.
+
+    Call wait to block until they're all done and get a BatchResult.
+
+    """
+
+    def __init__(self, pool, func):
+        self.pool = pool
+        self.func = func
+        self.pending = []
+
+    def __len__(self):
+        return len(self.pending)
+
+    def add(self, item):
+        self.pending.append(self.pool.apply_async(self.func, (item,)))
+
+    def wait(self):
+        return BatchResult.from_outcomes([r.get() for r in self.pending])
+
+
+class ProcessorExecutor(object):
+    """Run processor calls on a bounded pool of threads.
+
+    :param int concurrency: the number of worker threads
+    :param float rate: the maximum number of calls per second (0 for no limit)
+    :param int retries: how many times to retry a call that raised one of the
+        retry_on exceptions
+    :param float backoff: the delay before the first retry, in seconds; it
+        doubles for each subsequent retry
+    :param sleep: the function used to wait, for testing
+
+    """
+
+    def __init__(self, concurrency=5, rate=0, retries=3, backoff=0.5, sleep=time.sleep):
+        self.concurrency = concurrency
+        self.bucket = TokenBucket(rate, sleep=sleep)
+        self.retries = retries
+        self.backoff = backoff
+        self.sleep = sleep
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    @property
+    def pool(self):
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.concurrency)
+            return self._pool
+
+    def call(self, func, *a, **kw):
+        """Call func once we have a token, retrying transient errors.
+        """
+        retry_on = kw.pop('retry_on', TRANSIENT_ERRORS)
+        attempt = 0
+        while True:
+            self.bucket.take()
+            try:
+                return func(*a, **kw)
+            except retry_on:
+                if attempt >= self.retries:
+                    raise
+                self.sleep(self.backoff * 2 ** attempt)
+                attempt += 1
+
+    def _wrap(self, func, retry_on):
+        def g(item):
+            try:
+                return self.call(func, item, retry_on=retry_on), None
+            except Exception as e:
+                return None, ItemError(item, e, traceback.format_exc())
+        return g
+
+    def map(self, func, items, retry_on=TRANSIENT_ERRORS):
+        """Call func on each item concurrently, and return a BatchResult.
+
+        An exception from one item doesn't stop the others from being
+        processed; it's recorded in the result instead.
+
+        """
+        items = list(items)
+        if not items:
+            return BatchResult([], [])
+        outcomes = self.pool.map(self._wrap(func, retry_on), items)
+        return BatchResult.from_outcomes(outcomes)
+
+    def background(self, func, retry_on=TRANSIENT_ERRORS):
+        """Return a BackgroundBatch that calls func on items as they're added.
+        """
+        return BackgroundBatch(self.pool, self._wrap(func, retry_on))
+
+    def close(self):
+        with self._pool_lock:
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+                self._pool = None
@@ -21,7 +21,9 @@ def payday():
     from gratipay.billing.payday import Payday
 
     try:
-        Payday.start().run()
+        payday = Payday.start()
+        payday.payin_engine = env.payin_engine
+        payday.run()
     except KeyboardInterrupt:
         pass
     except:
@@ -6,11 +6,12 @@ import gratipay
 import gratipay.wireup
 from gratipay import utils
 from gratipay.cron import Cron
+from gratipay.models.counters import recompute_counters
 from gratipay.models.participant import Participant
 from gratipay.security import authentication, csrf, security_headers
-from gratipay.utils import erase_cookie, http_caching, i18n, set_cookie, timer
+from gratipay.utils import erase_cookie, http_caching, i18n, query_recorder, set_cookie, timer
 from gratipay.version import get_version
-from gratipay.renderers import csv_dump, jinja2_htmlescaped
+from gratipay.renderers import csv_dump, jinja2_htmlescaped, ndjson_dump
 
 import aspen
 from aspen.website import Website
@@ -26,6 +27,7 @@ website.renderer_default = 'unspecified'  # require explicit renderer, to avoid
 
 website.renderer_factories['csv_dump'] = csv_dump.Factory(website)
 website.renderer_factories['jinja2_htmlescaped'] = jinja2_htmlescaped.Factory(website)
+website.renderer_factories['ndjson_dump'] = ndjson_dump.Factory(website)
 website.default_renderers_by_media_type['text/html'] = 'jinja2_htmlescaped'
 website.default_renderers_by_media_type['text/plain'] = 'jinja2'  # unescaped is fine here
 
@@ -60,6 +62,7 @@ except Exception, e:
 env = website.env = gratipay.wireup.env()
 tell_sentry = website.tell_sentry = gratipay.wireup.make_sentry_teller(env)
 website.db = gratipay.wireup.db(env)
+website.query_cache = gratipay.wireup.query_cache(website.db, env)
 website.mailer = gratipay.wireup.mail(env, website.project_root)
 gratipay.wireup.base_url(website, env)
 gratipay.wireup.secure_cookies(env)
@@ -81,6 +84,8 @@ if exc:
 cron = Cron(website)
 cron(env.update_cta_every, lambda: utils.update_cta(website))
 cron(env.check_db_every, website.db.self_check, True)
+cron(env.full_check_db_every, lambda: website.db.self_check(full=True), True)
+cron(env.recompute_counters_every, lambda: recompute_counters(website.db), True)
 cron(env.dequeue_emails_every, Participant.dequeue_emails, True)
 
 
@@ -91,6 +96,7 @@ noop = lambda: None
 algorithm = website.algorithm
 algorithm.functions = [
     timer.start,
+    query_recorder.start,
     algorithm['parse_environ_into_request'],
     algorithm['parse_body_into_request'],
     algorithm['raise_200_for_OPTIONS'],
@@ -128,6 +134,7 @@ algorithm.functions = [
     algorithm['log_traceback_for_exception'],
     algorithm['log_result_of_request'],
 
+    query_recorder.end,
     timer.end,
     tell_sentry,
 ]
@@ -6,10 +6,19 @@ the most important two. Participant, in particular, is at the center of
 everything on Gratipay.
 
 """
+import threading
+import time
+import uuid
+from collections import namedtuple
 from contextlib import contextmanager
 
-from postgres import Postgres
+from postgres import Postgres, make_Connection, url_to_dsn
+import psycopg2
 import psycopg2.extras
+from psycopg2 import OperationalError
+from psycopg2.errorcodes import LOCK_NOT_AVAILABLE
+
+from gratipay.utils.query_recorder import CURSOR_FACTORIES, RecordingNamedTupleCursor
 
 
 @contextmanager
@@ -17,28 +26,100 @@ def just_yield(obj):
     yield obj
 
 
+class StreamTimeout(Exception):
+    """A result set took too long to stream out.
+    """
+
+
 class GratipayDB(Postgres):
 
+    def __init__(self, url, *a, **kw):
+        max_streams = kw.pop('max_streams', 2)
+        self.stream_timeout = kw.pop('stream_timeout', 60)
+        kw.setdefault('cursor_factory', RecordingNamedTupleCursor)
+        super(GratipayDB, self).__init__(url, *a, **kw)
+        self.dsn = url_to_dsn(url) if url.startswith("postgres://") else url
+        self.stream_slots = threading.BoundedSemaphore(max_streams)
+        self.StreamConnection = make_Connection(self)
+
     def get_cursor(self, cursor=None, **kw):
         if cursor:
             if kw:
                 raise ValueError('cannot change options when reusing a cursor')
             return just_yield(cursor)
+        back_as = kw.get('back_as')
+        if back_as is not None and 'cursor_factory' not in kw:
+            # Use our own cursors, so that queries are recorded.
+            kw['cursor_factory'] = CURSOR_FACTORIES[back_as]
         return super(GratipayDB, self).get_cursor(**kw)
 
-    def self_check(self):
+    def iter_all(self, sql, parameters=None, back_as=None, itersize=1000):
+        """Like all, but yield rows as they're read from a server-side cursor.
+
+        Only itersize rows are held in memory at a time, so this is the way to
+        send out a big result set as it's read. The cursor is on a connection
+        of its own, outside the pool, which is kept until the generator is
+        exhausted or closed, so a slow reader doesn't tie up the pool.
+
+        At most max_streams of these connections are open at a time; beyond
+        that the rows are read all at once from the pool, as all does. A stream
+        that takes longer than stream_timeout seconds, in a query or in total,
+        is cut off with StreamTimeout.
+
+        """
+        if not self.stream_slots.acquire(False):
+            for row in self.all(sql, parameters, back_as=back_as):
+                yield row
+            return
+        try:
+            kw = {}
+            if back_as is not None:
+                kw['cursor_factory'] = CURSOR_FACTORIES[back_as]
+            connection = psycopg2.connect(self.dsn, connection_factory=self.StreamConnection)
+            try:
+                connection.cursor().execute( "SET statement_timeout = %s"
+                                           , (int(self.stream_timeout * 1000),)
+                                            )
+                cursor = connection.cursor('iter_all_' + uuid.uuid4().hex, **kw)
+                cursor.itersize = itersize
+                cursor.execute(sql, parameters)
+                deadline = time.time() + self.stream_timeout
+                for row in cursor:
+                    if time.time() > deadline:
+                        raise StreamTimeout()
+                    yield row
+            finally:
+                connection.close()
+        finally:
+            self.stream_slots.release()
+
+    def self_check(self, full=False):
         with self.get_cursor() as cursor:
-            check_db(cursor)
+            check_db(cursor, full)
 
 
-def check_db(cursor):
+def check_db(cursor, full=False):
     """Runs all available self checks on the given cursor.
+
+    Balances are checked incrementally, from the latest ledger checkpoint. Pass
+    full=True to check them against the ledgers from scratch instead, and to
+    rebuild the running totals. That also checks the projections against their
+    logs, which scans the whole history of each. The incremental check runs
+    every CHECK_DB_EVERY seconds, and the full one every FULL_CHECK_DB_EVERY.
+
     """
-    _check_balances(cursor)
-    _check_no_team_balances(cursor)
+    if full:
+        _reset_ledger_checkpoint(cursor)
+    checkpoint = get_ledger_checkpoint(cursor)
+    _check_balances(cursor, checkpoint)
+    _check_no_team_balances(cursor, checkpoint)
     _check_tips(cursor)
+    if full:
+        _check_projections(cursor)
     _check_orphans(cursor)
     _check_orphans_no_tips(cursor)
+    # Last, since it locks the ledgers until the end of the transaction.
+    _advance_ledger_checkpoint(cursor, checkpoint)
 
 
 def _check_tips(cursor):
@@ -61,93 +142,246 @@ def _check_tips(cursor):
     assert conflicting_tips == 0
 
 
-def _check_balances(cursor):
+# Ledger checkpoints
+# ==================
+#
+# Balances are checked against the ledgers (exchanges, transfers, and
+# payments). Summing the ledgers from the beginning of time gets slow, so we
+# keep running totals per participant and per team in ledger_*_totals, up to
+# the ids recorded in the latest row of ledger_checkpoints. The incremental
+# checks then only need to look at rows added since that checkpoint.
+
+LEDGER_CHECKPOINT_LOCK = 0x1ed6e2  # for pg_try_advisory_xact_lock
+
+NO_CHECKPOINT = dict(last_exchange_id=0, last_transfer_id=0, last_payment_id=0)
+
+PARTICIPANT_DELTAS = """
+    SELECT username, sum(a) AS delta
+      FROM (
+              SELECT participant AS username, amount AS a
+                FROM exchanges
+               WHERE id > %(last_exchange_id)s AND id <= %(until_exchange_id)s
+                 AND amount > 0
+                 AND (status is null or status = 'succeeded')
+
+               UNION ALL
+
+              SELECT participant AS username, amount-fee AS a
+                FROM exchanges
+               WHERE id > %(last_exchange_id)s AND id <= %(until_exchange_id)s
+                 AND amount < 0
+                 AND (status is null or status <> 'failed')
+
+               UNION ALL
+
+              SELECT tipper AS username, -amount AS a
+                FROM transfers
+               WHERE id > %(last_transfer_id)s AND id <= %(until_transfer_id)s
+
+               UNION ALL
+
+              SELECT tippee AS username, amount AS a
+                FROM transfers
+               WHERE id > %(last_transfer_id)s AND id <= %(until_transfer_id)s
+
+               UNION ALL
+
+              SELECT participant AS username
+                   , CASE WHEN direction='to-participant' THEN amount ELSE -amount END AS a
+                FROM payments
+               WHERE id > %(last_payment_id)s AND id <= %(until_payment_id)s
+           ) AS foo
+  GROUP BY username
+"""
+
+TEAM_DELTAS = """
+    SELECT team, sum(CASE WHEN direction='to-team' THEN amount ELSE -amount END) AS delta
+      FROM payments
+     WHERE id > %(last_payment_id)s AND id <= %(until_payment_id)s
+  GROUP BY team
+"""
+
+UNBOUNDED = dict( until_exchange_id=2**31-1
+                , until_transfer_id=2**31-1
+                , until_payment_id=2**63-1
+                 )
+
+
+def get_ledger_checkpoint(cursor):
+    """Return a dict of the last ledger ids covered by the running totals.
+    """
+    checkpoint = cursor.one("""
+        SELECT last_exchange_id, last_transfer_id, last_payment_id
+          FROM ledger_checkpoints
+      ORDER BY id DESC
+         LIMIT 1
+    """)
+    return checkpoint._asdict() if checkpoint else NO_CHECKPOINT
+
+
+def _check_balances(cursor, checkpoint=NO_CHECKPOINT):
     """
-    Recalculates balances for all participants from transfers and exchanges.
+    Recalculates balances from transfers and exchanges, for all participants
+    that show up in the ledgers after the given checkpoint. The running totals
+    stand in for the rows before it, so with NO_CHECKPOINT this is a full scan.
 
     https://github.com/gratipay/gratipay.com/issues/1118
     """
+    params = dict(checkpoint, **UNBOUNDED)
     b = cursor.all("""
-        select p.username, expected, balance as actual
-          from (
-            select username, sum(a) as expected
-              from (
-                      select participant as username, sum(amount) as a
-                        from exchanges
-                       where amount > 0
-                         and (status is null or status = 'succeeded')
-                    group by participant
-
-                       union all
-
-                      select participant as username, sum(amount-fee) as a
-                        from exchanges
-                       where amount < 0
-                         and (status is null or status <> 'failed')
-                    group by participant
-
-                       union all
-
-                      select tipper as username, sum(-amount) as a
-                        from transfers
-                    group by tipper
-
-                       union all
-
-                      select participant as username, sum(amount) as a
-                        from payments
-                       where direction='to-participant'
-                    group by participant
-
-                       union all
-
-                      select participant as username, sum(-amount) as a
-                        from payments
-                       where direction='to-team'
-                    group by participant
-
-                       union all
-
-                      select tippee as username, sum(amount) as a
-                        from transfers
-                    group by tippee
-                    ) as foo
-            group by username
-          ) as foo2
-        join participants p on p.username = foo2.username
-        where expected <> p.balance
-    """)
+        WITH deltas AS ({})
+        SELECT p.username, coalesce(t.total, 0) + d.delta AS expected, p.balance AS actual
+          FROM deltas d
+          JOIN participants p ON p.username = d.username
+     LEFT JOIN ledger_participant_totals t ON t.participant = d.username
+         WHERE coalesce(t.total, 0) + d.delta <> p.balance
+    """.format(PARTICIPANT_DELTAS), params)
     assert len(b) == 0, "conflicting balances: {}".format(b)
 
-def _check_no_team_balances(cursor):
+def _check_no_team_balances(cursor, checkpoint=NO_CHECKPOINT):
     if cursor.one("select exists (select * from paydays where ts_end < ts_start) as running"):
         # payday is running
         return
+    params = dict(checkpoint, **UNBOUNDED)
     teams = cursor.all("""
-        SELECT t.slug, balance
-          FROM (
-                SELECT team, sum(delta) as balance
-                  FROM (
-                        SELECT team, sum(-amount) AS delta
-                          FROM payments
-                         WHERE direction='to-participant'
-                      GROUP BY team
-
-                         UNION ALL
-
-                        SELECT team, sum(amount) AS delta
-                          FROM payments
-                         WHERE direction='to-team'
-                      GROUP BY team
-                       ) AS foo
-              GROUP BY team
-               ) AS foo2
-          JOIN teams t ON t.slug = foo2.team
-         WHERE balance <> 0
-    """)
+        WITH deltas AS ({})
+        SELECT t.slug, coalesce(l.total, 0) + d.delta AS balance
+          FROM deltas d
+          JOIN teams t ON t.slug = d.team
+     LEFT JOIN ledger_team_totals l ON l.team = d.team
+         WHERE coalesce(l.total, 0) + d.delta <> 0
+    """.format(TEAM_DELTAS), params)
     assert len(teams) == 0, "teams with non-zero balance: {}".format(teams)
 
 
+def _advance_ledger_checkpoint(cursor, checkpoint):
+    """Fold ledger rows after the given checkpoint into the running totals.
+
+    We only move up to rows that can't change under us anymore: if another
+    transaction is writing to the ledgers then it may yet commit rows with
+    lower ids than ones we can see, so we lock the ledgers against writes
+    before looking, and leave the checkpoint where it is if that would have
+    to wait; and pending exchanges can still succeed or fail, so we stop short
+    of the first one of those.
+
+    This must run in a transaction, which holds the lock until it ends.
+
+    """
+    if not cursor.one("SELECT pg_try_advisory_xact_lock(%s)", (LEDGER_CHECKPOINT_LOCK,)):
+        return  # someone else is on it
+    cursor.run("SAVEPOINT advance_ledger_checkpoint")
+    try:
+        cursor.run("LOCK TABLE exchanges, transfers, payments IN SHARE MODE NOWAIT")
+    except OperationalError as e:
+        if e.pgcode != LOCK_NOT_AVAILABLE:
+            raise
+        cursor.run("ROLLBACK TO SAVEPOINT advance_ledger_checkpoint")
+        return  # ledgers are being written to
+    until = cursor.one("""
+        SELECT least( (SELECT coalesce(max(id), 0) FROM exchanges)
+                    , (SELECT min(id) - 1 FROM exchanges WHERE status IN ('pre', 'pending'))
+                     ) AS until_exchange_id
+             , (SELECT coalesce(max(id), 0) FROM transfers) AS until_transfer_id
+             , (SELECT coalesce(max(id), 0) FROM payments) AS until_payment_id
+    """)
+    params = dict(checkpoint, **until._asdict())
+    if all(params['until_%s_id' % t] <= params['last_%s_id' % t]
+           for t in ('exchange', 'transfer', 'payment')):
+        return  # nothing new since the checkpoint
+    cursor.run("""
+        CREATE TEMP TABLE ledger_participant_deltas AS ({0});
+        CREATE TEMP TABLE ledger_team_deltas AS ({1});
+
+        UPDATE ledger_participant_totals t
+           SET total = t.total + d.delta
+          FROM ledger_participant_deltas d
+         WHERE t.participant = d.username;
+
+        INSERT INTO ledger_participant_totals (participant, total)
+             SELECT username, delta
+               FROM ledger_participant_deltas d
+              WHERE NOT EXISTS (SELECT 1 FROM ledger_participant_totals t
+                                 WHERE t.participant = d.username);
+
+        UPDATE ledger_team_totals t
+           SET total = t.total + d.delta
+          FROM ledger_team_deltas d
+         WHERE t.team = d.team;
+
+        INSERT INTO ledger_team_totals (team, total)
+             SELECT team, delta
+               FROM ledger_team_deltas d
+              WHERE NOT EXISTS (SELECT 1 FROM ledger_team_totals t WHERE t.team = d.team);
+
+        DROP TABLE ledger_participant_deltas;
+        DROP TABLE ledger_team_deltas;
+
+        INSERT INTO ledger_checkpoints (last_exchange_id, last_transfer_id, last_payment_id)
+             VALUES ( greatest(%(last_exchange_id)s, %(until_exchange_id)s)
+                    , greatest(%(last_transfer_id)s, %(until_transfer_id)s)
+                    , greatest(%(last_payment_id)s, %(until_payment_id)s)
+                     );
+    """.format(PARTICIPANT_DELTAS, TEAM_DELTAS), params)
+
+
+def _reset_ledger_checkpoint(cursor):
+    cursor.run("""
+        DELETE FROM ledger_checkpoints;
+        DELETE FROM ledger_participant_totals;
+        DELETE FROM ledger_team_totals;
+    """)
+
+
+# Projections
+# ===========
+#
+# Tables that triggers keep up to date with the latest row of an append-only
+# log for each key, so that looking up the current state is an index probe
+# instead of a sort over the whole history. They're made by create_projection
+# (see sql/create_projection.sql), with the same definitions as listed here.
+
+Projection = namedtuple('Projection', 'log projection key order_by')
+
+PROJECTIONS = [ Projection( 'payment_instructions', 'current_payment_instructions'
+                          , ('participant', 'team'), ('mtime', 'id')
+                           )
+              , Projection('tips', 'current_tips', ('tipper', 'tippee'), ('mtime', 'id'))
+              , Projection('takes', 'latest_takes', ('member', 'team'), ('mtime', 'id'))
+              , Projection( 'exchange_routes', 'current_exchange_routes'
+                          , ('participant', 'network'), ('id',)
+                           )
+              , Projection( 'community_members', 'current_community_members'
+                          , ('participant', 'slug'), ('mtime', 'id')
+                           )
+               ]
+
+
+def _check_projections(cursor):
+    """
+    Checks that each projection has exactly the latest row of its log for each
+    key.
+    """
+    for p in PROJECTIONS:
+        key = ', '.join(p.key)
+        out_of_sync = cursor.all("""
+            WITH latest AS (
+                     SELECT DISTINCT ON ({key}) *
+                       FROM {log}
+                   ORDER BY {key}, {latest_first}
+                 )
+            SELECT {key}
+              FROM ( (SELECT * FROM latest EXCEPT SELECT * FROM {projection})
+                     UNION ALL
+                     (SELECT * FROM {projection} EXCEPT SELECT * FROM latest)
+                   ) AS foo
+        """.format( key=key
+                  , log=p.log
+                  , projection=p.projection
+                  , latest_first=', '.join(c + ' DESC' for c in p.order_by)
+                   ))
+        assert len(out_of_sync) == 0, "{} out of sync: {}".format(p.projection, out_of_sync)
+
+
 def _check_orphans(cursor):
     """
     Finds participants that
@@ -6,6 +6,9 @@ from decimal import Decimal
 from aspen.utils import typecheck
 
 
+TAKES_LOCK = 0x7a4e5  # for pg_advisory_xact_lock, with the team's id
+
+
 class MemberLimitReached(Exception): pass
 
 class StubParticipantAdded(Exception): pass
@@ -132,12 +135,14 @@ class MixinTeam(object):
         assert self.IS_PLURAL
         # XXX Factored out for testing purposes only! :O Use .set_take_for.
         with self.db.get_cursor(cursor) as cursor:
-            # Lock to avoid race conditions
-            cursor.run("LOCK TABLE takes IN EXCLUSIVE MODE")
+            # Lock this team's takes to avoid race conditions, without holding
+            # up changes to other teams
+            cursor.run("SELECT pg_advisory_xact_lock(%s, %s)", (TAKES_LOCK, self.id))
             # Compute the current takes
-            old_takes = self.compute_actual_takes(cursor)
+            nominal_takes = self.get_current_takes(cursor)
+            old_takes = self.compute_actual_takes(cursor, nominal_takes)
             # Insert the new take
-            cursor.run("""
+            take = cursor.one("""
 
                 INSERT INTO takes (ctime, member, team, amount, recorder)
                  VALUES ( COALESCE (( SELECT ctime
@@ -151,11 +156,19 @@ class MixinTeam(object):
                         , %(amount)s
                         , %(recorder)s
                          )
+              RETURNING member, amount, ctime, mtime
 
             """, dict(member=member.username, team=self.username, amount=amount,
                       recorder=recorder.username))
-            # Compute the new takes
-            new_takes = self.compute_actual_takes(cursor)
+            # Compute the new takes from the old ones, rather than querying
+            # them again. Like current_takes, leave out zeros and suspicious
+            # accounts.
+            nominal_takes = [t for t in nominal_takes if t['member'] != member.username]
+            if amount > 0 and member.is_suspicious is not True \
+                          and self.is_suspicious is not True:
+                nominal_takes.append(take._asdict())
+                nominal_takes.sort(key=lambda t: t['ctime'], reverse=True)
+            new_takes = self.compute_actual_takes(cursor, nominal_takes)
             # Update receiving amounts in the participants table
             self.update_taking(old_takes, new_takes, cursor, member)
             # Update is_funded on member's tips
@@ -165,22 +178,30 @@ class MixinTeam(object):
         """Update `taking` amounts based on the difference between `old_takes`
         and `new_takes`.
         """
+        diffs = {}
         for username in set(old_takes.keys()).union(new_takes.keys()):
             if username == self.username:
                 continue
             old = old_takes.get(username, {}).get('actual_amount', Decimal(0))
             new = new_takes.get(username, {}).get('actual_amount', Decimal(0))
-            diff = new - old
-            if diff != 0:
-                r = (cursor or self.db).one("""
-                    UPDATE participants
-                       SET taking = (taking + %(diff)s)
-                         , receiving = (receiving + %(diff)s)
-                     WHERE username=%(username)s
-                 RETURNING taking, receiving
-                """, dict(username=username, diff=diff))
-                if member and username == member.username:
-                    member.set_attributes(**r._asdict())
+            if new != old:
+                diffs[username] = new - old
+        if not diffs:
+            return
+        usernames, amounts = zip(*diffs.items())
+        updated = (cursor or self.db).all("""
+            UPDATE participants p
+               SET taking = (p.taking + d.diff)
+                 , receiving = (p.receiving + d.diff)
+              FROM ( SELECT unnest(%(usernames)s::text[]) AS username
+                          , unnest(%(diffs)s::numeric[]) AS diff
+                   ) d
+             WHERE p.username = d.username
+         RETURNING p.username, p.taking, p.receiving
+        """, dict(usernames=list(usernames), diffs=list(amounts)))
+        for r in updated:
+            if member and r.username == member.username:
+                member.set_attributes(taking=r.taking, receiving=r.receiving)
 
     def get_current_takes(self, cursor=None):
         """Return a list of member takes for a team.
@@ -195,12 +216,19 @@ class MixinTeam(object):
         records = (cursor or self.db).all(TAKES, dict(team=self.username))
         return [r._asdict() for r in records]
 
-    def get_team_take(self, cursor=None):
+    def get_team_take(self, cursor=None, nominal_takes=None):
         """Return a single take for a team, the team itself's take.
+
+        Pass the list from get_current_takes as nominal_takes to add it up
+        instead of querying it again.
+
         """
         assert self.IS_PLURAL
-        TAKE = "SELECT sum(amount) FROM current_takes WHERE team=%s"
-        total_take = (cursor or self.db).one(TAKE, (self.username,), default=0)
+        if nominal_takes is None:
+            TAKE = "SELECT sum(amount) FROM current_takes WHERE team=%s"
+            total_take = (cursor or self.db).one(TAKE, (self.username,), default=0)
+        else:
+            total_take = sum(take['amount'] for take in nominal_takes)
         team_take = max(self.receiving - total_take, 0)
         membership = { "ctime": None
                      , "mtime": None
@@ -209,12 +237,19 @@ class MixinTeam(object):
                       }
         return membership
 
-    def compute_actual_takes(self, cursor=None):
+    def compute_actual_takes(self, cursor=None, nominal_takes=None):
         """Get the takes, compute the actual amounts, and return an OrderedDict.
+
+        Pass a list like the one from get_current_takes as nominal_takes to
+        compute from it instead of querying the takes. It isn't modified.
+
         """
         actual_takes = OrderedDict()
-        nominal_takes = self.get_current_takes(cursor=cursor)
-        nominal_takes.append(self.get_team_take(cursor=cursor))
+        if nominal_takes is None:
+            nominal_takes = self.get_current_takes(cursor=cursor)
+        else:
+            nominal_takes = [dict(take) for take in nominal_takes]
+        nominal_takes.append(self.get_team_take(cursor=cursor, nominal_takes=nominal_takes))
         budget = balance = self.balance + self.receiving - self.giving
         for take in nominal_takes:
             nominal_amount = take['nominal_amount'] = take.pop('amount')
@@ -0,0 +1,300 @@
+"""Participants and teams carry denormalized counters of their payments:
+
+    participants.giving, participants.ngiving_to
+    participants.taking, participants.ntaking_from
+    teams.receiving, teams.nreceiving_from, teams.distributing, teams.ndistributing_to
+
+The functions here recompute them from current_payment_instructions for a list
+of participants or teams in one statement, however long the list is. Pass None
+instead of a list to recompute them for everyone; then only the rows that were
+wrong are written. Each function returns a row for every participant or team it
+updated, with the old and new values.
+
+Re-summing a team's receiving is O(supporters), so when a single participant's
+payment instructions change we apply the difference instead: note their
+contributions with get_contributions before the change, and pass them to
+apply_receiving_deltas after it. recompute_counters runs periodically to fix
+any drift.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from aspen import log_dammit
+
+
+GIVING = """
+
+    WITH expected AS (
+             SELECT p.username
+                  , COALESCE(sum(pi.amount), 0) AS giving
+                  , count(pi.amount) AS ngiving_to
+               FROM participants p
+          LEFT JOIN ( SELECT cpi.participant, cpi.amount
+                        FROM current_payment_instructions cpi
+                        JOIN teams t ON t.slug = cpi.team
+                       WHERE cpi.amount > 0
+                         AND cpi.is_funded
+                         AND t.is_approved
+                    ) pi ON pi.participant = p.username
+              WHERE (%(usernames)s::text[] IS NULL OR p.username = ANY(%(usernames)s))
+           GROUP BY p.username
+         )
+       , updated AS (
+             UPDATE participants p
+                SET giving = e.giving
+                  , ngiving_to = e.ngiving_to
+               FROM expected e
+              WHERE p.username = e.username
+                AND ( %(usernames)s::text[] IS NOT NULL OR
+                      (p.giving, p.ngiving_to) IS DISTINCT FROM (e.giving, e.ngiving_to)
+                     )
+          RETURNING p.username, p.giving, p.ngiving_to
+         )
+    SELECT u.username
+         , p.giving AS old_giving
+         , p.ngiving_to AS old_ngiving_to
+         , u.giving
+         , u.ngiving_to
+      FROM updated u
+      JOIN participants p ON p.username = u.username
+  ORDER BY u.username
+
+"""
+
+
+RECEIVING = """
+
+    WITH expected AS (
+             SELECT t.slug
+                  , COALESCE(sum(pi.amount), 0) AS receiving
+                  , count(pi.amount) AS nreceiving_from
+               FROM teams t
+          LEFT JOIN ( SELECT cpi.team, cpi.amount
+                        FROM current_payment_instructions cpi
+                        JOIN participants p ON p.username = cpi.participant
+                       WHERE p.is_suspicious IS NOT true
+                         AND cpi.amount > 0
+                         AND cpi.is_funded
+                    ) pi ON pi.team = t.slug
+              WHERE (%(slugs)s::text[] IS NULL OR t.slug = ANY(%(slugs)s))
+           GROUP BY t.slug
+         )
+       , updated AS (
+             -- This is easy for now since we don't have payroll.
+             UPDATE teams t
+                SET receiving = e.receiving
+                  , nreceiving_from = e.nreceiving_from
+                  , distributing = e.receiving
+                  , ndistributing_to = 1
+               FROM expected e
+              WHERE t.slug = e.slug
+                AND ( %(slugs)s::text[] IS NOT NULL OR
+                      (t.receiving, t.nreceiving_from, t.distributing)
+                      IS DISTINCT FROM (e.receiving, e.nreceiving_from, e.receiving)
+                     )
+          RETURNING t.slug, t.owner, t.receiving, t.nreceiving_from
+                  , t.distributing, t.ndistributing_to
+         )
+    SELECT u.slug
+         , u.owner
+         , t.receiving AS old_receiving
+         , t.nreceiving_from AS old_nreceiving_from
+         , u.receiving
+         , u.nreceiving_from
+         , u.distributing
+         , u.ndistributing_to
+      FROM updated u
+      JOIN teams t ON t.slug = u.slug
+  ORDER BY u.slug
+
+"""
+
+
+TAKING = """
+
+    WITH expected AS (
+             SELECT p.username
+                  , COALESCE(sum(t.receiving), 0) AS taking
+                  , count(t.slug) AS ntaking_from
+               FROM participants p
+          LEFT JOIN teams t ON t.owner = p.username
+              WHERE (%(usernames)s::text[] IS NULL OR p.username = ANY(%(usernames)s))
+           GROUP BY p.username
+         )
+       , updated AS (
+             UPDATE participants p
+                SET taking = e.taking
+                  , ntaking_from = e.ntaking_from
+               FROM expected e
+              WHERE p.username = e.username
+                AND ( %(usernames)s::text[] IS NOT NULL OR
+                      (p.taking, p.ntaking_from) IS DISTINCT FROM (e.taking, e.ntaking_from)
+                     )
+          RETURNING p.username, p.taking, p.ntaking_from
+         )
+    SELECT u.username
+         , p.taking AS old_taking
+         , p.ntaking_from AS old_ntaking_from
+         , u.taking
+         , u.ntaking_from
+      FROM updated u
+      JOIN participants p ON p.username = u.username
+  ORDER BY u.username
+
+"""
+
+
+# A payment instruction counts towards its team's receiving if it's funded,
+# nonzero, and not from a suspicious participant, as in RECEIVING above. There's
+# at most one current instruction per participant and team, so a participant's
+# contribution to a team is either its amount or nothing (NULL).
+
+CONTRIBUTIONS = """
+
+    SELECT cpi.team
+         , CASE WHEN p.is_suspicious IS NOT true AND cpi.amount > 0 AND cpi.is_funded
+                THEN cpi.amount
+            END AS amount
+      FROM current_payment_instructions cpi
+      JOIN participants p ON p.username = cpi.participant
+     WHERE cpi.participant = %(username)s
+       AND cpi.team = ANY(%(slugs)s)
+       FOR UPDATE OF cpi
+
+"""
+
+
+RECEIVING_DELTAS = """
+
+    WITH old AS (
+             SELECT unnest(%(slugs)s::text[]) AS team
+                  , unnest(%(amounts)s::numeric[]) AS amount
+         )
+       , new AS (
+             SELECT cpi.team, cpi.amount
+               FROM current_payment_instructions cpi
+               JOIN participants p ON p.username = cpi.participant
+              WHERE cpi.participant = %(username)s
+                AND cpi.team = ANY(%(slugs)s)
+                AND p.is_suspicious IS NOT true
+                AND cpi.amount > 0
+                AND cpi.is_funded
+         )
+       , deltas AS (
+             SELECT old.team
+                  , COALESCE(new.amount, 0) - COALESCE(old.amount, 0) AS amount
+                  , (new.amount IS NOT NULL)::int - (old.amount IS NOT NULL)::int AS n
+               FROM old
+          LEFT JOIN new ON new.team = old.team
+         )
+       , updated AS (
+             UPDATE teams t
+                SET receiving = t.receiving + d.amount
+                  , nreceiving_from = t.nreceiving_from + d.n
+                  , distributing = t.receiving + d.amount
+                  , ndistributing_to = 1
+               FROM deltas d
+              WHERE t.slug = d.team
+          RETURNING t.slug, t.owner, d.amount AS delta
+                  , t.receiving, t.nreceiving_from, t.distributing, t.ndistributing_to
+         )
+       , owners AS (
+             UPDATE participants p
+                SET taking = p.taking + o.delta
+               FROM ( SELECT owner, sum(delta) AS delta
+                        FROM updated
+                    GROUP BY owner
+                    ) o
+              WHERE p.username = o.owner
+         )
+    SELECT slug, receiving, nreceiving_from, distributing, ndistributing_to
+      FROM updated
+  ORDER BY slug
+
+"""
+
+
+def _listify(keys):
+    return None if keys is None else list(keys)
+
+
+def update_giving(cursor, usernames=None):
+    """Recompute giving and ngiving_to for the given participants.
+    """
+    return cursor.all(GIVING, dict(usernames=_listify(usernames)))
+
+
+def update_receiving(cursor, slugs=None):
+    """Recompute receiving, nreceiving_from, distributing, and ndistributing_to
+    for the given teams.
+
+    Their owners' taking depends on these, so follow this with update_taking
+    for the owners, which are in the rows returned.
+
+    """
+    return cursor.all(RECEIVING, dict(slugs=_listify(slugs)))
+
+
+def update_taking(cursor, usernames=None):
+    """Recompute taking and ntaking_from for the given participants.
+    """
+    return cursor.all(TAKING, dict(usernames=_listify(usernames)))
+
+
+def get_contributions(cursor, username, slugs):
+    """Return a dict of what the participant contributes to each of the given
+    teams' receiving, with None for nothing.
+
+    This locks the participant's current payment instructions to the teams,
+    so call it in the same transaction as the change and the
+    apply_receiving_deltas that follows.
+
+    """
+    contributions = dict.fromkeys(slugs)
+    rows = cursor.all(CONTRIBUTIONS, dict(username=username, slugs=list(contributions)))
+    contributions.update(rows)
+    return contributions
+
+
+def apply_receiving_deltas(cursor, username, old):
+    """Update the receiving of the teams in old, and their owners' taking, by
+    the change in the participant's contributions since old was taken.
+
+    Use get_contributions for old, or a dict of slugs to None if the
+    participant's instructions to them didn't count before. Returns the new
+    counters of the teams.
+
+    """
+    slugs, amounts = zip(*old.items()) if old else ((), ())
+    return cursor.all(RECEIVING_DELTAS, dict( username=username
+                                            , slugs=list(slugs)
+                                            , amounts=list(amounts)
+                                             ))
+
+
+def recompute_counters(db):
+    """Recompute the counters of every participant and team, and log the ones
+    that had drifted from the payment instructions.
+
+    This runs as a periodic job. It returns a list of (table, key, column,
+    old value, new value) tuples, one for each counter that was fixed.
+
+    """
+    drift = []
+    with db.get_cursor() as cursor:
+        for row in update_giving(cursor):
+            drift.extend(_diff('participants', row.username, row, 'giving', 'ngiving_to'))
+        for row in update_receiving(cursor):
+            drift.extend(_diff('teams', row.slug, row, 'receiving', 'nreceiving_from'))
+        for row in update_taking(cursor):
+            drift.extend(_diff('participants', row.username, row, 'taking', 'ntaking_from'))
+    for table, key, column, old, new in drift:
+        log_dammit("Counter drift: {}.{} for {} was {}, is {}.".format(table, column, key, old, new))
+    return drift
+
+
+def _diff(table, key, row, *columns):
+    for column in columns:
+        old, new = getattr(row, 'old_' + column), getattr(row, column)
+        if old != new:
+            yield table, key, column, old, new
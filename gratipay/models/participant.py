@@ -4,8 +4,7 @@ from __future__ import print_function, unicode_literals
 
 from datetime import timedelta
 from decimal import Decimal
-import pickle
-from time import sleep
+from multiprocessing.pool import ThreadPool
 from urllib import quote
 import uuid
 
@@ -13,9 +12,8 @@ from aspen.utils import utcnow
 import balanced
 import braintree
 from dependency_injection import resolve_dependencies
-from markupsafe import escape as htmlescape
 from postgres.orm import Model
-from psycopg2 import IntegrityError
+from psycopg2 import Binary, IntegrityError
 
 import gratipay
 from gratipay import NotSane
@@ -35,6 +33,12 @@ from gratipay.exceptions import (
 
 from gratipay.models import add_event
 from gratipay.models.account_elsewhere import AccountElsewhere
+from gratipay.models.counters import (
+    apply_receiving_deltas,
+    get_contributions,
+    update_giving,
+    update_taking,
+)
 from gratipay.models.exchange_route import ExchangeRoute
 from gratipay.models.team import Team
 from gratipay.security.crypto import constant_time_compare
@@ -50,6 +54,28 @@ ASCII_ALLOWED_IN_USERNAME = set("0123456789"
 
 EMAIL_HASH_TIMEOUT = timedelta(hours=24)
 
+DEQUEUE_BATCH_SIZE = 200
+DEQUEUE_THREADS = 8
+EMAIL_CLAIM_SECONDS = 600
+
+# Postgres 9.3 doesn't have SKIP LOCKED, so we mark the messages we take with
+# how long we have them for. Another worker that blocks on one of them sees the
+# mark once we commit, and passes it by.
+CLAIM_EMAILS = """
+
+    UPDATE email_queue
+       SET claimed_until = now() + %(lease)s * interval '1 second'
+     WHERE id IN ( SELECT id
+                     FROM email_queue
+                    WHERE claimed_until IS NULL OR claimed_until < now()
+                 ORDER BY id
+                    LIMIT %(n)s
+                      FOR UPDATE
+                  )
+ RETURNING id, participant, spt_name, context, context_version
+
+"""
+
 USERNAME_MAX_SIZE = 32
 
 class Participant(Model):
@@ -523,6 +549,16 @@ class Participant(Model):
                   (self.username, address))
 
     def send_email(self, spt_name, **context):
+        message = self.render_email(spt_name, **context)
+        if message is None:
+            return 0 # Not Sent
+        self._mailer.messages.send(message=message)
+        return 1 # Sent
+
+    def render_email(self, spt_name, **context):
+        """Return the message to send to Mandrill, or None if we have no email
+        address to send it to.
+        """
         context['participant'] = self
         context['username'] = self.username
         context['button_style'] = (
@@ -533,55 +569,74 @@ class Participant(Model):
         context.setdefault('include_unsubscribe', True)
         email = context.setdefault('email', self.email_address)
         if not email:
-            return 0 # Not Sent
-        langs = i18n.parse_accept_lang(self.email_lang or 'en')
-        locale = i18n.match_lang(langs)
-        i18n.add_helpers_to_context(self._tell_sentry, context, locale)
-        context['escape'] = lambda s: s
-        context_html = dict(context)
-        i18n.add_helpers_to_context(self._tell_sentry, context_html, locale)
-        context_html['escape'] = htmlescape
+            return None
+        locale = i18n.match_accept_lang(self.email_lang or 'en')
         spt = self._emails[spt_name]
-        base_spt = self._emails['base']
-        def render(t, context):
-            b = base_spt[t].render(context).strip()
-            return b.replace('$body', spt[t].render(context).strip())
+        render = lambda key: spt[key].render(context, locale, self._tell_sentry)
         message = {}
         message['from_email'] = 'support@gratipay.com'
         message['from_name'] = 'Gratipay Support'
         message['to'] = [{'email': email, 'name': self.username}]
-        message['subject'] = spt['subject'].render(context)
-        message['html'] = render('text/html', context_html)
-        message['text'] = render('text/plain', context)
-
-        self._mailer.messages.send(message=message)
-        return 1 # Sent
+        message['subject'] = render('subject')
+        message['html'] = render('text/html').strip()
+        message['text'] = render('text/plain').strip()
+        return message
 
     def queue_email(self, spt_name, **context):
-        self.db.run("""
+        self.queue_emails([(self.id, spt_name, context)])
+
+    @classmethod
+    def queue_emails(cls, messages, cursor=None):
+        """Queue (participant id, spt_name, context) messages in one statement.
+        """
+        ids, spt_names, contexts = zip(*messages) or ((), (), ())
+        contexts = [Binary(emails.encode_context(c)) for c in contexts]
+        (cursor or cls.db).run("""
             INSERT INTO email_queue
-                        (participant, spt_name, context)
-                 VALUES (%s, %s, %s)
-        """, (self.id, spt_name, pickle.dumps(context)))
+                        (participant, spt_name, context, context_version)
+                 SELECT unnest(%s::bigint[]), unnest(%s::text[]), unnest(%s::bytea[]), %s
+        """, (list(ids), list(spt_names), contexts, emails.CONTEXT_VERSION))
 
     @classmethod
-    def dequeue_emails(cls):
-        fetch_messages = lambda: cls.db.all("""
-            SELECT *
-              FROM email_queue
-          ORDER BY id ASC
-             LIMIT 60
-        """)
-        while True:
-            messages = fetch_messages()
-            if not messages:
-                break
-            for msg in messages:
-                p = cls.from_id(msg.participant)
-                r = p.send_email(msg.spt_name, **pickle.loads(msg.context))
-                cls.db.run("DELETE FROM email_queue WHERE id = %s", (msg.id,))
-                if r == 1:
-                    sleep(1)
+    def dequeue_emails(cls, batch_size=DEQUEUE_BATCH_SIZE, nthreads=DEQUEUE_THREADS):
+        """Send the queued emails.
+
+        We claim the queue a batch at a time, render and send the batch from a
+        pool of threads, at no more than the rate set by EMAILS_PER_MINUTE, and
+        delete the messages that went out. A message that fails is reported
+        to Sentry, and is retried once our claim on it runs out.
+
+        """
+        pool = ThreadPool(nthreads)
+        try:
+            while True:
+                messages = cls.db.all(CLAIM_EMAILS, dict(n=batch_size, lease=EMAIL_CLAIM_SECONDS))
+                if not messages:
+                    break
+                participants = {p.id: p for p in cls.db.all("""
+                    SELECT p.*::participants FROM participants p WHERE id = ANY(%s)
+                """, ([msg.participant for msg in messages],))}
+                jobs = [(participants[msg.participant], msg) for msg in sorted(messages)]
+                sent = pool.imap_unordered(cls._send_queued_email, jobs)
+                sent = [id for id in sent if id is not None]
+                cls.db.run("DELETE FROM email_queue WHERE id = ANY(%s)", (sent,))
+        finally:
+            pool.close()
+            pool.join()
+
+    @classmethod
+    def _send_queued_email(cls, job):
+        participant, msg = job
+        try:
+            context = emails.decode_context(msg.context_version, msg.context)
+            message = participant.render_email(msg.spt_name, **context)
+            if message is not None:
+                cls._email_rate_limiter.wait()
+                cls._mailer.messages.send(message=message)
+        except Exception as e:
+            cls._tell_sentry(e, {})
+            return None
+        return msg.id
 
     def set_email_lang(self, accept_lang):
         if not accept_lang:
@@ -853,20 +908,36 @@ class Participant(Model):
 
         """
         args = dict(participant=self.username, team=team.slug, amount=amount)
-        t = (cursor or self.db).one(NEW_PAYMENT_INSTRUCTION, args)
-        t_dict = t._asdict()
-
-        if update_self:
-            # Update giving amount of participant
-            self.update_giving(cursor)
-            # Carry over any existing due
-            self.update_due(t_dict['team'], t_dict['id'], cursor)
-        if update_team:
-            # Update receiving amount of team
-            team.update_receiving(cursor)
-        if team.slug == 'Gratipay':
-            # Update whether the participant is using Gratipay for free
-            self.update_is_free_rider(None if amount == 0 else False, cursor)
+        with self.db.get_cursor(cursor) as cursor:
+            if update_team:
+                # Note what we gave the team before, to update its receiving by
+                # the difference rather than re-summing all its supporters
+                contributions = get_contributions(cursor, self.username, [team.slug])
+
+            t = cursor.one(NEW_PAYMENT_INSTRUCTION, args)
+            t_dict = t._asdict()
+
+            if update_self:
+                # Update giving amount of participant
+                funded = self.update_giving(cursor)
+                # Carry over any existing due
+                self.update_due(t_dict['team'], t_dict['id'], cursor)
+            if update_team:
+                # Update receiving amount of the team, and of any other team
+                # whose instructions from us just became funded
+                if update_self:
+                    for payment_instruction in funded:
+                        contributions.setdefault(payment_instruction.team, None)
+                for r in apply_receiving_deltas(cursor, self.username, contributions):
+                    if r.slug == team.slug:
+                        team.set_attributes( receiving=r.receiving
+                                           , nreceiving_from=r.nreceiving_from
+                                           , distributing=r.distributing
+                                           , ndistributing_to=r.ndistributing_to
+                                            )
+            if team.slug == 'Gratipay':
+                # Update whether the participant is using Gratipay for free
+                self.update_is_free_rider(None if amount == 0 else False, cursor)
 
         return t._asdict()
 
@@ -969,8 +1040,8 @@ class Participant(Model):
     def update_giving_and_teams(self):
         with self.db.get_cursor() as cursor:
             updated_giving = self.update_giving(cursor)
-            for payment_instruction in updated_giving:
-                Team.from_slug(payment_instruction.team).update_receiving(cursor)
+            # The newly funded instructions didn't count towards receiving before
+            apply_receiving_deltas(cursor, self.username, {pi.team: None for pi in updated_giving})
 
 
     def update_giving(self, cursor=None):
@@ -985,22 +1056,7 @@ class Participant(Model):
              RETURNING *
             """, (self.username,))
 
-        r = (cursor or self.db).one("""
-        WITH pi AS (
-            SELECT amount
-              FROM current_payment_instructions cpi
-              JOIN teams t ON t.slug = cpi.team
-             WHERE participant = %(username)s
-               AND amount > 0
-               AND is_funded
-               AND t.is_approved
-        )
-            UPDATE participants p
-               SET giving = COALESCE((SELECT sum(amount) FROM pi), 0)
-                 , ngiving_to = COALESCE((SELECT count(amount) FROM pi), 0)
-             WHERE p.username=%(username)s
-         RETURNING giving, ngiving_to
-        """, dict(username=self.username))
+        r, = update_giving(cursor or self.db, [self.username])
         self.set_attributes(giving=r.giving, ngiving_to=r.ngiving_to)
 
         return updated
@@ -1032,14 +1088,8 @@ class Participant(Model):
         """, dict(username=self.username,team=team,id=id))
 
     def update_taking(self, cursor=None):
-        (cursor or self.db).run("""
-
-            UPDATE participants
-               SET taking=COALESCE((SELECT sum(receiving) FROM teams WHERE owner=%(username)s), 0)
-                 , ntaking_from=COALESCE((SELECT count(*) FROM teams WHERE owner=%(username)s), 0)
-             WHERE username=%(username)s
-
-        """, dict(username=self.username))
+        r, = update_taking(cursor or self.db, [self.username])
+        self.set_attributes(taking=r.taking, ntaking_from=r.ntaking_from)
 
 
     def update_is_free_rider(self, is_free_rider, cursor=None):
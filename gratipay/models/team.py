@@ -4,6 +4,8 @@ import requests
 from postgres.orm import Model
 from aspen import json, log
 
+from gratipay.models.counters import update_receiving, update_taking
+
 status_icons = { "unreviewed": "&#9995;"
                , "rejected": "&#10060;"
                , "approved": "&#9989;"
@@ -105,29 +107,9 @@ class Team(Model):
 
 
     def update_receiving(self, cursor=None):
-        r = (cursor or self.db).one("""
-            WITH our_receiving AS (
-                     SELECT amount
-                       FROM current_payment_instructions
-                       JOIN participants p ON p.username = participant
-                      WHERE team = %(slug)s
-                        AND p.is_suspicious IS NOT true
-                        AND amount > 0
-                        AND is_funded
-                 )
-            UPDATE teams t
-               SET receiving = COALESCE((SELECT sum(amount) FROM our_receiving), 0)
-                 , nreceiving_from = COALESCE((SELECT count(*) FROM our_receiving), 0)
-                 , distributing = COALESCE((SELECT sum(amount) FROM our_receiving), 0)
-                 , ndistributing_to = 1
-             WHERE t.slug = %(slug)s
-         RETURNING receiving, nreceiving_from, distributing, ndistributing_to
-        """, dict(slug=self.slug))
-
-
-        # This next step is easy for now since we don't have payroll.
-        from gratipay.models.participant import Participant
-        Participant.from_username(self.owner).update_taking()
+        with self.db.get_cursor(cursor) as cursor:
+            r, = update_receiving(cursor, [self.slug])
+            update_taking(cursor, [self.owner])
 
         self.set_attributes( receiving=r.receiving
                            , nreceiving_from=r.nreceiving_from
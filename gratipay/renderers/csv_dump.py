@@ -6,19 +6,35 @@ from io import BytesIO
 from aspen import renderers
 
 
+CHUNK_SIZE = 64 * 1024  # how much CSV to buffer before sending it out [bytes]
+
+
+def stream_csv(rows, chunk_size=CHUNK_SIZE):
+    """Yield the rows as chunks of CSV, with a header if they have _fields.
+    """
+    f = BytesIO()
+    w = csv.writer(f)
+    first = True
+    for row in rows:
+        if first and hasattr(row, '_fields'):
+            w.writerow(row._fields)
+        first = False
+        w.writerow(row)
+        if f.tell() >= chunk_size:
+            yield f.getvalue()
+            f.seek(0)
+            f.truncate()
+    if f.tell():
+        yield f.getvalue()
+
+
 class Renderer(renderers.Renderer):
 
     def render_content(self, context):
         rows = eval(self.compiled, globals(), context)
-        if not rows:
-            return ''
-        f = BytesIO()
-        w = csv.writer(f)
-        if hasattr(rows[0], '_fields'):
-            w.writerow(rows[0]._fields)
-        w.writerows(rows)
-        f.seek(0)
-        return f.read()
+        if not isinstance(rows, (list, tuple)):
+            return stream_csv(rows)
+        return b''.join(stream_csv(rows))
 
 
 class Factory(renderers.Factory):
@@ -0,0 +1,20 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from aspen import json, renderers
+
+
+def stream_ndjson(rows):
+    """Yield the rows as newline-delimited JSON, one line per row.
+    """
+    for row in rows:
+        yield json.dumps(row) + '\n'
+
+
+class Renderer(renderers.Renderer):
+
+    def render_content(self, context):
+        return stream_ndjson(eval(self.compiled, globals(), context))
+
+
+class Factory(renderers.Factory):
+    Renderer = Renderer
@@ -102,6 +102,7 @@ class Harness(unittest.TestCase):
 
     def tearDown(self):
         resources.__cache__ = {}  # Clear the simplate cache.
+        website.query_cache.clear()
         self.clear_tables()
 
 
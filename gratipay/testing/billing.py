@@ -1,6 +1,13 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import itertools
+import threading
+import time
+from collections import defaultdict
+from decimal import Decimal
+
 import braintree
+import mock
 from braintree.test.nonces import Nonces
 
 from gratipay.billing.exchanges import cancel_card_hold
@@ -38,6 +45,98 @@ class BillingHarness(Harness):
         super(BillingHarness, cls).tearDownClass()
 
 
+class FakeResult(object):
+
+    def __init__(self, transaction):
+        self.is_success = True
+        self.transaction = transaction
+
+
+class FakeSearchResult(object):
+
+    def __init__(self, items):
+        self.items = iter(items)
+        self.maximum_size = len(items)
+
+
+class FakeBraintree(object):
+    """A local stand-in for the parts of braintree.Transaction that payday uses.
+
+    Every call sleeps for `latency` seconds first (or for latencies[method],
+    if given), and the first `failures` calls to each method raise `error`.
+    Use it like this:
+
+        with FakeBraintree(latency=0.1).patch() as fake:
+            Payday.start().payin()
+
+    """
+
+    def __init__(self, latency=0, failures=0, error=braintree.exceptions.DownForMaintenanceError,
+                                                                                   latencies=None):
+        self.latency = latency
+        self.latencies = latencies or {}
+        self.failures = failures
+        self.error = error
+        self.transactions = {}
+        self.calls = defaultdict(int)
+        self.ids = itertools.count(1)
+        self.lock = threading.Lock()
+
+    def _hit(self, method):
+        time.sleep(self.latencies.get(method, self.latency))
+        with self.lock:
+            self.calls[method] += 1
+            if self.calls[method] <= self.failures:
+                raise self.error()
+
+    def _set_status(self, id, status):
+        txn = self.transactions[id]
+        txn.status = status
+        return txn
+
+    def sale(self, params):
+        self._hit('sale')
+        txn = braintree.Transaction(None, {
+            'id': 'fake-%i' % next(self.ids),
+            'amount': Decimal(params['amount']),
+            'tax_amount': 0,
+            'status': 'authorized',
+            'custom_fields': {'participant_id': str(params['custom_fields']['participant_id'])},
+            'credit_card': {'token': params['payment_method_token']},
+        })
+        self.transactions[txn.id] = txn
+        return FakeResult(txn)
+
+    def submit_for_settlement(self, id, amount=None):
+        self._hit('submit_for_settlement')
+        return FakeResult(self._set_status(id, 'submitted_for_settlement'))
+
+    def void(self, id):
+        self._hit('void')
+        return FakeResult(self._set_status(id, 'voided'))
+
+    def search(self, *query):
+        self._hit('search')
+        return FakeSearchResult([ t for t in self.transactions.values()
+                                  if t.status == 'authorized'
+                                 ])
+
+    def patch(self):
+        patcher = mock.patch.multiple( braintree.Transaction
+                                     , sale=self.sale
+                                     , submit_for_settlement=self.submit_for_settlement
+                                     , void=self.void
+                                     , search=self.search
+                                      )
+        class Context(object):
+            def __enter__(_):
+                patcher.start()
+                return self
+            def __exit__(_, *exc_info):
+                patcher.stop()
+        return Context()
+
+
 with use_cassette('BillingHarness'):
     cls = BillingHarness
 
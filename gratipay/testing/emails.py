@@ -1,19 +1,59 @@
+import threading
+import time
+import uuid
+
+import mandrill
 import mock
 
 from gratipay.models.participant import Participant
 from gratipay.testing import Harness
 
 
+class FakeMandrill(object):
+    """Stand in for mandrill.Mandrill, keeping the messages instead of sending
+    them.
+
+    Each send takes latency seconds, like a round trip to Mandrill would, and
+    sends to the addresses in fail_for raise mandrill.Error.
+
+    """
+
+    def __init__(self, latency=0, fail_for=()):
+        self.messages = FakeMessages(latency, fail_for)
+
+
+class FakeMessages(object):
+
+    def __init__(self, latency, fail_for):
+        self.latency = latency
+        self.fail_for = set(fail_for)
+        self.sent = []
+        self.lock = threading.Lock()
+
+    def send(self, message, **kw):
+        if self.latency:
+            time.sleep(self.latency)
+        to = message['to'][0]['email']
+        if to in self.fail_for:
+            raise mandrill.Error("Fake failure sending to %s" % to)
+        with self.lock:
+            self.sent.append(message)
+        return [{'email': to, 'status': 'sent', '_id': uuid.uuid4().hex}]
+
+
 class EmailHarness(Harness):
 
     def setUp(self):
         Harness.setUp(self)
-        self.mailer_patcher = mock.patch.object(Participant._mailer.messages, 'send')
+        self.fake_mandrill = FakeMandrill()
+        mandrill_patcher = mock.patch.object(Participant, '_mailer', self.fake_mandrill)
+        mandrill_patcher.start()
+        self.addCleanup(mandrill_patcher.stop)
+        self.mailer_patcher = mock.patch.object( self.fake_mandrill.messages, 'send'
+                                               , wraps=self.fake_mandrill.messages.send
+                                                )
         self.mailer = self.mailer_patcher.start()
         self.addCleanup(self.mailer_patcher.stop)
-        sleep_patcher = mock.patch('gratipay.models.participant.sleep')
-        sleep_patcher.start()
-        self.addCleanup(sleep_patcher.stop)
 
     def get_last_email(self):
         return self.mailer.call_args[1]['message']
@@ -1,8 +1,15 @@
 from __future__ import unicode_literals
 
+import pickle
+import threading
+import time
+
 from aspen.resources.pagination import parse_specline, split_and_escape
-from aspen_jinja2_renderer import SimplateLoader
 from jinja2 import Environment
+from markupsafe import escape as htmlescape
+import simplejson
+
+from gratipay.utils import i18n
 
 
 ( VERIFICATION_MISSING
@@ -14,17 +21,110 @@ from jinja2 import Environment
  ) = range(6)
 
 
+# The context of a queued email is stored as compact JSON, with decimals kept
+# as numbers, and tagged with this version in email_queue.context_version so
+# the format can change without breaking the messages already in the queue.
+# Version 1 was a pickle, and is still read for the messages queued before.
+CONTEXT_VERSION = 2
+
+
+def encode_context(context):
+    return simplejson.dumps(context, use_decimal=True, separators=(',', ':'))
+
+
+def decode_context(version, data):
+    if version == 2:
+        return simplejson.loads(bytes(data).decode('utf8'), use_decimal=True)
+    if version == 1:
+        return pickle.loads(bytes(data))
+    raise ValueError("unknown email context version: %r" % version)
+
+
 jinja_env = Environment()
 jinja_env_html = Environment(autoescape=True, extensions=['jinja2.ext.autoescape'])
 
-def compile_email_spt(fpath):
+
+class EmailTemplate(object):
+    """A page of an email simplate, compiled once.
+
+    Rendering binds the compiled code to the i18n helpers of the locale, and we
+    keep the result, so each locale's helpers are only made once.
+
+    """
+
+    def __init__(self, env, source, fpath):
+        self.env = env
+        self.code = env.compile(source, fpath, fpath)
+        self.escape = htmlescape if env.autoescape else (lambda s: s)
+        self.by_locale = {}
+
+    def get_template(self, locale, tell_sentry):
+        template = self.by_locale.get(str(locale))
+        if template is None:
+            helpers = {}
+            i18n.add_helpers_to_context(tell_sentry, helpers, locale)
+            helpers['escape'] = self.escape
+            template = self.env.template_class.from_code( self.env
+                                                        , self.code
+                                                        , self.env.make_globals(helpers)
+                                                         )
+            self.by_locale[str(locale)] = template
+        return template
+
+    def render(self, context, locale, tell_sentry):
+        return self.get_template(locale, tell_sentry).render(context)
+
+
+def read_email_spt(fpath):
+    """Return a dict of the sources of an email simplate's pages: the subject,
+    and a body for each content type.
+    """
     r = {}
     with open(fpath) as f:
         pages = list(split_and_escape(f.read()))
     for i, page in enumerate(pages, 1):
-        tmpl = b'\n' * page.offset + page.content
         content_type, renderer = parse_specline(page.header)
         key = 'subject' if i == 1 else content_type
+        r[key] = (content_type, b'\n' * page.offset + page.content)
+    return r
+
+
+def compile_email_spt(fpath, base=None):
+    """Return a dict of EmailTemplates for the pages of an email simplate.
+
+    base is what read_email_spt returns for the layout of our emails. Each body
+    is put in place of $body in the page of the base for its content type,
+    and compiled with it into a single template.
+
+    """
+    r = {}
+    for key, (content_type, tmpl) in read_email_spt(fpath).items():
+        if base and key in base and key != 'subject':
+            body = b'{% filter trim %}' + tmpl.strip() + b'{% endfilter %}'
+            tmpl = base[key][1].replace(b'$body', body)
         env = jinja_env_html if content_type == 'text/html' else jinja_env
-        r[key] = SimplateLoader(fpath, tmpl).load(env, fpath)
+        r[key] = EmailTemplate(env, tmpl, fpath)
     return r
+
+
+class RateLimiter(object):
+    """Space out calls to wait, from any number of threads, so that they return
+    at most per_minute times a minute. Zero means no limit.
+    """
+
+    def __init__(self, per_minute, clock=time.time, sleep=time.sleep):
+        self.interval = 60.0 / per_minute if per_minute > 0 else 0
+        self.clock = clock
+        self.sleep = sleep
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = self.clock()
+            then = max(now, self.next_time)
+            self.next_time = then + self.interval
+        if then > now:
+            self.sleep(then - now)
@@ -12,7 +12,6 @@ from gratipay.elsewhere import PLATFORMS
 from gratipay.models.participant import Participant
 from gratipay.models.team import Team
 from gratipay.models import community
-from gratipay.models import check_db
 
 faker = Factory.create()
 
@@ -386,7 +385,7 @@ def main():
     prep_db(db)
     populate_db(db)
     clean_db(db)
-    check_db(db)
+    db.self_check()
 
 
 if __name__ == '__main__':
@@ -5,6 +5,105 @@ from aspen import Response
 from psycopg2 import IntegrityError
 
 
+def year_range(year):
+    """Return the half-open [start, end) range of timestamps in year.
+
+    Query with "timestamp" >= start AND "timestamp" < end rather than with
+    extract(year from timestamp), so that the timestamp indexes can be used.
+
+    """
+    return datetime(year, 1, 1), datetime(year+1, 1, 1)
+
+
+# The amounts by which each participant's balance changed in a time range.
+BALANCE_DELTAS = """
+    SELECT username, sum(a) AS delta
+      FROM (
+              SELECT participant AS username, amount AS a
+                FROM exchanges
+               WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+                 AND amount > 0
+                 AND (status is null OR status = 'succeeded')
+
+           UNION ALL
+
+              SELECT participant AS username, amount-fee AS a
+                FROM exchanges
+               WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+                 AND amount < 0
+                 AND (status is null OR status <> 'failed')
+
+           UNION ALL
+
+              SELECT tipper AS username, -amount AS a
+                FROM transfers
+               WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+
+           UNION ALL
+
+              SELECT tippee AS username, amount AS a
+                FROM transfers
+               WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+
+           UNION ALL
+
+              SELECT participant AS username
+                   , CASE WHEN direction='to-participant' THEN amount ELSE -amount END AS a
+                FROM payments
+               WHERE "timestamp" >= %(start)s AND "timestamp" < %(end)s
+           ) AS foo
+  GROUP BY username
+"""
+
+
+def snapshot_balances(db, current_year=None):
+    """Record everyone's balance at the end of each past year in balances_at.
+
+    Each year is done in one pass for all participants, from the snapshot at
+    the end of the year before plus that year's ledger rows, so we go year by
+    year from the oldest. Years that are already done are skipped, which makes
+    this cheap enough to run after every payday.
+
+    """
+    current_year = current_year or datetime.utcnow().year
+    first_year = db.one("SELECT extract(year from min(ctime))::int FROM participants")
+    if first_year is None:
+        return
+    for year in range(first_year, current_year):
+        start, end = year_range(year)
+        params = dict(start=start, end=end)
+        with db.get_cursor() as cursor:
+            missing = cursor.one("""
+                SELECT EXISTS (
+                           SELECT 1
+                             FROM participants p
+                            WHERE p.ctime < %(end)s
+                              AND NOT EXISTS ( SELECT 1
+                                                 FROM balances_at b
+                                                WHERE b.participant = p.id
+                                                  AND b.at = %(end)s
+                                              )
+                       )
+            """, params)
+            if not missing:
+                continue
+            cursor.run("""
+                INSERT INTO balances_at
+                            (participant, at, balance)
+                     SELECT p.id, %(end)s, COALESCE(prev.balance, 0) + COALESCE(d.delta, 0)
+                       FROM participants p
+                  LEFT JOIN balances_at prev ON prev.participant = p.id
+                                            AND prev.at = %(start)s
+                  LEFT JOIN ({}) d ON d.username = p.username
+                      WHERE p.ctime < %(end)s
+                        AND NOT EXISTS ( SELECT 1
+                                           FROM balances_at b
+                                          WHERE b.participant = p.id
+                                            AND b.at = %(end)s
+                                        )
+            """.format(BALANCE_DELTAS), params)
+
+
 def get_end_of_year_balance(db, participant, year, current_year):
     if year == current_year:
         return participant.balance
@@ -21,36 +120,16 @@ def get_end_of_year_balance(db, participant, year, current_year):
     if balance is not None:
         return balance
 
-    username = participant.username
-    start_balance = get_end_of_year_balance(db, participant, year-1, current_year)
-    delta = db.one("""
-        SELECT (
-                  SELECT COALESCE(sum(amount), 0) AS a
-                    FROM exchanges
-                   WHERE participant = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount > 0
-                     AND (status is null OR status = 'succeeded')
-               ) + (
-                  SELECT COALESCE(sum(amount-fee), 0) AS a
-                    FROM exchanges
-                   WHERE participant = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-                     AND amount < 0
-                     AND (status is null OR status <> 'failed')
-               ) + (
-                  SELECT COALESCE(sum(-amount), 0) AS a
-                    FROM transfers
-                   WHERE tipper = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-               ) + (
-                  SELECT COALESCE(sum(amount), 0) AS a
-                    FROM transfers
-                   WHERE tippee = %(username)s
-                     AND extract(year from timestamp) = %(year)s
-               ) AS delta
-    """, locals())
-    balance = start_balance + delta
+    # The snapshot hasn't been taken yet, so sum this participant's ledger rows
+    # up to the end of the year.
+    balance = db.one("""
+        SELECT COALESCE(sum(delta), 0)
+          FROM ({}) AS deltas
+         WHERE username = %(username)s
+    """.format(BALANCE_DELTAS), dict( username=participant.username
+                                     , start=datetime(start.year, 1, 1)
+                                     , end=datetime(year+1, 1, 1)
+                                      ))
     try:
         db.run("""
             INSERT INTO balances_at
@@ -62,153 +141,228 @@ def get_end_of_year_balance(db, participant, year, current_year):
     return balance
 
 
-def iter_payday_events(db, participant, year=None):
+# The ledger rows of one participant in a time range, newest first, with the
+# number of the payday that ran on the same day, if any.
+PAYDAY_EVENTS = """
+    WITH payday_dates AS (
+             SELECT ts_start::date AS date
+                  , max(number) AS payday_number
+               FROM ( SELECT ts_start, row_number() OVER (ORDER BY ts_start) - 1 AS number
+                        FROM paydays
+                    ) AS numbered
+           GROUP BY ts_start::date
+         )
+       , events AS (
+             SELECT 'exchange' AS source, id, "timestamp", amount, fee, status, note, recorder
+                  , NULL::payment_direction AS direction, NULL AS team
+                  , NULL AS tipper, NULL AS tippee, NULL::context_type AS context
+               FROM exchanges
+              WHERE participant = %(username)s
+                AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+          UNION ALL
+             SELECT 'payment', id, "timestamp", amount, NULL, NULL, NULL, NULL
+                  , direction, team
+                  , NULL, NULL, NULL
+               FROM payments
+              WHERE participant = %(username)s
+                AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+          UNION ALL
+             SELECT 'transfer', id, "timestamp", amount, NULL, NULL, NULL, NULL
+                  , NULL, NULL
+                  , tipper, tippee, context
+               FROM transfers
+              WHERE tipper = %(username)s
+                AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+          UNION ALL
+             SELECT 'transfer', id, "timestamp", amount, NULL, NULL, NULL, NULL
+                  , NULL, NULL
+                  , tipper, tippee, context
+               FROM transfers
+              WHERE tippee = %(username)s AND tipper <> %(username)s
+                AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+         )
+    SELECT e.*, pd.payday_number
+      FROM events e
+ LEFT JOIN payday_dates pd ON pd.date = e."timestamp"::date
+  ORDER BY e."timestamp" DESC, e.id DESC
+"""
+
+
+def get_history_totals(db, participant, year):
+    """Return the number of payments and transfers of a participant in a year,
+    and the totals given and received through them.
+    """
+    start, end = year_range(year)
+    return db.one("""
+        SELECT count(*) AS n
+             , COALESCE(sum(given), 0) AS given
+             , COALESCE(sum(received), 0) AS received
+          FROM (
+                  SELECT CASE WHEN direction = 'to-team' THEN amount ELSE 0 END AS given
+                       , CASE WHEN direction = 'to-participant' THEN amount ELSE 0 END AS received
+                    FROM payments
+                   WHERE participant = %(username)s
+                     AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               UNION ALL
+                  SELECT CASE WHEN context <> 'take' THEN amount ELSE 0 END, 0
+                    FROM transfers
+                   WHERE tipper = %(username)s
+                     AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               UNION ALL
+                  SELECT 0, amount
+                    FROM transfers
+                   WHERE tippee = %(username)s AND tipper <> %(username)s
+                     AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
+               ) AS foo
+    """, dict(username=participant.username, start=start, end=end))
+
+
+def iter_payday_events(db, participant, year=None, before=None, ndays=None):
     """Yields payday events for the given participant.
+
+    The events are read lazily from a single query, newest first. Pass a date
+    as before to start from the day before it, and a number of days as ndays to
+    stop after that many days. When there are more days to show, the last event
+    is a 'more' event with the date to pass as before for the next page.
+
     """
     current_year = datetime.utcnow().year
     year = year or current_year
 
     username = participant.username
-    exchanges = db.all("""
-        SELECT *
-          FROM exchanges
-         WHERE participant=%(username)s
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-    payments = db.all("""
-        SELECT *
-          FROM payments
-         WHERE participant=%(username)s
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-    transfers = db.all("""
-        SELECT *
-          FROM transfers
-         WHERE (tipper=%(username)s OR tippee=%(username)s)
-           AND extract(year from timestamp) = %(year)s
-    """, locals(), back_as=dict)
-
-    if not (exchanges or payments or transfers):
-        return
+    start, end = year_range(year)
+    balance = get_end_of_year_balance(db, participant, year, current_year)
 
-    if payments or transfers:
-        payments_given = sum([p['amount'] for p in payments if p['direction'] == 'to-team'])
-        payments_received = sum([p['amount'] for p in payments \
-                                                            if p['direction'] == 'to-participant'])
-        transfers_given = sum(t['amount'] for t in transfers \
-                                             if t['tipper'] == username and t['context'] != 'take')
-        transfers_received = sum(t['amount'] for t in transfers if t['tippee'] == username)
-        yield dict( kind='totals'
-                  , given=payments_given + transfers_given
-                  , received=payments_received + transfers_received
-                   )
-
-    payday_dates = db.all("""
-        SELECT ts_start::date
-          FROM paydays
-      ORDER BY ts_start ASC
-    """)
+    if before is None:
+        totals = get_history_totals(db, participant, year)
+        if totals.n:
+            yield dict(kind='totals', given=totals.given, received=totals.received)
+    else:
+        page_end = datetime(before.year, before.month, before.day)
+        if page_end < end:
+            # Roll the balance back over the days shown on previous pages.
+            balance -= db.one("""
+                SELECT COALESCE(sum(delta), 0)
+                  FROM ({}) AS deltas
+                 WHERE username = %(username)s
+            """.format(BALANCE_DELTAS), dict(username=username, start=page_end, end=end))
+            end = page_end
 
-    balance = get_end_of_year_balance(db, participant, year, current_year)
-    prev_date = None
-    get_timestamp = lambda e: e['timestamp']
-    events = sorted(exchanges+payments+transfers, key=get_timestamp, reverse=True)
-    for event in events:
-
-        event['balance'] = balance
-
-        event_date = event['timestamp'].date()
-        if event_date != prev_date:
-            if prev_date:
-                yield dict(kind='day-close', balance=balance)
-            day_open = dict(kind='day-open', date=event_date, balance=balance)
-            if payday_dates:
-                while payday_dates and payday_dates[-1] > event_date:
-                    payday_dates.pop()
-                payday_date = payday_dates[-1] if payday_dates else None
-                if event_date == payday_date:
-                    day_open['payday_number'] = len(payday_dates) - 1
-            yield day_open
-            prev_date = event_date
-
-        if 'fee' in event:
-            if event['amount'] > 0:
-                kind = 'charge'
-                if event['status'] in (None, 'succeeded'):
+    params = dict(username=username, start=start, end=end)
+    events = db.iter_all(PAYDAY_EVENTS, params, back_as=dict)
+    try:
+        prev_date = None
+        days = 0
+        for event in events:
+
+            event['balance'] = balance
+            payday_number = event.pop('payday_number')
+
+            event_date = event['timestamp'].date()
+            if event_date != prev_date:
+                if prev_date:
+                    yield dict(kind='day-close', balance=balance)
+                    if days == ndays:
+                        yield dict(kind='more', before=prev_date)
+                        return
+                day_open = dict(kind='day-open', date=event_date, balance=balance)
+                if payday_number is not None:
+                    day_open['payday_number'] = payday_number
+                yield day_open
+                prev_date = event_date
+                days += 1
+
+            source = event.pop('source')
+            if source == 'exchange':
+                if event['amount'] > 0:
+                    kind = 'charge'
+                    if event['status'] in (None, 'succeeded'):
+                        balance -= event['amount']
+                else:
+                    kind = 'credit'
+                    if event['status'] != 'failed':
+                        balance -= event['amount'] - event['fee']
+            elif source == 'payment':
+                kind = 'payment'
+                if event['direction'] == 'to-participant':
                     balance -= event['amount']
+                else:
+                    assert event['direction'] == 'to-team'
+                    balance += event['amount']
             else:
-                kind = 'credit'
-                if event['status'] != 'failed':
-                    balance -= event['amount'] - event['fee']
-        elif 'direction' in event:
-            kind = 'payment'
-            if event['direction'] == 'to-participant':
-                balance -= event['amount']
-            else:
-                assert event['direction'] == 'to-team'
-                balance += event['amount']
-        else:
-            kind = 'transfer'
-            if event['tippee'] == username:
-                balance -= event['amount']
-            else:
-                balance += event['amount']
-        event['kind'] = kind
+                kind = 'transfer'
+                if event['tippee'] == username:
+                    balance -= event['amount']
+                else:
+                    balance += event['amount']
+            event['kind'] = kind
 
-        yield event
+            yield event
 
-    yield dict(kind='day-close', balance=balance)
+        if prev_date:
+            yield dict(kind='day-close', balance=balance)
+    finally:
+        events.close()
 
 
-def export_history(participant, year, mode, key, back_as='namedtuple', require_key=False):
+def export_history(participant, year, mode, key, back_as='namedtuple', require_key=False,
+                   stream=False):
+    """Return the rows of the history export for the given year.
+
+    With stream=True each result set is an iterator over a server-side cursor
+    instead of a list, for the renderers to send out as the rows are read.
+
+    """
     db = participant.db
-    params = dict(username=participant.username, year=year)
+    fetch = db.iter_all if stream else db.all
+    start, end = year_range(year)
+    params = dict(username=participant.username, start=start, end=end)
     out = {}
     if mode == 'aggregate':
-        out['given'] = lambda: db.all("""
+        out['given'] = lambda: fetch("""
             SELECT tippee, sum(amount) AS amount
               FROM transfers
              WHERE tipper = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
           GROUP BY tippee
         """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+        out['taken'] = lambda: fetch("""
             SELECT tipper AS team, sum(amount) AS amount
               FROM transfers
              WHERE tippee = %(username)s
                AND context = 'take'
-               AND extract(year from timestamp) = %(year)s
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
           GROUP BY tipper
         """, params, back_as=back_as)
     else:
-        out['exchanges'] = lambda: db.all("""
+        out['exchanges'] = lambda: fetch("""
             SELECT timestamp, amount, fee, status, note
               FROM exchanges
              WHERE participant = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
           ORDER BY timestamp ASC
         """, params, back_as=back_as)
-        out['given'] = lambda: db.all("""
+        out['given'] = lambda: fetch("""
             SELECT timestamp, tippee, amount, context
               FROM transfers
              WHERE tipper = %(username)s
-               AND extract(year from timestamp) = %(year)s
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
           ORDER BY timestamp ASC
         """, params, back_as=back_as)
-        out['taken'] = lambda: db.all("""
+        out['taken'] = lambda: fetch("""
             SELECT timestamp, tipper AS team, amount
               FROM transfers
              WHERE tippee = %(username)s
                AND context = 'take'
-               AND extract(year from timestamp) = %(year)s
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
           ORDER BY timestamp ASC
         """, params, back_as=back_as)
-        out['received'] = lambda: db.all("""
+        out['received'] = lambda: fetch("""
             SELECT timestamp, amount, context
               FROM transfers
              WHERE tippee = %(username)s
                AND context NOT IN ('take', 'take-over')
-               AND extract(year from timestamp) = %(year)s
+               AND "timestamp" >= %(start)s AND "timestamp" < %(end)s
           ORDER BY timestamp ASC
         """, params, back_as=back_as)
 
@@ -10,6 +10,10 @@ from aspen import Response
 ETAGS = {}
 
 
+def hash_etag(content):
+    return b64encode(md5(content).digest(), '-_').replace('=', '~')
+
+
 def asset_etag(path):
     if path.endswith('.spt'):
         return ''
@@ -17,10 +21,22 @@ def asset_etag(path):
         h = ETAGS[path]
     else:
         with open(path) as f:
-            h = ETAGS[path] = b64encode(md5(f.read()).digest(), '-_').replace('=', '~')
+            h = ETAGS[path] = hash_etag(f.read())
     return h
 
 
+def serve_304_if_unchanged(request, response, content):
+    """Set an Etag computed from content on a dynamic response, and raise 304
+    if the client already has that version.
+    """
+    etag = hash_etag(content)
+    response.headers['Etag'] = etag
+    if request.headers.get('If-None-Match') == etag:
+        response.code = 304
+        response.body = ''
+        raise response
+
+
 # algorithm functions
 
 def get_etag_for_file(dispatch_result):
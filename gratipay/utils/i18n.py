@@ -195,6 +195,22 @@ def match_lang(languages):
     return LOCALE_EN
 
 
+MATCHED_LANGS = {}
+MATCHED_LANGS_MAX = 1000
+
+
+def match_accept_lang(accept_lang):
+    """Return match_lang(parse_accept_lang(accept_lang)), remembering the
+    answer for the next time the same accept_lang comes by.
+    """
+    loc = MATCHED_LANGS.get(accept_lang)
+    if loc is None:
+        if len(MATCHED_LANGS) >= MATCHED_LANGS_MAX:
+            MATCHED_LANGS.clear()
+        loc = MATCHED_LANGS[accept_lang] = match_lang(parse_accept_lang(accept_lang))
+    return loc
+
+
 def format_currency_with_options(number, currency, format=None, locale='en', trailing_zeroes=True):
     s = format_currency(number, currency, format, locale=locale)
     if not trailing_zeroes:
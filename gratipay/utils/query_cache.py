@@ -1,7 +1,10 @@
+import cPickle
+import heapq
 import sys
 import threading
 import time
 import traceback
+from collections import OrderedDict
 
 
 # Define a query cache.
@@ -19,13 +22,46 @@ class Entry(object):
     timestamp = None    # The timestamp of the last query run [datetime.datetime]
     lock = None         # Access control for this record [threading.Lock]
     exc = None          # Any exception in query or formatting [Exception]
+    ttl = 0             # The maximum life of this entry [seconds as int]
+    size = 0            # The approximate size of the result [bytes as int]
+    has_result = False  # Whether result is from a successful query [bool]
 
-    def __init__(self, timestamp=0, lock=None, result=None):
+    def __init__(self, timestamp=0, lock=None, result=None, ttl=0):
         """Populate with dummy data or an actual db entry.
         """
         self.timestamp = timestamp
         self.lock = lock or threading.Lock()
         self.result = result
+        self.ttl = ttl
+
+
+def sizeof(obj):
+    """Return the approximate size of obj in bytes.
+
+    We go by the length of the pickle, which accounts for nested objects, and
+    fall back to the shallow sys.getsizeof for things that don't pickle. The
+    rows that postgres.py returns are namedtuples of a class made on the fly,
+    which doesn't pickle, so we measure a copy with those turned into plain
+    tuples.
+
+    """
+    try:
+        return len(cPickle.dumps(_plain(obj), cPickle.HIGHEST_PROTOCOL))
+    except Exception:
+        return sys.getsizeof(obj)
+
+
+def _plain(obj):
+    """Return a copy of obj with any tuples (namedtuples included) in it turned
+    into plain tuples.
+    """
+    if isinstance(obj, tuple):
+        return tuple(_plain(v) for v in obj)
+    elif isinstance(obj, list):
+        return [_plain(v) for v in obj]
+    elif isinstance(obj, dict):
+        return {k: _plain(v) for k, v in obj.iteritems()}
+    return obj
 
 
 class QueryCache(object):
@@ -39,10 +75,16 @@ class QueryCache(object):
     result, post-processed for your application.
 
     The results of the callback are cached for <self.threshold> seconds
-    (default: 5), keyed to the given SQL queries. NB: the cache is *not* keyed
-    to the callback function, so cache entries with different callbacks will
-    collide when operating on identical SQL queries. In this case cache entries
-    can be differentiated by adding comments to the SQL statements.
+    (default: 5), or for <ttl> seconds if that's passed to one or all, keyed to
+    the given SQL queries. NB: the cache is *not* keyed to the callback
+    function, so cache entries with different callbacks will collide when
+    operating on identical SQL queries. In this case cache entries can be
+    differentiated by adding comments to the SQL statements.
+
+    A <version> may also be passed to one or all, and is then part of the key.
+    Give something cheap to look up that changes along with the data, such as
+    a max id, and the cached result is replaced as soon as the data changes
+    instead of when the ttl runs out.
 
     This so-called micro-caching helps greatly when under load, while keeping
     pages more or less fresh. For relatively static page elements like
@@ -53,107 +95,162 @@ class QueryCache(object):
     but 100 requests in the same second will only result in one database call.
 
     This object also features a pruning thread, which removes stale cache
-    entries on a more relaxed schedule (default: 60 seconds). It keeps the
-    cache clean without interfering too much with actual usage.
+    entries on a more relaxed schedule (default: 60 seconds). Expiry times are
+    kept in a heap, so a pruning run only looks at the entries that have
+    actually expired, and it keeps the cache clean without interfering too
+    much with actual usage. It prunes the <shared> backend too, if any. Call
+    stop to end the pruning thread.
+
+    The cache is also bounded: if there are more than <max_entries> entries,
+    or their results add up to more than <max_bytes> (as measured by sizeof),
+    then the least recently used entries are evicted. Zero means no bound.
+
+    Hits, misses, and evictions (by the pruner or for size) are counted in
+    <self.stats>, and the current size is in <self.nbytes>.
+
+    If a <shared> backend from gratipay.utils.shared_cache is given, then
+    misses go through it, so that processes sharing the backend run each query
+    once between them. Misses answered by the backend count as shared_hits.
 
     If the actual database call or the formatting callback raise an Exception,
     then that is cached as well, and will be raised on further calls until the
     cache expires as usual.
 
+    With <serve_stale> set, the cache works in stale-while-revalidate mode
+    instead: an expired entry is refreshed by a single background thread,
+    while readers keep getting the last good result without waiting. Errors
+    are not cached in this mode, and a failed refresh keeps the last good
+    result. Stale reads and failed refreshes are counted in <self.stats> too.
+
     And yes, Virginia, QueryCache is thread-safe (as long as you don't invoke
     the same instance again within your formatting callback).
 
     """
 
     db = None               # PostgresManager object
-    cache = None            # the query cache [dictionary]
+    cache = None            # the query cache, least recently used first [OrderedDict]
+    expiries = None         # (expiry time, key) pairs [heap]
     locks = None            # access controls for self.cache [Locks]
     threshold = 5           # maximum life of a cache entry [seconds as int]
     threshold_prune = 60    # time between pruning runs [seconds as int]
+    max_entries = 0         # maximum number of entries [int]
+    max_bytes = 0           # maximum total size of results [bytes as int]
+    nbytes = 0              # total size of results [bytes as int]
+    serve_stale = False     # stale-while-revalidate mode [bool]
+    shared = None           # cache shared with other processes [backend]
+    stats = None            # hit/miss/eviction counters [dictionary]
+    stopped = None          # set to end the pruning thread [Event]
 
 
-    def __init__(self, db, threshold=5, threshold_prune=60):
+    def __init__(self, db, threshold=5, threshold_prune=60, max_entries=0, max_bytes=0,
+                 serve_stale=False, shared=None):
         """
         """
         self.db = db
         self.threshold = threshold
         self.threshold_prune = threshold_prune
-        self.cache = {}
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.serve_stale = serve_stale
+        self.shared = shared
+        self.cache = OrderedDict()
+        self.expiries = []
+        self.nbytes = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, stale=0, errors=0, shared_hits=0)
 
         class Locks:
-            checkin = threading.Lock()
-            checkout = threading.Lock()
+            cache = threading.Lock()
+            stats = threading.Lock()
         self.locks = Locks()
 
+        self.stopped = threading.Event()
         self.pruner = threading.Thread(target=self.prune)
         self.pruner.setDaemon(True)
         self.pruner.start()
 
 
-    def one(self, query, params, process=None):
-        return self._do_query(self.db.one, query, params, process)
+    def one(self, query, params=None, process=None, ttl=None, version=None):
+        return self._do_query(self.db.one, query, params, process, ttl, version)
 
-    def all(self, query, params, process=None):
+    def all(self, query, params=None, process=None, ttl=None, version=None):
         if process is None:
             process = lambda g: list(g)
-        return self._do_query(self.db.all, query, params, process)
+        return self._do_query(self.db.all, query, params, process, ttl, version)
+
+    def clear(self):
+        """Remove all entries from the cache.
+        """
+        self.locks.cache.acquire()
+        try:  # critical section
+            self.cache.clear()
+            self.expiries = []
+            self.nbytes = 0
+        finally:
+            self.locks.cache.release()
+        if self.shared is not None:
+            self.shared.clear()
+
+    def _count(self, name, n=1):
+        self.locks.stats.acquire()
+        try:  # critical section
+            self.stats[name] += n
+        finally:
+            self.locks.stats.release()
 
-    def _do_query(self, fetchfunc, query, params, process):
+    def _do_query(self, fetchfunc, query, params, process, ttl=None, version=None):
         """Given a function, a SQL string, a tuple, and a function, return ???.
         """
 
+        if ttl is None:
+            ttl = self.threshold
+
+
         # Compute a cache key.
         # ====================
 
-        key = (query, params)
+        key = (query, params) if version is None else (query, params, version)
 
 
         # Check out an entry.
         # ===================
         # Each entry has its own lock, and "checking out" an entry means
         # acquiring that lock. If a queryset isn't yet in our cache, we first
-        # "check in" a new dummy entry for it (and prevent other threads from
-        # adding the same query), which will be populated presently.
-
-        #thread_id = threading.currentThread().getName()[-1:] # for debugging
-        #call_id = ''.join([random.choice(string.letters) for i in range(5)])
+        # "check in" a new dummy entry for it (so that other threads wait for
+        # us instead of running the same query), which will be populated
+        # presently. We don't wait for the entry's lock while holding the cache
+        # lock, so a slow query doesn't hold up requests for other queries.
 
-        self.locks.checkout.acquire()
+        self.locks.cache.acquire()
         try:  # critical section
-            if key in self.cache:
-
-                # Retrieve an already cached query.
-                # =================================
-                # The cached entry may be a dummy. The best way to guarantee we
-                # will catch this case is to simply refresh our entry after we
-                # acquire its lock.
-
-                entry = self.cache[key]
-                entry.lock.acquire()
-                entry = self.cache[key]
-
+            entry = self.cache.pop(key, None)
+            if entry is None:
+                entry = Entry()
+            self.cache[key] = entry  # (re)insert as most recently used
+        finally:
+            self.locks.cache.release()
+
+        # Serve a stale result.
+        # =====================
+        # In stale-while-revalidate mode, once an entry has a good result we
+        # never make readers wait for it. If it's expired then whoever gets
+        # its lock first refreshes it in the background, and in the meantime
+        # everyone gets the last good result.
+
+        if self.serve_stale and entry.has_result:
+            if time.time() - entry.timestamp < ttl:
+                self._count('hits')
             else:
+                self._count('stale')
+                if entry.lock.acquire(False):
+                    refresher = threading.Thread( target=self._refresh_in_background
+                                                , args=(key, entry, fetchfunc, query, params,
+                                                        process, ttl)
+                                                 )
+                    refresher.setDaemon(True)
+                    refresher.start()
+            return entry.result
 
-                # Add a new entry to our cache.
-                # =============================
-
-                dummy = Entry()
-                dummy.lock.acquire()
-                self.locks.checkin.acquire()
-                try:  # critical section
-                    if key in self.cache:
-                        # Someone beat us to it. XXX: can this actually happen?
-                        entry = self.cache[key]
-                    else:
-                        self.cache[key] = dummy
-                        entry = dummy
-                finally:
-                    self.locks.checkin.release()
-
-        finally:
-            self.locks.checkout.release() # Now that we've checked out our
-                                          # queryset, other threads are free to
-                                          # check out other queries.
+        entry.lock.acquire()
 
 
         # Process the query.
@@ -164,79 +261,208 @@ class QueryCache(object):
             # Decide whether it's a hit or miss.
             # ==================================
 
-            if time.time() - entry.timestamp < self.threshold:  # cache hit
+            if time.time() - entry.timestamp < ttl:             # cache hit
+                self._count('hits')
                 if entry.exc is not None:
                     raise entry.exc
                 return entry.result
 
             else:                                               # cache miss
-                try:                    # XXX uses postgres.py api, not dbapi2!
-                    entry.result = fetchfunc(query, params)
-                    if process is not None:
-                        entry.result = process(entry.result)
-                    entry.exc = None
-                except:
-                    entry.result = None
-                    entry.exc = ( FormattingError(traceback.format_exc())
-                                , sys.exc_info()[2]
-                                 )
-
-
-            # Check the queryset back in.
-            # ===========================
-
-            self.locks.checkin.acquire()
-            try:  # critical section
-                entry.timestamp = time.time()
+                self._count('misses')
+                result, exc, timestamp = self._fetch_shared(key, ttl, fetchfunc, query,
+                                                            params, process)
+                if exc is not None and self.serve_stale:
+                    # Don't cache errors in this mode; the next reader will
+                    # try again.
+                    raise exc[0]
+                self._check_in(key, entry, result, exc, ttl, timestamp)
+
+            if entry.exc is not None:
+                raise entry.exc[0]
+            else:
+                return entry.result
+
+        finally:
+            entry.lock.release()
+
+
+    def _fetch(self, fetchfunc, query, params, process):
+        """Run the query and the formatting callback.
+
+        Return a (result, exc) tuple, where exc is None on success.
+
+        """
+        try:                    # XXX uses postgres.py api, not dbapi2!
+            result = fetchfunc(query, params)
+            if process is not None:
+                result = process(result)
+            return result, None
+        except:
+            exc = ( FormattingError(traceback.format_exc())
+                  , sys.exc_info()[2]
+                   )
+            return None, exc
+
+
+    def _fetch_shared(self, key, ttl, fetchfunc, query, params, process):
+        """Get a result from the shared backend, or fetch it and share it.
+
+        Return a (result, exc, timestamp) tuple. The timestamp is the time the
+        result was fetched, by whichever process did so.
+
+        """
+        if self.shared is None:
+            return self._fetch(fetchfunc, query, params, process) + (time.time(),)
+        with self.shared.lock(key):
+            shared = self.shared.get(key)
+            if shared is not None and time.time() - shared[0] < ttl:
+                self._count('shared_hits')
+                timestamp, result = shared
+                return result, None, timestamp
+            result, exc = self._fetch(fetchfunc, query, params, process)
+            timestamp = time.time()
+            if exc is None:
+                self.shared.set(key, timestamp, result, ttl)
+            return result, exc, timestamp
+
+
+    def _check_in(self, key, entry, result, exc, ttl, timestamp):
+        """Store a fresh result in an entry, whose lock we must be holding.
+        """
+
+        # Check the queryset back in.
+        # ===========================
+        # The entry may have been evicted while we were busy with it, in
+        # which case it goes back in.
+
+        size = sizeof(result)
+        self.locks.cache.acquire()
+        try:  # critical section
+            entry.result = result
+            entry.exc = exc
+            entry.has_result = exc is None
+            entry.ttl = ttl
+            entry.timestamp = timestamp
+            if self.cache.get(key) is entry:
+                self.nbytes -= entry.size
+            else:
+                self.cache.pop(key, None)
                 self.cache[key] = entry
-                if entry.exc is not None:
-                    raise entry.exc[0]
-                else:
-                    return entry.result
-            finally:
-                self.locks.checkin.release()
+            entry.size = size
+            self.nbytes += size
+            expiry = entry.timestamp + max(entry.ttl, self.threshold_prune)
+            heapq.heappush(self.expiries, (expiry, key))
+            self._evict_lru(keep=key)
+        finally:
+            self.locks.cache.release()
 
+
+    def _refresh_in_background(self, key, entry, fetchfunc, query, params, process, ttl):
+        """Refresh an entry whose lock we've been handed.
+
+        If the query fails we keep the last good result, and leave the entry
+        expired so that the next reader tries again.
+
+        """
+        try:
+            result, exc, timestamp = self._fetch_shared(key, ttl, fetchfunc, query,
+                                                        params, process)
+            if exc is None:
+                self._check_in(key, entry, result, exc, ttl, timestamp)
+            else:
+                self._count('errors')
         finally:
             entry.lock.release()
 
 
+    def _evict_lru(self, keep):
+        """Evict least recently used entries until we're within bounds.
+
+        Entries that are in use are skipped, as is the entry for keep. Must be
+        called with the cache lock held.
+
+        """
+        victims = []
+        n, nbytes = len(self.cache), self.nbytes
+        for key, entry in self.cache.iteritems():
+            if not (self.max_entries and n > self.max_entries) and \
+               not (self.max_bytes and nbytes > self.max_bytes):
+                break
+            if key == keep or not entry.lock.acquire(False):
+                continue
+            victims.append((key, entry))
+            n -= 1
+            nbytes -= entry.size
+        for key, entry in victims:
+            del self.cache[key]
+            self.nbytes -= entry.size
+            entry.lock.release()
+        if victims:
+            self._count('evictions', len(victims))
+
+
     def prune(self):
         """Periodically remove any stale queries in our cache.
         """
 
         last = 0  # timestamp of last pruning run
 
-        while 1:
+        while not self.stopped.is_set():
 
             if time.time() < last + self.threshold_prune:
                 # Not time to prune yet.
-                time.sleep(0.2)
+                self.stopped.wait(0.2)
                 continue
 
-            self.locks.checkout.acquire()
-            try:  # critical section
+            self.prune_once()
+            last = time.time()
 
-                for key, entry in tuple(self.cache.items()):
 
-                    # Check out the entry.
-                    # ====================
-                    # If the entry is currently in use, skip it.
+    def stop(self):
+        """Stop the pruning thread, and wait for it to finish.
+        """
+        self.stopped.set()
+        self.pruner.join()
 
-                    available = entry.lock.acquire(False)
-                    if not available:
-                        continue
 
+    def prune_once(self):
+        """Remove the entries that have expired.
 
-                    # Remove the entry if it is too old.
-                    # ==================================
+        Each check-in pushes a new expiry onto the heap, so there can be stale
+        expiries for entries that have been refreshed or evicted since; those
+        are just dropped. Then the shared backend, if any, is pruned too.
 
-                    try:  # critical section
-                        if time.time() - entry.timestamp > self.threshold_prune:
-                            del self.cache[key]
-                    finally:
-                        entry.lock.release()
+        """
+        now = time.time()
+        self.locks.cache.acquire()
+        try:  # critical section
+            while self.expiries and self.expiries[0][0] <= now:
+                expiry, key = heapq.heappop(self.expiries)
+                entry = self.cache.get(key)
+                if entry is None:
+                    continue
 
-            finally:
-                self.locks.checkout.release()
+                # Check out the entry.
+                # ====================
+                # If the entry is currently in use, skip it: it's being
+                # refreshed, and will push a new expiry when it's checked in.
 
-            last = time.time()
+                available = entry.lock.acquire(False)
+                if not available:
+                    continue
+
+
+                # Remove the entry if it is too old.
+                # ==================================
+
+                try:  # critical section
+                    if now - entry.timestamp >= max(entry.ttl, self.threshold_prune):
+                        del self.cache[key]
+                        self.nbytes -= entry.size
+                        self._count('evictions')
+                finally:
+                    entry.lock.release()
+        finally:
+            self.locks.cache.release()
+        if self.shared is not None:
+            self.shared.prune()
@@ -0,0 +1,105 @@
+"""Record the SQL run while handling each request.
+
+GratipayDB hands out cursors from this module, which report the time spent in
+each statement to the QueryRecorder of the current thread, if there is one.
+The start and end functions hook this into the website algorithm, so that
+every request gets its own recorder, and the totals are logged (if
+LOG_METRICS is set) and sent to admins in a Server-Timing header.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import heapq
+import threading
+import time
+from collections import namedtuple
+
+from postgres.cursors import SimpleDictCursor, SimpleNamedTupleCursor, SimpleTupleCursor
+
+
+NSLOWEST = 3            # how many statements to keep per request
+SQL_EXCERPT = 200       # how much of a slow statement to log [characters]
+
+_local = threading.local()
+
+
+class QueryRecorder(object):
+    """Count the statements run in a request, their total time, and keep the
+    slowest few.
+    """
+
+    def __init__(self, nslowest=NSLOWEST):
+        self.nslowest = nslowest
+        self.count = 0
+        self.total_time = 0.0   # seconds
+        self._slowest = []      # a heap of (elapsed, sql)
+
+    def record(self, sql, elapsed):
+        self.count += 1
+        self.total_time += elapsed
+        if len(self._slowest) < self.nslowest:
+            heapq.heappush(self._slowest, (elapsed, sql))
+        elif elapsed > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (elapsed, sql))
+
+    @property
+    def slowest(self):
+        """A list of (elapsed, sql) tuples, slowest first.
+        """
+        return sorted(self._slowest, reverse=True)
+
+
+def get_recorder():
+    """Return the QueryRecorder for the current thread, or None.
+    """
+    return getattr(_local, 'recorder', None)
+
+
+class RecordingCursorMixin(object):
+
+    def execute(self, sql, parameters=None):
+        recorder = get_recorder()
+        if recorder is None:
+            return super(RecordingCursorMixin, self).execute(sql, parameters)
+        start = time.time()
+        try:
+            return super(RecordingCursorMixin, self).execute(sql, parameters)
+        finally:
+            recorder.record(sql, time.time() - start)
+
+
+class RecordingTupleCursor(RecordingCursorMixin, SimpleTupleCursor): pass
+class RecordingNamedTupleCursor(RecordingCursorMixin, SimpleNamedTupleCursor): pass
+class RecordingDictCursor(RecordingCursorMixin, SimpleDictCursor): pass
+
+CURSOR_FACTORIES = { tuple: RecordingTupleCursor
+                   , 'tuple': RecordingTupleCursor
+                   , namedtuple: RecordingNamedTupleCursor
+                   , 'namedtuple': RecordingNamedTupleCursor
+                   , dict: RecordingDictCursor
+                   , 'dict': RecordingDictCursor
+                    }
+
+
+# algorithm functions
+
+def start():
+    _local.recorder = recorder = QueryRecorder()
+    return {'query_recorder': recorder}
+
+
+def end(query_recorder, website, response=None, user=None):
+    _local.recorder = None
+    total_ms = query_recorder.total_time * 1000
+    if website.log_metrics:
+        print("measure#db.queries={}".format(query_recorder.count))
+        print("measure#db.time={}ms".format(total_ms))
+        for elapsed, sql in query_recorder.slowest:
+            if isinstance(sql, bytes):
+                sql = sql.decode('utf8', 'replace')
+            sql = ' '.join(sql.split())[:SQL_EXCERPT]
+            line = "measure#db.slow_query={}ms sql=\"{}\"".format(elapsed * 1000, sql)
+            print(line.encode('utf8'))
+    if response is not None and user is not None and user.ADMIN:
+        response.headers[b'Server-Timing'] = b'db;dur=%.1f;desc="%i queries"' \
+                                           % (total_ms, query_recorder.count)
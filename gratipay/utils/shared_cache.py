@@ -0,0 +1,230 @@
+"""Backends that let the QueryCaches of several processes share results.
+
+Each gunicorn worker has its own QueryCache. Give them all the same shared
+backend and a result is computed once per host instead of once per worker:
+on a local miss QueryCache takes the backend's lock for the key, uses the
+backend's value if it's fresh enough, and otherwise runs the query and stores
+the result in the backend for the other workers.
+
+Values are stored with the ttl they were fetched for, and QueryCache's pruner
+calls the backend's prune to delete the ones that have expired, along with
+their locks.
+
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import cPickle
+import fcntl
+import os
+import threading
+import time
+from collections import defaultdict, namedtuple
+from contextlib import contextmanager
+from hashlib import sha1
+from tempfile import mkstemp
+
+from aspen import log
+
+
+class MemoryBackend(object):
+    """Keep shared values in this process.
+
+    This is a stand-in for FileBackend in tests, and a way to share results
+    between several QueryCaches in one process.
+
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.expiries = {}
+        self.key_locks = defaultdict(threading.Lock)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return a (timestamp, value) tuple for key, or None.
+        """
+        return self.values.get(key)
+
+    def set(self, key, timestamp, value, ttl):
+        self.values[key] = (timestamp, value)
+        self.expiries[key] = timestamp + ttl
+
+    @contextmanager
+    def lock(self, key):
+        with self._lock:
+            key_lock = self.key_locks[key]
+        with key_lock:
+            yield
+
+    def prune(self):
+        """Delete the values that have expired, and the locks that aren't held.
+        """
+        now = time.time()
+        with self._lock:
+            for key, expiry in self.expiries.items():
+                if expiry <= now:
+                    self.values.pop(key, None)
+                    del self.expiries[key]
+            for key, key_lock in self.key_locks.items():
+                if key not in self.values and key_lock.acquire(False):
+                    del self.key_locks[key]
+                    key_lock.release()
+
+    def clear(self):
+        self.values.clear()
+        self.expiries.clear()
+
+
+class _Row(object):
+    """Stand in for a namedtuple row in a pickle.
+
+    The rows that postgres.py returns are namedtuples of a class made on the
+    fly, which doesn't pickle, so we store their fields and values and make
+    them back into namedtuples when they're loaded.
+
+    """
+
+    def __init__(self, fields, values):
+        self.fields = fields
+        self.values = values
+
+
+_row_types = {}
+
+
+def _freeze(obj):
+    if isinstance(obj, tuple) and hasattr(obj, '_fields'):
+        return _Row(obj._fields, tuple(_freeze(v) for v in obj))
+    elif isinstance(obj, tuple):
+        return tuple(_freeze(v) for v in obj)
+    elif isinstance(obj, list):
+        return [_freeze(v) for v in obj]
+    elif isinstance(obj, dict):
+        return {k: _freeze(v) for k, v in obj.iteritems()}
+    return obj
+
+
+def _thaw(obj):
+    if isinstance(obj, _Row):
+        row_type = _row_types.get(obj.fields)
+        if row_type is None:
+            row_type = _row_types.setdefault(obj.fields, namedtuple('Record', obj.fields))
+        return row_type(*(_thaw(v) for v in obj.values))
+    elif isinstance(obj, tuple):
+        return tuple(_thaw(v) for v in obj)
+    elif isinstance(obj, list):
+        return [_thaw(v) for v in obj]
+    elif isinstance(obj, dict):
+        return {k: _thaw(v) for k, v in obj.iteritems()}
+    return obj
+
+
+class FileBackend(object):
+    """Keep shared values in pickle files under a directory.
+
+    The directory should be on a tmpfs such as /dev/shm, so the files live in
+    memory that's shared between processes. Writes go to a temporary file that
+    is renamed into place, so readers never see half a value, and locks are
+    flock(2)s on a sibling lock file. Values that can't be pickled even so are
+    logged and kept local.
+
+    A value file's mtime is set to its expiry, so prune can tell which ones
+    have expired without reading them.
+
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                if not os.path.isdir(directory):  # another worker beat us to it
+                    raise
+
+    def _path(self, key):
+        return os.path.join(self.directory, sha1(repr(key)).hexdigest())
+
+    def get(self, key):
+        """Return a (timestamp, value) tuple for key, or None.
+        """
+        try:
+            with open(self._path(key), 'rb') as f:
+                stored_key, timestamp, value = cPickle.load(f)
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        return timestamp, _thaw(value)
+
+    def set(self, key, timestamp, value, ttl):
+        try:
+            data = cPickle.dumps((key, timestamp, _freeze(value)), cPickle.HIGHEST_PROTOCOL)
+        except (cPickle.PicklingError, TypeError) as e:
+            log("Can't share a QueryCache result, keeping it local: %s" % e)
+            return
+        fd, tmp = mkstemp(dir=self.directory, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            expiry = timestamp + ttl
+            os.utime(tmp, (expiry, expiry))
+            os.rename(tmp, self._path(key))
+        except:
+            os.unlink(tmp)
+            raise
+
+    @contextmanager
+    def lock(self, key):
+        with open(self._path(key) + '.lock', 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def prune(self):
+        """Delete the values that have expired, and the lock files of keys that
+        have no value and whose lock isn't held.
+
+        Several processes may prune at once, so files that are already gone
+        are skipped. A process that opened a lock file just before we deleted
+        it may run a query that another process is running too, which is
+        harmless.
+
+        """
+        now = time.time()
+        names = os.listdir(self.directory)
+        for name in names:
+            if name.endswith('.lock'):
+                continue
+            path = os.path.join(self.directory, name)
+            # A temporary file is either being written (and renamed in a
+            # moment) or left over from a crash.
+            cutoff = now - 3600 if name.startswith('.tmp-') else now
+            try:
+                if os.stat(path).st_mtime <= cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
+        for name in names:
+            if not name.endswith('.lock'):
+                continue
+            path = os.path.join(self.directory, name)
+            if os.path.exists(path[:-len('.lock')]):
+                continue
+            try:
+                with open(path, 'a') as f:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    os.unlink(path)
+            except (IOError, OSError):
+                pass  # held, or already gone
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith('.lock'):
+                continue
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
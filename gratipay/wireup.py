@@ -17,6 +17,7 @@ import balanced
 import braintree
 import gratipay
 import gratipay.billing.payday
+from gratipay.billing.processor import ProcessorExecutor
 import raven
 import mandrill
 from environment import Environment, is_yesish
@@ -35,8 +36,10 @@ from gratipay.models.exchange_route import ExchangeRoute
 from gratipay.models.participant import Participant
 from gratipay.models.team import Team
 from gratipay.models import GratipayDB
-from gratipay.utils.emails import compile_email_spt
+from gratipay.utils.emails import RateLimiter, compile_email_spt, read_email_spt
 from gratipay.utils.http_caching import asset_etag
+from gratipay.utils.query_cache import QueryCache
+from gratipay.utils.shared_cache import FileBackend
 from gratipay.utils.i18n import (
     ALIASES, ALIASES_R, COUNTRIES, LANGUAGES_2, LOCALES,
     get_function_from_rule, make_sorted_dict
@@ -51,7 +54,11 @@ def secure_cookies(env):
 def db(env):
     dburl = env.database_url
     maxconn = env.database_maxconn
-    db = GratipayDB(dburl, maxconn=maxconn)
+    db = GratipayDB( dburl
+                   , maxconn=maxconn
+                   , max_streams=env.database_max_streams
+                   , stream_timeout=env.database_stream_timeout
+                    )
 
     for model in (AccountElsewhere, Community, ExchangeRoute, Participant, Team):
         db.register_model(model)
@@ -59,14 +66,29 @@ def db(env):
 
     return db
 
+def query_cache(db, env):
+    shared = None
+    if env.query_cache_shared_dir:
+        shared = FileBackend(env.query_cache_shared_dir)
+    return QueryCache( db
+                     , max_entries=env.query_cache_max_entries
+                     , max_bytes=env.query_cache_max_bytes
+                     , serve_stale=env.query_cache_serve_stale
+                     , shared=shared
+                      )
+
 def mail(env, project_root='.'):
     Participant._mailer = mandrill.Mandrill(env.mandrill_key)
+    Participant._email_rate_limiter = RateLimiter(env.emails_per_minute)
     emails = {}
     emails_dir = project_root+'/emails/'
     i = len(emails_dir)
+    base = read_email_spt(emails_dir+'base.spt')
     for spt in find_files(emails_dir, '*.spt'):
         base_name = spt[i:-4]
-        emails[base_name] = compile_email_spt(spt)
+        if base_name == 'base':
+            continue
+        emails[base_name] = compile_email_spt(spt, base)
     Participant._emails = emails
 
 def billing(env):
@@ -84,6 +106,11 @@ def billing(env):
         env.braintree_private_key
     )
 
+    gratipay.billing.payday.Payday.processor = ProcessorExecutor(
+        concurrency=env.braintree_concurrency,
+        rate=env.braintree_rate_limit,
+    )
+
 
 def team_review(env):
     Team.review_repo = env.team_review_repo
@@ -365,6 +392,8 @@ def env():
         BASE_URL                        = unicode,
         DATABASE_URL                    = unicode,
         DATABASE_MAXCONN                = int,
+        DATABASE_MAX_STREAMS            = int,
+        DATABASE_STREAM_TIMEOUT         = int,
         GRATIPAY_ASSET_URL              = unicode,
         GRATIPAY_CACHE_STATIC           = is_yesish,
         GRATIPAY_COMPRESS_ASSETS        = is_yesish,
@@ -373,6 +402,8 @@ def env():
         BRAINTREE_MERCHANT_ID           = unicode,
         BRAINTREE_PUBLIC_KEY            = unicode,
         BRAINTREE_PRIVATE_KEY           = unicode,
+        BRAINTREE_CONCURRENCY           = int,
+        BRAINTREE_RATE_LIMIT            = float,
         GITHUB_CLIENT_ID                = unicode,
         GITHUB_CLIENT_SECRET            = unicode,
         GITHUB_CALLBACK                 = unicode,
@@ -402,7 +433,14 @@ def env():
         OPENSTREETMAP_AUTH_URL          = unicode,
         UPDATE_CTA_EVERY                = int,
         CHECK_DB_EVERY                  = int,
+        FULL_CHECK_DB_EVERY             = int,
+        RECOMPUTE_COUNTERS_EVERY        = int,
+        QUERY_CACHE_MAX_ENTRIES         = int,
+        QUERY_CACHE_MAX_BYTES           = int,
+        QUERY_CACHE_SERVE_STALE         = is_yesish,
+        QUERY_CACHE_SHARED_DIR          = unicode,
         DEQUEUE_EMAILS_EVERY            = int,
+        EMAILS_PER_MINUTE               = int,
         OPTIMIZELY_ID                   = unicode,
         SENTRY_DSN                      = unicode,
         LOG_METRICS                     = is_yesish,
@@ -412,6 +450,7 @@ def env():
         TEAM_REVIEW_USERNAME            = unicode,
         TEAM_REVIEW_TOKEN               = unicode,
         RAISE_SIGNIN_NOTIFICATIONS      = is_yesish,
+        PAYIN_ENGINE                    = unicode,
 
         # This is used in our Procfile. (PORT is also used but is provided by
         # Heroku; we don't set it ourselves in our app config.)
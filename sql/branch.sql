@@ -0,0 +1,136 @@
+-- payday_metrics - how long each stage of each payday took, and how much it did
+BEGIN;
+    CREATE TABLE payday_metrics
+    ( id                    serial                      PRIMARY KEY
+    , payday                int                         NOT NULL REFERENCES paydays
+                                                            ON UPDATE RESTRICT ON DELETE RESTRICT
+    , stage                 text                        NOT NULL
+    , ts                    timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+    , wall_time             double precision            NOT NULL -- seconds
+    , db_time               double precision            NOT NULL -- seconds
+    , nrows                 bigint                      NOT NULL
+    , nprocessor_calls      integer                     NOT NULL
+    , UNIQUE (payday, stage)
+     );
+END;
+
+-- ledger checkpoints - running totals that let check_db look at new rows only
+BEGIN;
+    CREATE TABLE ledger_checkpoints
+    ( id                    serial                      PRIMARY KEY
+    , ts                    timestamp with time zone    NOT NULL DEFAULT CURRENT_TIMESTAMP
+    , last_exchange_id      integer                     NOT NULL
+    , last_transfer_id      integer                     NOT NULL
+    , last_payment_id       bigint                      NOT NULL
+     );
+
+    CREATE TABLE ledger_participant_totals
+    ( participant           text                        PRIMARY KEY REFERENCES participants
+                                                            ON UPDATE CASCADE ON DELETE RESTRICT
+    , total                 numeric(35,2)               NOT NULL
+     );
+
+    CREATE TABLE ledger_team_totals
+    ( team                  text                        PRIMARY KEY REFERENCES teams
+                                                            ON UPDATE CASCADE ON DELETE RESTRICT
+    , total                 numeric(35,2)               NOT NULL
+     );
+END;
+
+-- composite indexes for the history pages, which query a participant's ledger
+-- rows by timestamp range
+BEGIN;
+    CREATE INDEX exchanges_participant_timestamp_idx ON exchanges (participant, timestamp);
+    CREATE INDEX payments_participant_timestamp_idx ON payments (participant, timestamp);
+    CREATE INDEX transfers_tipper_timestamp_idx ON transfers (tipper, timestamp);
+    CREATE INDEX transfers_tippee_timestamp_idx ON transfers (tippee, timestamp);
+
+    -- superseded by the composite indexes above
+    DROP INDEX transfers_tipper_idx;
+    DROP INDEX transfers_tippee_idx;
+END;
+
+-- per-payday receipts of each team, for %team/charts.json
+BEGIN;
+    CREATE TABLE payday_team_stats
+    ( payday                int                         NOT NULL REFERENCES paydays
+                                                            ON UPDATE RESTRICT ON DELETE RESTRICT
+    , team                  text                        NOT NULL REFERENCES teams
+                                                            ON UPDATE CASCADE ON DELETE RESTRICT
+    , npatrons              int                         NOT NULL
+    , receipts              numeric(35,2)               NOT NULL
+    , PRIMARY KEY (team, payday)
+     );
+
+    INSERT INTO payday_team_stats
+                (payday, team, npatrons, receipts)
+         SELECT payday, team, count(DISTINCT participant), sum(amount)
+           FROM payments
+          WHERE direction = 'to-team'
+            AND payday IS NOT NULL
+       GROUP BY payday, team;
+END;
+
+-- the current_* views over append-only logs become projections, tables that
+-- triggers keep up to date with the latest row for each key
+\i sql/create_projection.sql
+BEGIN;
+    DROP VIEW current_payment_instructions;
+    DROP FUNCTION update_payment_instruction();
+    SELECT create_projection( 'payment_instructions', 'current_payment_instructions'
+                            , '{participant,team}', '{mtime,id}'
+                             );
+    CREATE INDEX current_payment_instructions_team_idx ON current_payment_instructions (team);
+
+    DROP VIEW current_tips;
+    DROP FUNCTION update_tip();
+    SELECT create_projection('tips', 'current_tips', '{tipper,tippee}', '{mtime,id}');
+    CREATE INDEX current_tips_tippee_idx ON current_tips (tippee);
+
+    -- current_takes also hides zero takes and suspicious accounts, so it stays
+    -- a view, over the latest takes
+    DROP VIEW current_takes;
+    SELECT create_projection('takes', 'latest_takes', '{member,team}', '{mtime,id}');
+    CREATE INDEX latest_takes_team_idx ON latest_takes (team);
+    CREATE VIEW current_takes AS
+        SELECT t.*
+          FROM latest_takes t
+          JOIN participants p1 ON p1.username = t.member
+          JOIN participants p2 ON p2.username = t.team
+         WHERE p1.is_suspicious IS NOT TRUE
+           AND p2.is_suspicious IS NOT TRUE
+           AND t.amount > 0;
+
+    DROP CAST (current_exchange_routes AS exchange_routes);
+    DROP VIEW current_exchange_routes;
+    SELECT create_projection( 'exchange_routes', 'current_exchange_routes'
+                            , '{participant,network}', '{id}'
+                             );
+    CREATE CAST (current_exchange_routes AS exchange_routes) WITH INOUT;
+
+    -- community_members had nothing to break ties between rows with the
+    -- same mtime
+    ALTER TABLE community_members ADD COLUMN id bigserial PRIMARY KEY;
+    DROP VIEW current_community_members;
+    SELECT create_projection( 'community_members', 'current_community_members'
+                            , '{participant,slug}', '{mtime,id}'
+                             );
+    CREATE INDEX current_community_members_slug_idx ON current_community_members (slug);
+END;
+
+BEGIN;
+    -- Queued emails are claimed by a worker until this time
+    ALTER TABLE email_queue ADD COLUMN claimed_until timestamptz;
+END;
+
+BEGIN;
+    -- The format of email_queue.context: 1 is a pickle, 2 is JSON
+    ALTER TABLE email_queue ADD COLUMN context_version smallint NOT NULL DEFAULT 1;
+    ALTER TABLE email_queue ALTER COLUMN context_version DROP DEFAULT;
+END;
+
+-- balances_at rows were written without payments, which snapshot_balances now
+-- counts; drop them so the next snapshot rebuilds every year consistently
+BEGIN;
+    DELETE FROM balances_at;
+END;
@@ -0,0 +1,138 @@
+-- Keep a table with the latest row of an append-only log for each key.
+--
+--     SELECT create_projection('tips', 'current_tips', '{tipper,tippee}', '{mtime,id}');
+--
+-- creates the table current_tips with the same columns as tips, fills it with
+-- the latest row of tips for each (tipper, tippee), ordered by (mtime, id), and
+-- adds the triggers that keep it in step with the log in the same transaction:
+--
+--  - a row inserted into the log replaces the current one for its key, unless
+--    it's older, even if the first two rows for a key are inserted at once;
+--  - deleting the current row from the log promotes the one before it;
+--  - updating the current row in the log updates the projection, and updating
+--    the projection updates the log, so columns like is_funded can be set on
+--    either side.
+--
+-- The log must have an id column. The same definitions are listed in
+-- gratipay.models.PROJECTIONS, which check_db uses to verify the projections.
+
+CREATE OR REPLACE FUNCTION create_projection(log_table text, projection text, key text[], order_by text[])
+RETURNS void AS $create$
+    DECLARE
+        cols text;          -- a, b, c
+        new_cols text;      -- NEW.a, NEW.b, NEW.c
+        cur_cols text;      -- cur.a, cur.b, cur.c
+        key_cols text;      -- a, b
+        new_key text;       -- cur.a = NEW.a AND cur.b = NEW.b
+        old_key text;       -- a = OLD.a AND b = OLD.b
+        latest_first text;  -- c DESC, id DESC
+        new_order text;     -- NEW.c, NEW.id
+        cur_order text;     -- cur.c, cur.id
+        sync text;          -- the body of the functions that copy updates
+    BEGIN
+        SELECT string_agg(quote_ident(attname), ', ' ORDER BY attnum)
+             , string_agg('NEW.' || quote_ident(attname), ', ' ORDER BY attnum)
+             , string_agg('cur.' || quote_ident(attname), ', ' ORDER BY attnum)
+          INTO cols, new_cols, cur_cols
+          FROM pg_attribute
+         WHERE attrelid = log_table::regclass
+           AND attnum > 0
+           AND NOT attisdropped;
+
+        SELECT string_agg(quote_ident(key[i]), ', ' ORDER BY i)
+             , string_agg(format('cur.%1$I = NEW.%1$I', key[i]), ' AND ' ORDER BY i)
+             , string_agg(format('%1$I = OLD.%1$I', key[i]), ' AND ' ORDER BY i)
+          INTO key_cols, new_key, old_key
+          FROM generate_subscripts(key, 1) i;
+
+        SELECT string_agg(quote_ident(order_by[i]) || ' DESC', ', ' ORDER BY i)
+             , string_agg('NEW.' || quote_ident(order_by[i]), ', ' ORDER BY i)
+             , string_agg('cur.' || quote_ident(order_by[i]), ', ' ORDER BY i)
+          INTO latest_first, new_order, cur_order
+          FROM generate_subscripts(order_by, 1) i;
+
+        EXECUTE format( 'CREATE TABLE %I (LIKE %I, PRIMARY KEY (%s), UNIQUE (id))'
+                      , projection, log_table, key_cols
+                       );
+        EXECUTE format( 'INSERT INTO %I SELECT DISTINCT ON (%s) * FROM %I ORDER BY %s, %s'
+                      , projection, key_cols, log_table, key_cols, latest_first
+                       );
+
+        EXECUTE format($f$
+            CREATE FUNCTION %1$I() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE %2$I cur
+                       SET (%3$s) = (%4$s)
+                     WHERE %5$s
+                       AND (%6$s) < (%7$s);
+                    IF NOT FOUND THEN
+                        BEGIN
+                            INSERT INTO %2$I
+                                 SELECT NEW.*
+                                  WHERE NOT EXISTS (SELECT 1 FROM %2$I cur WHERE %5$s);
+                        EXCEPTION WHEN unique_violation THEN
+                            -- Another transaction inserted the first row for
+                            -- this key since we looked; it's committed now.
+                            UPDATE %2$I cur
+                               SET (%3$s) = (%4$s)
+                             WHERE %5$s
+                               AND (%6$s) < (%7$s);
+                        END;
+                    END IF;
+                    RETURN NULL;
+                END;
+            $$ LANGUAGE plpgsql
+        $f$, projection || '_on_insert', projection, cols, new_cols, new_key, cur_order, new_order);
+
+        EXECUTE format($f$
+            CREATE FUNCTION %1$I() RETURNS trigger AS $$
+                BEGIN
+                    DELETE FROM %2$I WHERE id = OLD.id;
+                    IF FOUND THEN
+                        INSERT INTO %2$I
+                             SELECT *
+                               FROM %3$I
+                              WHERE %4$s
+                           ORDER BY %5$s
+                              LIMIT 1;
+                    END IF;
+                    RETURN NULL;
+                END;
+            $$ LANGUAGE plpgsql
+        $f$, projection || '_on_delete', projection, log_table, old_key, latest_first);
+
+        -- The IS DISTINCT FROM stops the updates from bouncing back and forth.
+        sync := $f$
+            CREATE FUNCTION %1$I() RETURNS trigger AS $$
+                BEGIN
+                    UPDATE %2$I cur
+                       SET (%3$s) = (%4$s)
+                     WHERE cur.id = NEW.id
+                       AND (%5$s) IS DISTINCT FROM (%4$s);
+                    RETURN NULL;
+                END;
+            $$ LANGUAGE plpgsql
+        $f$;
+        EXECUTE format(sync, projection || '_from_log', projection, cols, new_cols, cur_cols);
+        EXECUTE format(sync, projection || '_to_log', log_table, cols, new_cols, cur_cols);
+
+        EXECUTE format( 'CREATE TRIGGER %1$I AFTER INSERT ON %2$I '
+                        'FOR EACH ROW EXECUTE PROCEDURE %1$I()'
+                      , projection || '_on_insert', log_table
+                       );
+        EXECUTE format( 'CREATE TRIGGER %1$I AFTER DELETE ON %2$I '
+                        'FOR EACH ROW EXECUTE PROCEDURE %1$I()'
+                      , projection || '_on_delete', log_table
+                       );
+        EXECUTE format( 'CREATE TRIGGER %1$I AFTER UPDATE ON %2$I '
+                        'FOR EACH ROW EXECUTE PROCEDURE %1$I()'
+                      , projection || '_from_log', log_table
+                       );
+        -- When the insert trigger replaces the current row the id changes, and
+        -- that's not an update to copy back to the log.
+        EXECUTE format( 'CREATE TRIGGER %1$I AFTER UPDATE ON %2$I '
+                        'FOR EACH ROW WHEN (OLD.id = NEW.id) EXECUTE PROCEDURE %1$I()'
+                      , projection || '_to_log', projection
+                       );
+    END;
+$create$ LANGUAGE plpgsql;
@@ -56,6 +56,10 @@ CREATE TABLE payday_payments_done AS
 DROP TABLE IF EXISTS payday_payment_instructions;
 CREATE TABLE payday_payment_instructions AS
     SELECT s.id, participant, team, amount, due
+         , row_number() OVER (ORDER BY p.claimed_time ASC, s.ctime ASC, s.id ASC) AS ord
+         , row_number() OVER ( PARTITION BY s.participant
+                                   ORDER BY p.claimed_time ASC, s.ctime ASC, s.id ASC
+                              ) AS nth
       FROM ( SELECT DISTINCT ON (participant, team) *
                FROM payment_instructions
               WHERE mtime < %(ts_start)s
@@ -70,9 +74,10 @@ CREATE TABLE payday_payment_instructions AS
                 AND s.team = done.team
                 AND direction = 'to-team'
            ) IS NULL
-  ORDER BY p.claimed_time ASC, s.ctime ASC;
+  ORDER BY p.claimed_time ASC, s.ctime ASC, s.id ASC;
 
 CREATE INDEX ON payday_payment_instructions (participant);
+CREATE UNIQUE INDEX ON payday_payment_instructions (participant, nth);
 CREATE INDEX ON payday_payment_instructions (team);
 ALTER TABLE payday_payment_instructions ADD COLUMN is_funded boolean;
 
@@ -202,6 +207,107 @@ CREATE TRIGGER process_payment_instruction BEFORE UPDATE OF is_funded ON payday_
     WHEN (NEW.is_funded IS true AND OLD.is_funded IS NOT true)
     EXECUTE PROCEDURE process_payment_instruction();
 
+-- Fund all payment_instructions in a few set-based statements. This is an
+-- alternative to the process_payment_instruction trigger above, and must have
+-- exactly the same effects. Each participant's instructions are walked in
+-- order (nth), carrying the remaining balance from one to the next, so that an
+-- instruction that doesn't fit is parked without blocking smaller ones after
+-- it. Everything is then written out in the global order (ord) that the
+-- trigger would have used.
+
+CREATE OR REPLACE FUNCTION fund_payment_instructions() RETURNS void AS $$
+    BEGIN
+        DROP TABLE IF EXISTS payday_funding;
+        CREATE TABLE payday_funding AS
+            WITH RECURSIVE funding AS (
+                SELECT i.id, i.ord, i.nth, i.participant, i.team
+                     , i.amount + i.due AS cost
+                     , p.new_balance::numeric AS balance
+                     , p.card_hold_ok
+                  FROM payday_payment_instructions i
+                  JOIN payday_participants p ON p.username = i.participant
+                 WHERE i.nth = 1
+             UNION ALL
+                SELECT i.id, i.ord, i.nth, i.participant, i.team
+                     , i.amount + i.due AS cost
+                     , CASE WHEN (f.cost <= f.balance OR f.card_hold_ok)
+                            THEN f.balance - f.cost
+                            ELSE f.balance
+                        END AS balance
+                     , f.card_hold_ok
+                  FROM funding f
+                  JOIN payday_payment_instructions i ON i.participant = f.participant
+                                                    AND i.nth = f.nth + 1
+            )
+            SELECT id, ord, participant, team, cost
+                 , COALESCE(cost <= balance OR card_hold_ok, false) AS is_funded
+              FROM funding;
+
+        UPDATE payday_participants p
+           SET new_balance = (new_balance - f.paid)
+          FROM ( SELECT participant, sum(cost) AS paid
+                   FROM payday_funding
+                  WHERE is_funded AND cost <> 0
+               GROUP BY participant
+               ) f
+         WHERE p.username = f.participant;
+
+        UPDATE payday_teams t
+           SET balance = (balance + f.received)
+          FROM ( SELECT team, sum(cost) AS received
+                   FROM payday_funding
+                  WHERE is_funded AND cost <> 0
+               GROUP BY team
+               ) f
+         WHERE t.slug = f.team;
+
+        UPDATE payment_instructions pi
+           SET due = (CASE WHEN f.is_funded THEN 0 ELSE f.cost END)
+          FROM current_payment_instructions c
+          JOIN payday_funding f ON f.participant = c.participant AND f.team = c.team
+         WHERE pi.id = c.id
+           AND f.cost <> 0
+           AND (f.is_funded IS false OR c.due > 0);
+
+        INSERT INTO events (type, payload)
+            SELECT 'payday'
+                 , ( CASE WHEN is_funded
+                          THEN '{"action":"pay","participant":"' || participant || '", "team":"'
+                               || team || '", "amount":' || cost || '}'
+                          ELSE '{"action":"due","participant":"' || participant || '", "team":"'
+                               || team || '", "due":' || cost || '}'
+                      END )::json
+              FROM payday_funding
+             WHERE cost <> 0
+          ORDER BY ord;
+
+        INSERT INTO payday_payments (participant, team, amount, direction)
+            SELECT ( SELECT p.username
+                       FROM participants p
+                       JOIN payday_participants p2 ON p.id = p2.id
+                      WHERE p2.username = f.participant )
+                 , ( SELECT t.slug
+                       FROM teams t
+                       JOIN payday_teams t2 ON t.id = t2.id
+                      WHERE t2.slug = f.team )
+                 , f.cost
+                 , 'to-team'
+              FROM payday_funding f
+             WHERE f.is_funded AND f.cost <> 0
+          ORDER BY f.ord;
+
+        -- Mark funded rows the way the trigger would, without firing it.
+        ALTER TABLE payday_payment_instructions DISABLE TRIGGER process_payment_instruction;
+        UPDATE payday_payment_instructions i
+           SET is_funded = true
+          FROM payday_funding f
+         WHERE f.id = i.id
+           AND f.is_funded;
+        ALTER TABLE payday_payment_instructions ENABLE TRIGGER process_payment_instruction;
+    END;
+$$ LANGUAGE plpgsql;
+
+
 -- Create a trigger to process takes
 
 CREATE OR REPLACE FUNCTION process_take() RETURNS trigger AS $$
@@ -2,6 +2,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 
 from decimal import Decimal as D
 import os
+import random
 
 import balanced
 import braintree
@@ -9,12 +10,13 @@ import mock
 import pytest
 
 from gratipay.billing.exchanges import create_card_hold, MINIMUM_CHARGE
-from gratipay.billing.payday import NoPayday, Payday
+from gratipay.billing.payday import NoPayday, Payday, UnknownPayinEngine
 from gratipay.exceptions import NegativeBalance
 from gratipay.models.participant import Participant
-from gratipay.testing import Foobar
+from gratipay.testing import Foobar, Harness
 from gratipay.testing.billing import BillingHarness
 from gratipay.testing.emails import EmailHarness
+from gratipay.utils import emails
 
 
 class TestPayday(BillingHarness):
@@ -214,6 +216,44 @@ class TestPayday(BillingHarness):
         for args, _ in log.call_args_list:
             assert args[0] == expected_logging_call_args.pop()
 
+    @mock.patch.object(Payday, 'fetch_card_holds')
+    def test_payday_records_stage_metrics(self, fch):
+        Enterprise = self.make_team(is_approved=True)
+        self.obama.set_payment_instruction(Enterprise, '6.00')
+        fch.return_value = {}
+        payday = Payday.start()
+        payday.run()
+
+        stages = self.db.all("""
+            SELECT stage FROM payday_metrics WHERE payday=%s ORDER BY id
+        """, (payday.id,))
+        assert stages == [ 'prepare', 'create_card_holds', 'process_payment_instructions'
+                         , 'process_draws', 'settle_card_holds', 'update_balances'
+                         , 'take_over_balances', 'update_stats', 'snapshot_balances'
+                         , 'notify_participants'
+                          ]
+        metrics = self.db.one("""
+            SELECT * FROM payday_metrics WHERE payday=%s AND stage='create_card_holds'
+        """, (payday.id,))
+        assert metrics.wall_time >= metrics.db_time > 0
+        assert metrics.nrows == 1  # obama
+
+    def test_measure_counts_processor_calls(self):
+        payday = Payday.start()
+        with payday.measure('create_card_holds'):
+            payday.count_processor_call()
+            payday.count_processor_call()
+        assert self.db.one("SELECT nprocessor_calls FROM payday_metrics") == 2
+
+    def test_measure_records_metrics_in_the_stages_transaction(self):
+        payday = Payday.start()
+        with self.assertRaises(ZeroDivisionError):
+            with self.db.get_cursor() as cursor:
+                with payday.measure('prepare', cursor):
+                    pass
+                1/0
+        assert self.db.all("SELECT stage FROM payday_metrics") == []
+
     def test_end(self):
         Payday.start().end()
         result = self.db.one("SELECT count(*) FROM paydays "
@@ -522,6 +562,90 @@ class TestPayin(BillingHarness):
         assert filename.endswith('_payments.csv')
         os.unlink(filename)
 
+class TestPayinEngines(Harness):
+
+    def make_generated_data(self, seed):
+        rand = random.Random(seed)
+        teams = []
+        for i in range(4):
+            owner = self.make_participant('owner%i' % i, claimed_time='now', last_paypal_result='')
+            teams.append(self.make_team('Team %i' % i, owner, is_approved=True))
+        givers = []
+        for i in range(25):
+            balance = D(rand.randint(0, 3000)) / 100
+            giver = self.make_participant('giver%i' % i, claimed_time='now', balance=balance)
+            for team in rand.sample(teams, rand.randint(0, len(teams))):
+                giver.set_payment_instruction(team, D(rand.randint(1, 1500)) / 100)
+            givers.append(giver.username)
+        for pi_id in self.db.all("SELECT id FROM payment_instructions ORDER BY id"):
+            if rand.random() < 0.3:
+                due = D(rand.randint(1, 800)) / 100
+                self.db.run("UPDATE payment_instructions SET due=%s WHERE id=%s", (due, pi_id))
+        return tuple(rand.sample(givers, 5))
+
+    def run_engine(self, engine, holders):
+        payday = Payday.start()
+        payday.payin_engine = engine
+        with self.db.get_cursor() as cursor:
+            payday.prepare(cursor, payday.ts_start)
+            cursor.run("""
+                UPDATE payday_participants SET card_hold_ok = true WHERE username IN %s
+            """, (holders,))
+            payday.process_payment_instructions(cursor)
+            r = dict(
+                payments=cursor.all("""
+                    SELECT participant, team, amount, direction FROM payday_payments
+                """),
+                events=cursor.all("""
+                    SELECT payload::text FROM events WHERE type='payday' ORDER BY id
+                """),
+                dues=cursor.all("SELECT id, due FROM payment_instructions ORDER BY id"),
+                participants=cursor.all("""
+                    SELECT username, new_balance FROM payday_participants ORDER BY username
+                """),
+                teams=cursor.all("SELECT slug, balance FROM payday_teams ORDER BY slug"),
+                funded=cursor.all("""
+                    SELECT id FROM payday_payment_instructions WHERE is_funded ORDER BY id
+                """),
+            )
+            cursor.connection.rollback()
+        return r
+
+    def test_set_based_engine_matches_trigger_engine(self):
+        for seed in range(3):
+            self.clear_tables()
+            holders = self.make_generated_data(seed)
+            expected = self.run_engine('trigger', holders)
+            actual = self.run_engine('set-based', holders)
+            assert expected['events']  # sanity check
+            assert actual == expected
+
+    def test_set_based_engine_parks_without_blocking_smaller_instructions(self):
+        alice = self.make_participant('alice', claimed_time='now', balance=5)
+        picard = self.make_participant('picard', claimed_time='now', last_paypal_result='')
+        Enterprise = self.make_team('The Enterprise', picard, is_approved=True)
+        Trident = self.make_team('The Trident', picard, is_approved=True)
+        alice.set_payment_instruction(Enterprise, D('6.00'))
+        alice.set_payment_instruction(Trident, D('4.00'))
+
+        payday = Payday.start()
+        payday.payin_engine = 'set-based'
+        with self.db.get_cursor() as cursor:
+            payday.prepare(cursor, payday.ts_start)
+            payday.process_payment_instructions(cursor)
+            payday.update_balances(cursor)
+
+        assert Participant.from_id(alice.id).balance == D('1.00')
+        assert alice.get_due('TheEnterprise') == D('6.00')
+        assert alice.get_due('TheTrident') == D('0.00')
+
+    def test_run_rejects_unknown_payin_engine(self):
+        payday = Payday.start()
+        payday.payin_engine = 'nope'
+        with self.assertRaises(UnknownPayinEngine):
+            payday.run()
+
+
 class TestNotifyParticipants(EmailHarness):
 
     def test_it_notifies_participants(self):
@@ -542,3 +666,38 @@ class TestNotifyParticipants(EmailHarness):
             Participant.dequeue_emails()
             assert self.get_last_email()['to'][0]['email'] == 'kalel@example.net'
             assert 'Gratiteam' in self.get_last_email()['text']
+
+    def test_it_notifies_everyone_charged_in_one_go(self):
+        team = self.make_team('Gratiteam', is_approved=True)
+        other = self.make_team('Othergood', is_approved=True)
+        unpaid = self.make_team('Unpaid', owner=self.make_participant('unpaid'), is_approved=True)
+        people = {}
+        for name, notify_charge in (('kalel', 3), ('zod', 1), ('lois', 2)):
+            p = people[name] = self.make_participant(name, claimed_time='now',
+                                                     email_address=name+'@example.net',
+                                                     notify_charge=notify_charge)
+            p.set_payment_instruction(team, 10)
+        people['kalel'].set_payment_instruction(other, 20)
+        people['kalel'].set_payment_instruction(unpaid, 30)
+
+        payday = Payday.start()
+        for name in ('kalel', 'zod', 'lois'):
+            self.make_exchange('balanced-cc', 10, 0, people[name], 'succeeded')
+        payday.end()
+        payday.notify_participants()
+
+        queued = self.db.all("""
+            SELECT p.username, q.spt_name, q.context, q.context_version
+              FROM email_queue q
+              JOIN participants p ON p.id = q.participant
+          ORDER BY p.username
+        """)
+        assert [(q.username, q.spt_name) for q in queued] == [ ('kalel', 'charge_succeeded')
+                                                             , ('lois', 'charge_succeeded')
+                                                              ]
+        kalel = emails.decode_context(queued[0].context_version, queued[0].context)
+        assert kalel['nteams'] == 2
+        assert kalel['top_team'] == 'Othergood'
+        assert kalel['exchange']['amount'] == D('10.00')
+        lois = emails.decode_context(queued[1].context_version, queued[1].context)
+        assert (lois['nteams'], lois['top_team']) == (1, 'Gratiteam')
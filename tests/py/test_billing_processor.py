@@ -0,0 +1,146 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import time
+
+import braintree
+import mock
+
+from gratipay.billing.exchanges import MINIMUM_CHARGE
+from gratipay.billing.payday import Payday
+from gratipay.billing.processor import ProcessorExecutor, TokenBucket
+from gratipay.testing import Foobar, Harness
+from gratipay.testing.billing import BillingHarness, FakeBraintree
+
+
+class TestProcessorExecutor(Harness):
+
+    def test_map_returns_results_in_order(self):
+        batch = ProcessorExecutor().map(lambda x: x * 2, [1, 2, 3])
+        assert batch.results == [2, 4, 6]
+        assert batch.errors == []
+
+    def test_map_collects_errors_without_aborting_the_batch(self):
+        def f(x):
+            if x == 2:
+                raise Foobar
+            return x
+        batch = ProcessorExecutor().map(f, [1, 2, 3])
+        assert batch.results == [1, None, 3]
+        assert [e.item for e in batch.errors] == [2]
+        assert isinstance(batch.errors[0].exception, Foobar)
+        with self.assertRaises(Foobar):
+            batch.raise_first_error()
+
+    def test_call_retries_transient_errors_with_backoff(self):
+        sleep = mock.Mock()
+        f = mock.Mock(side_effect=[braintree.exceptions.DownForMaintenanceError, 'ok'])
+        executor = ProcessorExecutor(backoff=0.5, sleep=sleep)
+        assert executor.call(f) == 'ok'
+        assert f.call_count == 2
+        sleep.assert_called_once_with(0.5)
+
+    def test_call_gives_up_after_so_many_retries(self):
+        sleep = mock.Mock()
+        f = mock.Mock(side_effect=braintree.exceptions.DownForMaintenanceError)
+        executor = ProcessorExecutor(retries=2, backoff=1, sleep=sleep)
+        with self.assertRaises(braintree.exceptions.DownForMaintenanceError):
+            executor.call(f)
+        assert f.call_count == 3
+        assert [c[0][0] for c in sleep.call_args_list] == [1, 2]
+
+    def test_call_doesnt_retry_other_errors(self):
+        f = mock.Mock(side_effect=Foobar)
+        with self.assertRaises(Foobar):
+            ProcessorExecutor(sleep=mock.Mock()).call(f)
+        assert f.call_count == 1
+
+    def test_token_bucket_limits_rate(self):
+        now = [0.0]
+        def sleep(seconds):
+            now[0] += seconds
+        bucket = TokenBucket(rate=10, burst=1, clock=lambda: now[0], sleep=sleep)
+        for i in range(5):
+            bucket.take()
+        assert abs(now[0] - 0.4) < 1e-9
+
+    def test_map_runs_calls_concurrently(self):
+        fake = FakeBraintree(latency=0.05)
+        executor = ProcessorExecutor(concurrency=10)
+        start = time.time()
+        with fake.patch():
+            batch = executor.map(lambda i: braintree.Transaction.void(i), ['a']*20, retry_on=())
+        assert time.time() - start < 20 * 0.05 / 2
+        assert len(batch.errors) == 20  # KeyError, there's no such transaction
+        assert fake.calls['void'] == 20
+
+
+class TestPayinWithFakeBraintree(BillingHarness):
+
+    def test_payin_pays_in_through_fake_braintree(self):
+        team = self.make_team('Gratiteam', owner=self.homer, is_approved=True)
+        self.obama.set_payment_instruction(team, MINIMUM_CHARGE)
+
+        fake = FakeBraintree(latency=0.01)
+        with fake.patch():
+            Payday.start().payin()
+
+        assert fake.calls['sale'] == 1
+        assert fake.calls['submit_for_settlement'] == 1
+        payments = self.db.all("SELECT amount, direction FROM payments ORDER BY id")
+        assert payments == [(MINIMUM_CHARGE, 'to-team'), (MINIMUM_CHARGE, 'to-participant')]
+
+    def test_failed_capture_doesnt_stop_other_captures(self):
+        team = self.make_team('Gratiteam', owner=self.homer, is_approved=True)
+        self.obama.set_payment_instruction(team, MINIMUM_CHARGE)
+        alice = self.make_participant('alice', claimed_time='now', is_suspicious=False)
+        alice.set_payment_instruction(team, MINIMUM_CHARGE)
+
+        payday = Payday.start()
+        with self.db.get_cursor() as cursor:
+            payday.prepare(cursor, payday.ts_start)
+            participants = cursor.all("SELECT * FROM payday_participants WHERE username IN "
+                                      "('alice', 'obama') ORDER BY username")
+            cursor.run("UPDATE payday_participants SET new_balance = -10 "
+                       "WHERE username IN ('alice', 'obama')")
+            holds = {p.id: mock.Mock() for p in participants}
+            captured = []
+            def capture(db, p, amount, hold):
+                if p.username == 'alice':
+                    raise Foobar
+                captured.append(p.username)
+            with mock.patch('gratipay.billing.payday.capture_card_hold', capture):
+                with self.assertRaises(Foobar):
+                    payday.settle_card_holds(cursor, holds)
+        assert captured == ['obama']
+
+    def make_holds(self, fake, participant_ids):
+        with fake.patch():
+            return [ braintree.Transaction.sale({ 'amount': '10.00'
+                                                , 'custom_fields': {'participant_id': p_id}
+                                                , 'payment_method_token': 'foo'
+                                                 }).transaction
+                     for p_id in participant_ids
+                    ]
+
+    def test_fetch_card_holds_reuses_current_holds_and_cancels_stale_ones(self):
+        fake = FakeBraintree()
+        current, stale1, stale2 = self.make_holds(fake, [self.obama.id, 1000, 1001])
+        with fake.patch():
+            holds = Payday.start().fetch_card_holds(set([self.obama.id]))
+        assert holds == {self.obama.id: current}
+        assert current.status == 'authorized'
+        assert stale1.status == stale2.status == 'voided'
+
+    def test_fetch_card_holds_doesnt_wait_for_cancellations(self):
+        fake = FakeBraintree(latencies={'void': 0.2})
+        stale = self.make_holds(fake, range(1000, 1005))
+        payday = Payday.start()
+        cancellations = payday.processor.background(payday.cancel_card_hold)
+        with fake.patch():
+            start = time.time()
+            holds = payday.fetch_card_holds(set(), cancellations)
+            assert time.time() - start < 0.2
+            assert holds == {}
+            assert len(cancellations) == 5
+            payday.wait_for_cancellations(cancellations)
+        assert set(h.status for h in stale) == set(['voided'])
@@ -9,6 +9,7 @@ from mock import patch
 from aspen.utils import utcnow
 from gratipay.billing.payday import Payday
 from gratipay.testing import Harness
+from gratipay.testing.billing import BillingHarness, FakeBraintree
 
 def today():
     return datetime.datetime.utcnow().date().strftime('%Y-%m-%d')
@@ -172,3 +173,53 @@ class TestChartsJson(Harness):
         actual = json.loads(self.client.GET('/about/charts.json').body)[0]
 
         assert actual == expected
+
+
+class TestTeamChartsJson(BillingHarness):
+
+    def setUp(self):
+        BillingHarness.setUp(self)
+        self.team = self.make_team(is_approved=True)
+
+    def run_payday(self):
+        with FakeBraintree().patch():
+            Payday.start().run()
+
+    def get_charts(self, **kw):
+        return json.loads(self.client.GET('/TheEnterprise/charts.json', **kw).body)
+
+    def test_team_that_never_received_gets_empty_array(self):
+        self.run_payday()   # zeroth, ignored
+        self.run_payday()   # first
+        assert self.get_charts() == []
+
+    def test_paydays_come_through(self):
+        self.run_payday()   # zeroth, ignored
+        self.obama.set_payment_instruction(self.team, '10.00')
+        self.run_payday()   # first
+        self.obama.set_payment_instruction(self.team, '0.00')
+        self.run_payday()   # second
+
+        expected = [ {"date": today(), "npatrons": 0, "receipts": 0.00}
+                   , {"date": today(), "npatrons": 1, "receipts": 10.00}
+                    ]
+        assert self.get_charts() == expected
+
+    def test_update_stats_records_team_receipts(self):
+        self.obama.set_payment_instruction(self.team, '10.00')
+        self.run_payday()
+        stats = self.db.all("SELECT team, npatrons, receipts FROM payday_team_stats")
+        assert stats == [('TheEnterprise', 1, 10)]
+
+    def test_unchanged_data_gets_a_304(self):
+        self.obama.set_payment_instruction(self.team, '10.00')
+        self.run_payday()
+        self.run_payday()
+        etag = self.client.GET('/TheEnterprise/charts.json').headers['Etag']
+        response = self.client.GxT('/TheEnterprise/charts.json', HTTP_IF_NONE_MATCH=etag)
+        assert response.code == 304
+
+        self.run_payday()
+        response = self.client.GET('/TheEnterprise/charts.json', HTTP_IF_NONE_MATCH=etag)
+        assert response.code == 200
+        assert response.headers['Etag'] != etag
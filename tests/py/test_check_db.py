@@ -0,0 +1,205 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import threading
+from decimal import Decimal as D
+
+from gratipay.models import check_db, get_ledger_checkpoint, NO_CHECKPOINT
+from gratipay.models.exchange_route import ExchangeRoute
+from gratipay.testing import Harness
+
+
+class TestCheckDB(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now')
+
+    def totals(self):
+        return dict(self.db.all("SELECT participant, total FROM ledger_participant_totals"))
+
+    def test_check_db_records_a_checkpoint(self):
+        assert get_ledger_checkpoint(self.db) == NO_CHECKPOINT
+        e_id = self.make_exchange('braintree-cc', 50, 0, self.alice)
+        self.db.self_check()
+        assert get_ledger_checkpoint(self.db)['last_exchange_id'] == e_id
+        assert self.totals() == {'alice': D('50.00')}
+
+    def test_check_db_adds_new_rows_to_the_running_totals(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        self.db.self_check()
+        self.make_exchange('braintree-cc', 25, 0, self.alice)
+        self.db.self_check()
+        assert self.totals() == {'alice': D('75.00')}
+        assert self.db.one("SELECT count(*) FROM ledger_checkpoints") == 2
+
+    def test_check_db_doesnt_record_a_checkpoint_when_nothing_is_new(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        self.db.self_check()
+        self.db.self_check()
+        assert self.db.one("SELECT count(*) FROM ledger_checkpoints") == 1
+        assert self.totals() == {'alice': D('50.00')}
+
+    def test_check_db_catches_bad_balances_after_the_checkpoint(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        self.db.self_check()
+        self.make_exchange('braintree-cc', 25, 0, self.alice)
+        self.db.run("UPDATE participants SET balance = 70 WHERE username = 'alice'")
+        with self.assertRaises(AssertionError):
+            self.db.self_check()
+
+    def test_check_db_doesnt_rescan_rows_before_the_checkpoint(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        self.db.self_check()
+        self.db.run("UPDATE exchanges SET amount = 40")
+        self.make_exchange('braintree-cc', 25, 0, self.alice)
+        self.db.self_check()
+        with self.assertRaises(AssertionError):
+            self.db.self_check(full=True)
+
+    def test_full_check_rebuilds_the_running_totals(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        self.db.self_check()
+        self.db.run("UPDATE ledger_participant_totals SET total = 0")
+        self.db.self_check(full=True)
+        assert self.totals() == {'alice': D('50.00')}
+        assert self.db.one("SELECT count(*) FROM ledger_checkpoints") == 1
+
+    def test_checkpoint_stops_short_of_pending_exchanges(self):
+        first = self.make_exchange('braintree-cc', 50, 0, self.alice)
+        self.make_exchange('paypal', -20, 0, self.alice, status='pending')
+        self.make_exchange('braintree-cc', 10, 0, self.alice)
+        self.db.self_check()
+        assert get_ledger_checkpoint(self.db)['last_exchange_id'] == first
+        assert self.totals() == {'alice': D('50.00')}
+
+    def test_checkpoint_doesnt_move_while_ledgers_are_being_written(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        with self.db.get_cursor() as cursor:
+            cursor.run("""
+                INSERT INTO transfers (tipper, tippee, amount, context)
+                     VALUES ('alice', 'alice', 1, 'tip')
+            """)
+            self.db.self_check()
+            assert get_ledger_checkpoint(self.db) == NO_CHECKPOINT
+            cursor.connection.rollback()
+
+    def test_check_db_carries_on_in_its_transaction_while_ledgers_are_being_written(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        with self.db.get_cursor() as writer:
+            writer.run("""
+                INSERT INTO transfers (tipper, tippee, amount, context)
+                     VALUES ('alice', 'alice', 1, 'tip')
+            """)
+            with self.db.get_cursor() as cursor:
+                check_db(cursor)
+                assert cursor.one("SELECT count(*) FROM ledger_checkpoints") == 0
+            writer.connection.rollback()
+
+    def test_check_db_works_inside_a_transaction(self):
+        self.make_exchange('braintree-cc', 50, 0, self.alice)
+        with self.db.get_cursor() as cursor:
+            check_db(cursor)
+        assert self.totals() == {'alice': D('50.00')}
+
+
+class TestProjections(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now')
+        self.team = self.make_team(is_approved=True)
+
+    def current(self):
+        return self.db.all("SELECT participant, team, amount, is_funded, due "
+                           "FROM current_payment_instructions")
+
+    def test_new_instructions_replace_the_current_one(self):
+        self.alice.set_payment_instruction(self.team, '1.00')
+        self.alice.set_payment_instruction(self.team, '2.00')
+        assert self.current() == [('alice', 'TheEnterprise', D('2.00'), False, D('0.00'))]
+        self.db.self_check(full=True)
+
+    def test_updates_to_the_log_reach_the_current_table(self):
+        self.alice.set_payment_instruction(self.team, '1.00')
+        self.db.run("UPDATE payment_instructions SET is_funded = true, due = 1")
+        assert self.current() == [('alice', 'TheEnterprise', D('1.00'), True, D('1.00'))]
+        self.db.self_check(full=True)
+
+    def test_updates_to_the_current_table_reach_the_log(self):
+        self.alice.set_payment_instruction(self.team, '1.00')
+        self.db.run("UPDATE current_payment_instructions SET is_funded = true")
+        assert self.db.one("SELECT is_funded FROM payment_instructions") is True
+        self.db.self_check(full=True)
+
+    def test_current_table_follows_renames(self):
+        self.alice.set_payment_instruction(self.team, '1.00')
+        self.alice.change_username('bob')
+        assert self.current()[0].participant == 'bob'
+        self.db.self_check(full=True)
+
+    def test_check_db_catches_an_out_of_sync_current_table(self):
+        self.alice.set_payment_instruction(self.team, '1.00')
+        self.alice.set_payment_instruction(self.team, '2.00')
+        self.db.run("DELETE FROM current_payment_instructions")
+        with self.assertRaises(AssertionError):
+            self.db.self_check(full=True)
+
+    def test_the_first_two_instructions_for_a_key_can_be_inserted_at_once(self):
+        insert = """
+            INSERT INTO payment_instructions (ctime, participant, team, amount)
+                 VALUES (now(), 'alice', 'TheEnterprise', %s)
+        """
+        errors = []
+        def insert_second():
+            try:
+                self.db.run(insert, ('2.00',))
+            except Exception as e:
+                errors.append(e)
+        with self.db.get_cursor() as cursor:
+            cursor.run(insert, ('1.00',))
+            thread = threading.Thread(target=insert_second)
+            thread.start()
+            thread.join(0.5)  # it waits for us on the projection's primary key
+        thread.join()
+        assert errors == []
+        assert [pi.amount for pi in self.current()] == [D('2.00')]
+        self.db.self_check(full=True)
+
+    def test_new_tips_replace_the_current_one(self):
+        bob = self.make_participant('bob', claimed_time='now')
+        self.make_tip(self.alice, bob, '1.00')
+        self.make_tip(self.alice, bob, '2.00')
+        assert self.db.all("SELECT amount FROM current_tips") == [D('2.00')]
+        self.db.self_check(full=True)
+
+    def test_current_takes_still_hides_zero_takes(self):
+        self.make_participant('bob', claimed_time='now')
+        self.db.run("""
+            INSERT INTO takes (ctime, member, team, amount, recorder)
+                 VALUES (now(), 'bob', 'alice', 1, 'alice')
+                      , (now(), 'bob', 'alice', 0, 'alice')
+        """)
+        assert self.db.one("SELECT amount FROM latest_takes") == 0
+        assert self.db.all("SELECT * FROM current_takes") == []
+        self.db.self_check(full=True)
+
+    def test_deleting_the_current_route_promotes_the_previous_one(self):
+        first = ExchangeRoute.insert(self.alice, 'paypal', 'alice@example.com')
+        second = ExchangeRoute.insert(self.alice, 'paypal', 'alice@example.net')
+        assert ExchangeRoute.from_network(self.alice, 'paypal').id == second.id
+        second.invalidate()
+        assert ExchangeRoute.from_network(self.alice, 'paypal').id == first.id
+        self.db.self_check(full=True)
+
+    def test_current_community_members_follows_joins_and_leaves(self):
+        self.alice.insert_into_communities(True, 'Test', 'test')
+        self.alice.insert_into_communities(False, 'Test', 'test')
+        assert self.db.all("SELECT is_member FROM current_community_members") == [False]
+        self.db.self_check(full=True)
+
+    def test_only_a_full_check_db_checks_the_projections(self):
+        self.alice.set_payment_instruction(self.team, '1.00')
+        self.db.run("DELETE FROM current_payment_instructions")
+        self.db.self_check()
+        with self.assertRaises(AssertionError):
+            self.db.self_check(full=True)
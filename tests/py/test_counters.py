@@ -0,0 +1,102 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from decimal import Decimal as D
+
+from gratipay.models.counters import (
+    recompute_counters,
+    update_giving,
+    update_receiving,
+    update_taking,
+)
+from gratipay.models.exchange_route import ExchangeRoute
+from gratipay.testing import Harness
+
+
+class TestCounters(Harness):
+
+    def setUp(self):
+        Harness.setUp(self)
+        self.alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        self.bob = self.make_participant('bob', claimed_time='now', last_bill_result='')
+        self.enterprise = self.make_team(is_approved=True)
+        self.gratipay = self.make_team('Gratipay', owner='picard', is_approved=True)
+        self.alice.set_payment_instruction(self.enterprise, '1.00')
+        self.alice.set_payment_instruction(self.gratipay, '2.00')
+        self.bob.set_payment_instruction(self.gratipay, '4.00')
+
+    def counters(self):
+        return ( self.db.all("SELECT username, giving, ngiving_to, taking, ntaking_from "
+                             "FROM participants ORDER BY username")
+               , self.db.all("SELECT slug, receiving, nreceiving_from, distributing "
+                             "FROM teams ORDER BY slug")
+                )
+
+    def zero_counters(self):
+        self.db.run("UPDATE participants SET giving = 0, ngiving_to = 0, "
+                    "taking = 0, ntaking_from = 0")
+        self.db.run("UPDATE teams SET receiving = 0, nreceiving_from = 0, distributing = 0")
+
+    def test_set_payment_instruction_updates_the_counters(self):
+        participants, teams = self.counters()
+        assert participants == [ ('alice', D('3.00'), 2, D('0.00'), 0)
+                               , ('bob', D('4.00'), 1, D('0.00'), 0)
+                               , ('picard', D('0.00'), 0, D('7.00'), 2)
+                                ]
+        assert teams == [ ('Gratipay', D('6.00'), 2, D('6.00'))
+                        , ('TheEnterprise', D('1.00'), 1, D('1.00'))
+                         ]
+
+    def test_bulk_updates_leave_other_rows_alone(self):
+        self.zero_counters()
+        with self.db.get_cursor() as cursor:
+            update_giving(cursor, ['alice'])
+            update_receiving(cursor, ['TheEnterprise'])
+            update_taking(cursor, ['picard'])
+        participants, teams = self.counters()
+        assert participants == [ ('alice', D('3.00'), 2, D('0.00'), 0)
+                               , ('bob', D('0.00'), 0, D('0.00'), 0)
+                               , ('picard', D('0.00'), 0, D('1.00'), 2)
+                                ]
+        assert teams == [ ('Gratipay', D('0.00'), 0, D('0.00'))
+                        , ('TheEnterprise', D('1.00'), 1, D('1.00'))
+                         ]
+
+    def test_recompute_counters_finds_no_drift_when_there_is_none(self):
+        assert recompute_counters(self.db) == []
+
+    def test_recompute_counters_fixes_and_reports_drift(self):
+        expected = self.counters()
+        self.db.run("UPDATE participants SET giving = 10 WHERE username = 'bob'")
+        self.db.run("UPDATE teams SET nreceiving_from = 5 WHERE slug = 'Gratipay'")
+        drift = recompute_counters(self.db)
+        assert drift == [ ('participants', 'bob', 'giving', D('10.00'), D('4.00'))
+                        , ('teams', 'Gratipay', 'nreceiving_from', 5, 2)
+                         ]
+        assert self.counters() == expected
+
+    def test_set_payment_instruction_applies_the_difference_to_receiving(self):
+        self.db.run("UPDATE teams SET receiving = receiving + 10 WHERE slug = 'Gratipay'")
+        self.bob.set_payment_instruction(self.gratipay, '3.00')
+        gratipay = self.db.one("SELECT receiving, nreceiving_from FROM teams "
+                               "WHERE slug = 'Gratipay'")
+        assert gratipay == (D('15.00'), 2)  # the 10 was left alone
+        assert self.db.one("SELECT taking FROM participants WHERE username = 'picard'") == 6
+
+    def test_deltas_agree_with_recomputing(self):
+        carl = self.make_participant('carl', claimed_time='now', last_bill_result='Fail!')
+        dana = self.make_participant('dana', claimed_time='now', last_bill_result='',
+                                     is_suspicious=True)
+        carl.set_payment_instruction(self.gratipay, '8.00')
+        dana.set_payment_instruction(self.gratipay, '16.00')
+        self.alice.set_payment_instruction(self.gratipay, '0.00')
+        self.bob.set_payment_instruction(self.gratipay, '5.00')
+        self.bob.set_payment_instruction(self.enterprise, '1.00')
+        ExchangeRoute.from_network(carl, 'braintree-cc').update_error('')
+        assert recompute_counters(self.db) == []
+        assert self.db.one("SELECT receiving, nreceiving_from FROM teams "
+                           "WHERE slug = 'Gratipay'") == (D('13.00'), 2)
+
+    def test_set_payment_instruction_returns_the_new_receiving_on_the_team(self):
+        self.alice.set_payment_instruction(self.gratipay, '3.00')
+        assert self.gratipay.receiving == D('7.00')
+        assert self.gratipay.nreceiving_from == 2
@@ -1,10 +1,14 @@
 import json
+import pickle
+from decimal import Decimal as D
+
+from psycopg2 import Binary
 
 from gratipay.exceptions import CannotRemovePrimaryEmail, EmailAlreadyTaken, EmailNotVerified
 from gratipay.exceptions import TooManyEmailAddresses
 from gratipay.models.participant import Participant
 from gratipay.testing.emails import EmailHarness
-from gratipay.utils import emails
+from gratipay.utils import emails, i18n
 
 
 class TestEmail(EmailHarness):
@@ -223,3 +227,133 @@ class TestEmail(EmailHarness):
         Participant.dequeue_emails()
         assert self.mailer.call_count == 0
         assert self.db.one("SELECT spt_name FROM email_queue") is None
+
+    def test_dequeue_emails_sends_the_whole_queue_in_batches(self):
+        for name in ('larry', 'moe', 'curly'):
+            p = self.make_participant(name, email_address=name+'@example.com')
+            p.queue_email("verification")
+            p.queue_email("verification")
+        Participant.dequeue_emails(batch_size=4, nthreads=3)
+        assert self.mailer.call_count == 6
+        sent_to = sorted(m['to'][0]['email'] for m in self.fake_mandrill.messages.sent)
+        assert sent_to == ['curly@example.com']*2 + ['larry@example.com']*2 + ['moe@example.com']*2
+        assert self.db.one("SELECT count(*) FROM email_queue") == 0
+
+    def test_dequeue_emails_leaves_failed_emails_claimed_for_later(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        moe = self.make_participant('moe', email_address='moe@example.com')
+        larry.queue_email("verification")
+        moe.queue_email("verification")
+        self.fake_mandrill.messages.fail_for.add('larry@example.com')
+        Participant.dequeue_emails()
+        assert [m['to'][0]['email'] for m in self.fake_mandrill.messages.sent] == ['moe@example.com']
+        left = self.db.one("SELECT participant, claimed_until > now() AS claimed FROM email_queue")
+        assert left == (larry.id, True)
+
+        # It's not picked up again until the claim runs out
+        self.fake_mandrill.messages.fail_for.clear()
+        Participant.dequeue_emails()
+        assert self.mailer.call_count == 2
+        self.db.run("UPDATE email_queue SET claimed_until = now() - interval '1 second'")
+        Participant.dequeue_emails()
+        assert self.mailer.call_count == 3
+        assert self.db.one("SELECT count(*) FROM email_queue") == 0
+
+    def test_queued_context_is_versioned_json(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        larry.queue_email('charge_succeeded', nteams=1, top_team='Gratipay',
+                          exchange=dict(id=1, amount=D('10.00'), fee=D('0.59'), note=''))
+        row = self.db.one("SELECT context, context_version FROM email_queue")
+        assert row.context_version == emails.CONTEXT_VERSION == 2
+        assert json.loads(bytes(row.context))['top_team'] == 'Gratipay'
+        assert b'"amount":10.00' in bytes(row.context)
+        context = emails.decode_context(row.context_version, row.context)
+        assert context['exchange']['amount'] == D('10.00')
+        assert isinstance(context['exchange']['fee'], D)
+        Participant.dequeue_emails()
+        assert '$10.59' in self.get_last_email()['text']
+
+    def test_pickled_contexts_queued_before_json_are_still_sent(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        self.db.run("""
+            INSERT INTO email_queue (participant, spt_name, context, context_version)
+                 VALUES (%s, 'verification', %s, 1)
+        """, (larry.id, Binary(pickle.dumps(dict(link='https://example.com/')))))
+        Participant.dequeue_emails()
+        assert self.mailer.call_count == 1
+        assert 'https://example.com/' in self.get_last_email()['text']
+
+    def test_queue_emails_queues_many_in_one_go(self):
+        larry = self.make_participant('larry', email_address='larry@example.com')
+        moe = self.make_participant('moe', email_address='moe@example.com')
+        Participant.queue_emails([ (larry.id, 'verification', {'link': 'a'})
+                                 , (moe.id, 'verification', {'link': 'b'})
+                                  ])
+        queued = self.db.all("SELECT participant, spt_name FROM email_queue ORDER BY id")
+        assert queued == [(larry.id, 'verification'), (moe.id, 'verification')]
+        Participant.queue_emails([])
+        assert self.db.one("SELECT count(*) FROM email_queue") == 2
+
+
+class TestRateLimiter(object):
+
+    def make_limiter(self, per_minute):
+        self.now = 0
+        self.slept = []
+        def sleep(seconds):
+            self.slept.append(seconds)
+            self.now += seconds
+        return emails.RateLimiter(per_minute, clock=lambda: self.now, sleep=sleep)
+
+    def test_rate_limiter_spaces_out_calls(self):
+        limiter = self.make_limiter(120)
+        for i in range(3):
+            limiter.wait()
+        assert self.slept == [0.5, 0.5]
+
+    def test_rate_limiter_doesnt_wait_after_a_pause(self):
+        limiter = self.make_limiter(60)
+        limiter.wait()
+        self.now += 5
+        limiter.wait()
+        assert self.slept == []
+
+    def test_zero_means_no_limit(self):
+        limiter = self.make_limiter(0)
+        for i in range(3):
+            limiter.wait()
+        assert self.slept == []
+
+
+class TestRenderEmail(EmailHarness):
+
+    def setUp(self):
+        EmailHarness.setUp(self)
+        self.larry = self.make_participant('larry', email_address='larry@example.com')
+
+    def render(self, spt_name='verification', **context):
+        return self.larry.render_email(spt_name, link='https://example.com/', **context)
+
+    def test_body_is_put_in_the_base_template(self):
+        message = self.render(include_unsubscribe=False)
+        assert message['text'].startswith("Greetings!\n\n")
+        assert message['text'].endswith("716 Park Road, Ambridge, PA, 15003, USA")
+        assert "connect larry" in message['text']
+        assert '$body' not in message['text'] + message['html']
+        assert message['html'].startswith('<div style="text-align: center;')
+
+    def test_templates_are_bound_to_each_locale_once(self):
+        template = Participant._emails['verification']['text/plain']
+        template.by_locale.clear()
+        self.render()
+        self.render()
+        assert list(template.by_locale) == ['en']
+        self.larry.set_attributes(email_lang='fr')
+        self.render()
+        assert sorted(template.by_locale) == ['en', 'fr']
+
+    def test_match_accept_lang_matches_like_match_lang(self):
+        accept_lang = 'xx-YY,en;q=0.8'
+        expected = i18n.match_lang(i18n.parse_accept_lang(accept_lang))
+        assert i18n.match_accept_lang(accept_lang) is expected
+        assert i18n.MATCHED_LANGS[accept_lang] is expected
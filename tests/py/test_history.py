@@ -1,6 +1,6 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
-from datetime import datetime
+from datetime import date, datetime
 from decimal import Decimal as D
 import json
 
@@ -10,7 +10,9 @@ from gratipay.billing.payday import Payday
 from gratipay.models.participant import Participant
 from gratipay.testing import Harness
 from gratipay.testing.billing import BillingHarness
-from gratipay.utils.history import get_end_of_year_balance, iter_payday_events
+from gratipay.utils.history import ( get_end_of_year_balance, iter_payday_events
+                                   , snapshot_balances
+                                    )
 
 
 def make_history(harness):
@@ -99,11 +101,71 @@ class TestHistory(BillingHarness):
         assert events[4]['kind'] == 'day-close'
         assert events[4]['balance'] == 0
 
+    def test_iter_payday_events_can_be_paginated_by_day(self):
+        alice = self.make_participant('alice', claimed_time=datetime(2001, 1, 1))
+        year = datetime.utcnow().year - 1
+        for i in range(3):
+            e_id = self.make_exchange('braintree-cc', 10, 0, alice)
+            self.db.run("UPDATE exchanges SET timestamp = %s WHERE id = %s",
+                        (datetime(year, 6, i+1, 12), e_id))
+
+        events = list(iter_payday_events(self.db, alice, year, ndays=2))
+        assert [e['kind'] for e in events] == [ 'day-open', 'charge', 'day-close'
+                                              , 'day-open', 'charge', 'day-close'
+                                              , 'more'
+                                               ]
+        assert events[0]['balance'] == 30
+        assert events[-1]['before'] == date(year, 6, 2)
+
+        events = list(iter_payday_events(self.db, alice, year, events[-1]['before'], ndays=2))
+        assert [e['kind'] for e in events] == ['day-open', 'charge', 'day-close']
+        assert events[0]['date'] == date(year, 6, 1)
+        assert events[0]['balance'] == 10
+        assert events[-1]['balance'] == 0
+
     def test_get_end_of_year_balance(self):
         make_history(self)
         balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
         assert balance == 10
 
+    def get_snapshots(self):
+        return self.db.all("""
+            SELECT extract(year from "at")::int - 1 AS year, balance
+              FROM balances_at
+             WHERE participant = %s
+          ORDER BY "at"
+        """, (self.alice.id,))
+
+    def test_snapshot_balances_snapshots_past_years(self):
+        make_history(self)
+        self.db.run("UPDATE participants SET ctime = ctime - interval '2 years'")
+        snapshot_balances(self.db)
+        assert self.get_snapshots() == [(self.past_year - 1, 0), (self.past_year, 10)]
+
+    def test_snapshot_balances_skips_years_that_are_done(self):
+        make_history(self)
+        self.db.run("UPDATE participants SET ctime = ctime - interval '1 year'")
+        snapshot_balances(self.db)
+        self.db.run("UPDATE balances_at SET balance = 42")
+        snapshot_balances(self.db)
+        assert self.get_snapshots() == [(self.past_year, 42)]
+
+    def test_get_end_of_year_balance_uses_snapshots(self):
+        make_history(self)
+        self.db.run("UPDATE participants SET ctime = ctime - interval '1 year'")
+        snapshot_balances(self.db)
+        self.db.run("UPDATE balances_at SET balance = 42")
+        balance = get_end_of_year_balance(self.db, self.alice, self.past_year, datetime.now().year)
+        assert balance == 42
+
+    def test_payday_snapshots_balances(self):
+        make_history(self)
+        self.db.run("UPDATE participants SET ctime = ctime - interval '1 year'")
+        with patch.object(Payday, 'fetch_card_holds') as fch:
+            fch.return_value = {}
+            Payday.start().run()
+        assert self.get_snapshots() == [(self.past_year, 10)]
+
 
 class TestHistoryPage(Harness):
 
@@ -122,6 +184,10 @@ class TestHistoryPage(Harness):
         response = self.client.GET('/~alice/history/?year=%s' % self.past_year, auth_as='bob')
         assert "automatic charge" in response.body
 
+    def test_bad_before_date_is_400(self):
+        response = self.client.GxT('/~alice/history/?before=yesterday', auth_as='alice')
+        assert response.code == 400
+
 class TestExport(Harness):
 
     def setUp(self):
@@ -143,3 +209,43 @@ class TestExport(Harness):
     def test_export_csv(self):
         r = self.client.GET('/~alice/history/export.csv?key=exchanges', auth_as='alice')
         assert r.body.count('\n') == 5
+
+    def test_export_csv_can_be_streamed(self):
+        r = self.client.GET('/~alice/history/export.csv?key=exchanges', auth_as='alice')
+        streamed = self.client.GET('/~alice/history/export.csv?key=exchanges&stream=yes',
+                                   auth_as='alice')
+        assert not isinstance(streamed.body, basestring)
+        assert b''.join(streamed.body) == r.body
+
+    def test_export_ndjson(self):
+        r = self.client.GET('/~alice/history/export.ndjson?year=%s&key=exchanges' % self.past_year,
+                            auth_as='alice')
+        assert r.headers['Content-Type'].startswith('application/x-ndjson')
+        rows = [json.loads(line) for line in b''.join(r.body).splitlines()]
+        assert len(rows) == 4
+        assert set(rows[0]) == set(['timestamp', 'amount', 'fee', 'status', 'note'])
+
+    def test_export_ndjson_requires_key(self):
+        r = self.client.GxT('/~alice/history/export.ndjson', auth_as='alice')
+        assert r.code == 400
+
+    def test_iter_all_yields_the_same_rows_as_all(self):
+        sql = "SELECT * FROM exchanges ORDER BY id"
+        assert list(self.db.iter_all(sql, itersize=2)) == self.db.all(sql)
+        assert list(self.db.iter_all(sql, back_as=dict)) == self.db.all(sql, back_as=dict)
+
+    def test_iter_all_can_stream_two_result_sets_at_once(self):
+        sql = "SELECT * FROM exchanges ORDER BY id"
+        first, second = self.db.iter_all(sql, itersize=1), self.db.iter_all(sql, itersize=1)
+        assert zip(first, second) == [(row, row) for row in self.db.all(sql)]
+
+    def test_iter_all_reads_from_the_pool_when_every_stream_is_taken(self):
+        sql = "SELECT * FROM exchanges ORDER BY id"
+        streams = [self.db.iter_all(sql, itersize=1) for i in range(3)]
+        firsts = [next(stream) for stream in streams]
+        assert self.db.stream_slots.acquire(False) is False
+        assert firsts == [self.db.one(sql + " LIMIT 1")] * 3
+        for stream in streams:
+            stream.close()
+        assert self.db.stream_slots.acquire(False) is True
+        self.db.stream_slots.release()
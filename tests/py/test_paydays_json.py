@@ -15,3 +15,18 @@ class Tests(Harness):
         response = self.client.GET("/about/paydays.json")
         paydays = json.loads(response.body)
         assert paydays[0]['nusers'] == 0
+
+    def test_timing_json_gives_stage_metrics(self):
+        payday = Payday.start()
+        with payday.measure('update_stats'):
+            payday.update_stats()
+
+        response = self.client.GET("/about/paydays/%i/timing.json" % payday.id)
+        timing = json.loads(response.body)
+        assert timing['payday'] == payday.id
+        assert [s['stage'] for s in timing['stages']] == ['update_stats']
+        assert timing['stages'][0]['nprocessor_calls'] == 0
+
+    def test_timing_json_404s_for_unknown_payday(self):
+        response = self.client.GxT("/about/paydays/42/timing.json")
+        assert response.code == 404
@@ -0,0 +1,286 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import time
+from decimal import Decimal as D
+from tempfile import mkdtemp
+
+from gratipay.models.exchange_route import ExchangeRoute
+from gratipay.testing import Harness
+from gratipay.utils.query_cache import FormattingError, QueryCache
+from gratipay.utils.shared_cache import FileBackend, MemoryBackend
+
+
+class QueryCacheHarness(Harness):
+
+    def make_cache(self, **kw):
+        cache = QueryCache(self.db, **kw)
+        self.addCleanup(cache.stop)
+        return cache
+
+    def make_directory(self):
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        return directory
+
+
+class TestQueryCache(QueryCacheHarness):
+
+    def setUp(self):
+        QueryCacheHarness.setUp(self)
+        self.cache = self.make_cache(threshold=5)
+
+    def test_results_are_cached(self):
+        assert self.cache.one("SELECT count(*) FROM teams") == 0
+        self.make_team()
+        assert self.cache.one("SELECT count(*) FROM teams") == 0
+        assert self.cache.stats['hits'] == 1
+        assert self.cache.stats['misses'] == 1
+
+    def test_ttl_can_be_given_per_query(self):
+        assert self.cache.one("SELECT count(*) FROM teams", ttl=0.01) == 0
+        self.make_team()
+        time.sleep(0.02)
+        assert self.cache.one("SELECT count(*) FROM teams", ttl=0.01) == 1
+        assert self.cache.stats['misses'] == 2
+
+    def test_version_is_part_of_the_key(self):
+        assert self.cache.one("SELECT count(*) FROM teams", version=1) == 0
+        self.make_team()
+        assert self.cache.one("SELECT count(*) FROM teams", version=1) == 0
+        assert self.cache.one("SELECT count(*) FROM teams", version=2) == 1
+
+    def test_all_can_process_results(self):
+        self.make_team()
+        actual = self.cache.all("SELECT slug FROM teams", process=lambda rows: len(list(rows)))
+        assert actual == 1
+
+    def test_clear_empties_the_cache(self):
+        self.cache.one("SELECT count(*) FROM teams")
+        self.cache.clear()
+        assert self.cache.cache == {}
+        assert self.cache.nbytes == 0
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = self.make_cache(max_entries=2)
+        cache.one("SELECT 1")
+        cache.one("SELECT 2")
+        cache.one("SELECT 1")
+        cache.one("SELECT 3")
+        assert [q for q, p in cache.cache] == ["SELECT 1", "SELECT 3"]
+        assert cache.stats['evictions'] == 1
+
+    def test_cache_is_bounded_by_bytes(self):
+        cache = self.make_cache(max_bytes=3000)
+        for i in range(5):
+            cache.one("SELECT repeat('x', 1000) AS i%i" % i)
+        assert len(cache.cache) == 2
+        assert cache.nbytes <= 3000
+
+    def test_rows_count_towards_the_byte_bound(self):
+        cache = self.make_cache(max_bytes=30000)
+        for i in range(5):
+            cache.all("SELECT repeat('x', 1000) AS x, %i AS i FROM generate_series(1, 10)" % i)
+        assert len(cache.cache) == 2
+        assert 20000 < cache.nbytes <= 30000
+
+    def test_prune_once_removes_only_expired_entries(self):
+        cache = self.make_cache(threshold_prune=0)
+        cache.one("SELECT 1", ttl=0)
+        cache.one("SELECT 2", ttl=60)
+        cache.prune_once()
+        assert [q for q, p in cache.cache] == ["SELECT 2"]
+        assert cache.expiries == [(cache.expiries[0][0], ("SELECT 2", None))]
+        assert cache.stats['evictions'] == 1
+
+    def test_stop_ends_the_pruning_thread(self):
+        self.cache.stop()
+        assert not self.cache.pruner.is_alive()
+
+
+class TestServeStale(QueryCacheHarness):
+
+    QUERY = "SELECT count(*) FROM teams"
+
+    def setUp(self):
+        QueryCacheHarness.setUp(self)
+        self.cache = self.make_cache(serve_stale=True)
+
+    def wait_for_refresh(self):
+        entry = self.cache.cache[(self.QUERY, None)]
+        entry.lock.acquire()
+        entry.lock.release()
+
+    def test_expired_entries_are_served_stale_while_refreshing(self):
+        assert self.cache.one(self.QUERY, ttl=0.01) == 0
+        self.make_team()
+        time.sleep(0.02)
+        assert self.cache.one(self.QUERY, ttl=0.01) == 0
+        self.wait_for_refresh()
+        assert self.cache.one(self.QUERY, ttl=60) == 1
+        assert self.cache.stats['stale'] == 1
+
+    def test_failed_refresh_keeps_the_last_good_result(self):
+        calls = []
+        def process(n):
+            calls.append(n)
+            if len(calls) > 1:
+                raise Exception
+            return n
+        assert self.cache.one(self.QUERY, process=process, ttl=0.01) == 0
+        self.make_team()
+        time.sleep(0.02)
+        assert self.cache.one(self.QUERY, process=process, ttl=0.01) == 0
+        self.wait_for_refresh()
+        assert self.cache.one(self.QUERY, process=process, ttl=0.01) == 0
+        assert self.cache.stats['errors'] >= 1
+
+    def test_errors_arent_cached(self):
+        calls = []
+        def process(n):
+            calls.append(n)
+            if len(calls) == 1:
+                raise Exception
+            return n
+        with self.assertRaises(FormattingError):
+            self.cache.one(self.QUERY, process=process)
+        assert self.cache.one(self.QUERY, process=process) == 0
+
+
+class TestCachedEndpoints(Harness):
+
+    def test_paydays_json_is_cached(self):
+        cache = self.client.website.query_cache
+        before = dict(cache.stats)
+        self.client.GET("/about/paydays.json")
+        self.client.GET("/about/paydays.json")
+        assert cache.stats['misses'] - before['misses'] == 1
+        assert cache.stats['hits'] - before['hits'] == 1
+
+    def get_payment_distribution(self):
+        bins = json.loads(self.client.GET("/about/payment-distribution.json").body)
+        return {b['hi']: (b['n'], b['sum']) for b in bins if b['n'] != '0'}
+
+    def test_payment_distribution_json_is_refreshed_when_instructions_change(self):
+        team = self.make_team(is_approved=True)
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        alice.set_payment_instruction(team, '1.00')
+        assert self.get_payment_distribution() == {'1.00': ('1', '1.00')}
+
+        bob = self.make_participant('bob', claimed_time='now', last_bill_result='Fail!')
+        bob.set_payment_instruction(team, '0.15')
+        assert self.get_payment_distribution() == {'1.00': ('1', '1.00')}
+
+        ExchangeRoute.from_network(bob, 'braintree-cc').update_error('')
+        assert self.get_payment_distribution() == { '1.00': ('1', '1.00')
+                                                  , '0.20': ('1', '0.15')
+                                                   }
+
+    def test_payment_distribution_json_is_refreshed_when_a_team_is_rejected(self):
+        team = self.make_team(is_approved=True)
+        alice = self.make_participant('alice', claimed_time='now', last_bill_result='')
+        alice.set_payment_instruction(team, '1.00')
+        assert self.get_payment_distribution() == {'1.00': ('1', '1.00')}
+
+        self.db.run("UPDATE teams SET is_approved = false")
+        assert self.get_payment_distribution() == {}
+
+
+class TestSharedBackends(QueryCacheHarness):
+
+    QUERY = "SELECT count(*) FROM teams"
+
+    def count_queries(self):
+        calls = []
+        def process(n):
+            calls.append(n)
+            return n
+        return calls, process
+
+    def test_caches_with_a_shared_backend_run_a_query_once(self):
+        shared = MemoryBackend()
+        first, second = self.make_cache(shared=shared), self.make_cache(shared=shared)
+        calls, process = self.count_queries()
+        assert first.one(self.QUERY, process=process) == 0
+        self.make_team()
+        assert second.one(self.QUERY, process=process) == 0
+        assert len(calls) == 1
+        assert second.stats['shared_hits'] == 1
+
+    def test_shared_results_expire(self):
+        shared = MemoryBackend()
+        first, second = self.make_cache(shared=shared), self.make_cache(shared=shared)
+        first.one(self.QUERY, ttl=0.01)
+        self.make_team()
+        time.sleep(0.02)
+        assert second.one(self.QUERY, ttl=0.01) == 1
+
+    def test_file_backend_round_trips_values(self):
+        backend = FileBackend(self.make_directory())
+        key = (self.QUERY, None)
+        assert backend.get(key) is None
+        backend.set(key, 1234.5, [{'a': D('1.00')}], 60)
+        assert backend.get(key) == (1234.5, [{'a': D('1.00')}])
+        backend.clear()
+        assert backend.get(key) is None
+
+    def test_memory_backend_prunes_expired_values_and_their_locks(self):
+        backend = MemoryBackend()
+        expired, fresh = ("SELECT 1", None), ("SELECT 2", None)
+        with backend.lock(expired):
+            backend.set(expired, time.time(), 1, 0)
+        backend.set(fresh, time.time(), 2, 60)
+        backend.prune()
+        assert backend.values.keys() == [fresh]
+        assert backend.key_locks.keys() == []
+
+    def test_file_backend_prunes_expired_values_and_their_locks(self):
+        directory = self.make_directory()
+        backend = FileBackend(directory)
+        expired, fresh = ("SELECT 1", None), ("SELECT 2", None)
+        with backend.lock(expired):
+            backend.set(expired, time.time(), 1, 0)
+        backend.set(fresh, time.time(), 2, 60)
+        backend.prune()
+        assert backend.get(expired) is None
+        assert backend.get(fresh)[1] == 2
+        assert os.listdir(directory) == [os.path.basename(backend._path(fresh))]
+
+    def test_file_backend_keeps_lock_files_that_are_held(self):
+        directory = self.make_directory()
+        backend = FileBackend(directory)
+        key = ("SELECT 1", None)
+        with backend.lock(key):
+            backend.prune()
+            assert os.listdir(directory) == [os.path.basename(backend._path(key)) + '.lock']
+
+    def test_pruning_a_cache_prunes_its_shared_backend(self):
+        shared = MemoryBackend()
+        cache = self.make_cache(shared=shared)
+        cache.one(self.QUERY, ttl=0)
+        cache.prune_once()
+        assert shared.values == {}
+
+    def test_caches_can_share_a_file_backend(self):
+        directory = self.make_directory()
+        first = self.make_cache(shared=FileBackend(directory))
+        second = self.make_cache(shared=FileBackend(directory))
+        first.one(self.QUERY)
+        self.make_team()
+        assert second.one(self.QUERY) == 0
+        assert second.stats['shared_hits'] == 1
+
+    def test_caches_can_share_rows_through_a_file_backend(self):
+        directory = self.make_directory()
+        first = self.make_cache(shared=FileBackend(directory))
+        second = self.make_cache(shared=FileBackend(directory))
+        self.make_team(is_approved=True)
+        query = "SELECT slug, is_approved FROM teams ORDER BY slug"
+        rows = first.all(query)
+        self.make_team('Gratipay')
+        shared = second.all(query)
+        assert second.stats['shared_hits'] == 1
+        assert shared == rows == [('TheEnterprise', True)]
+        assert shared[0].slug == 'TheEnterprise'
@@ -0,0 +1,39 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from gratipay.testing import Harness
+from gratipay.utils import query_recorder
+from gratipay.utils.query_recorder import QueryRecorder
+
+
+class TestQueryRecorder(Harness):
+
+    def test_recorder_keeps_the_slowest_statements(self):
+        recorder = QueryRecorder(nslowest=2)
+        for i, elapsed in enumerate([0.1, 0.5, 0.2, 0.4]):
+            recorder.record('q%i' % i, elapsed)
+        assert recorder.count == 4
+        assert abs(recorder.total_time - 1.2) < 1e-9
+        assert recorder.slowest == [(0.5, 'q1'), (0.4, 'q3')]
+
+    def test_queries_are_recorded_between_start_and_end(self):
+        recorder = query_recorder.start()['query_recorder']
+        try:
+            self.db.one("SELECT 1")
+            self.db.all("SELECT 2", back_as=dict)
+            with self.db.get_cursor(back_as='tuple') as cursor:
+                cursor.run("SELECT 3")
+        finally:
+            query_recorder.end(recorder, self.client.website)
+        assert recorder.count == 3
+        self.db.one("SELECT 4")
+        assert recorder.count == 3
+
+    def test_admins_get_a_server_timing_header(self):
+        self.make_participant('admin', claimed_time='now', is_admin=True)
+        response = self.client.GET('/about/stats', auth_as='admin')
+        assert response.headers['Server-Timing'].startswith('db;dur=')
+
+    def test_others_dont_get_a_server_timing_header(self):
+        self.make_participant('alice', claimed_time='now')
+        response = self.client.GET('/about/stats', auth_as='alice')
+        assert 'Server-Timing' not in response.headers